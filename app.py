@@ -1,181 +1,2708 @@
+import fcntl
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                TimeoutError as FutureTimeout)
+from concurrent.futures.process import BrokenProcessPool
+import gzip
+import hashlib
+import mimetypes
+import multiprocessing
+import re
 import secrets
-from flask import (Flask, json, render_template, request, flash,
+import shlex
+import signal
+import socket
+import sqlite3
+import sys
+from flask import (Flask, Response, json, render_template, request, flash,
                    redirect, send_from_directory, make_response, jsonify,
-                   url_for)
+                   url_for, abort, stream_with_context)
 import os
 import time
 import uuid
 import subprocess
-from threading import Lock, Thread
+from threading import BoundedSemaphore, Condition, Event, Lock, Thread, local
 import tempfile
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
+from werkzeug.utils import safe_join, secure_filename
 import shutil
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
 from mocpy import MOC
 
+from tools.catalog_hips import build_catalog_hips
+from tools.hips2fits_cutout import generate_bytes, warm_up
+from tools.hips_properties import get_initial_view, read_properties
+
 
 app = Flask(__name__)
 CORS(app)
 app.secret_key = 'your-secret-key'
 
-UPLOAD_FOLDER = 'uploads'
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-ALLOWED_EXTENSIONS = {'fits'}
-app.config['MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024 * 1024  # 4 Go
+UPLOAD_FOLDER = 'uploads'
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# content-addressed store of the uploaded FITS files, named by sha256
+app.config['BLOB_FOLDER'] = 'blobs'
+# finished HiPS, named by hips_cache_key. The least recently used ones
+# are removed when the cache holds more than HIPS_CACHE_MAX_BYTES
+app.config['HIPS_CACHE_FOLDER'] = 'hips_cache'
+app.config['HIPS_CACHE_MAX_BYTES'] = 50 * 1024 * 1024 * 1024  # 50 Go
+# input folders of the queued and running project jobs, kept across
+# restarts for the jobs to resume
+app.config['JOB_INPUT_FOLDER'] = 'job_inputs'
+app.config['UPLOAD_CHUNK_SIZE'] = 1024 * 1024
+app.config['MAX_CHUNK_SIZE'] = 64 * 1024 * 1024
+# chunked uploads (and .part files of interrupted uploads) not written to
+# for this long are removed
+app.config['CHUNKED_UPLOAD_EXPIRE_S'] = 24 * 3600
+app.config['DATABASE'] = 'metadata.db'
+SHARED_PAGES_JSON = os.path.join("shared-pages", "shared_pages.json")
+ALLOWED_EXTENSIONS = {'fits'}
+app.config['MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024 * 1024  # 4 Go
+# heap of the Hipsgen daemon JVM, and least memory reserved for one job
+# when sizing the worker pool (the largest profile's is used when larger)
+app.config['HIPSGEN_JOB_MEMORY'] = 2 * 1024 * 1024 * 1024  # 2 Go
+app.config['HIPSGEN_MAX_WORKERS'] = None  # None: sized from cpu and memory
+app.config['HIPSGEN_MAX_JOBS_PER_USER'] = 1
+app.config['HIPSGEN_LOG_LINES'] = 200
+# Unix socket of the long-lived Hipsgen JVM (tools/HipsgenDaemon.java),
+# None to start a new java process for each Hipsgen command
+app.config['HIPSGEN_DAEMON_SOCKET'] = None
+# Hipsgen execution profiles, the first one whose `max_input` (bytes of
+# image data, from the FITS headers) holds the input is used. `memory` is
+# the JVM heap, capped by the available memory of the host, `threads` the
+# Hipsgen threads (None: all cores) and `tmp_dir` the JVM scratch folder
+# (None: HIPSGEN_TMP_FOLDER).
+app.config['HIPSGEN_PROFILES'] = [
+    {'name': 'small', 'max_input': 256 * 1024 * 1024,
+     'memory': 1024 * 1024 * 1024, 'threads': 2, 'tmp_dir': None},
+    {'name': 'medium', 'max_input': 4 * 1024 * 1024 * 1024,
+     'memory': 4 * 1024 * 1024 * 1024, 'threads': 4, 'tmp_dir': None},
+    {'name': 'large', 'max_input': None,
+     'memory': 8 * 1024 * 1024 * 1024, 'threads': None, 'tmp_dir': None},
+]
+app.config['HIPSGEN_TMP_FOLDER'] = None  # None: the system temp folder
+# partitioned builds: the tiles of projects with more image data than
+# HIPSGEN_PARTITION_MIN_INPUT are generated as HIPSGEN_PARTITIONS sky
+# regions in parallel, on the HIPSGEN_PARTITION_HOSTS (over ssh) or
+# locally when the list is empty. The hosts see the application folder,
+# on a shared filesystem, at the absolute HIPSGEN_PARTITION_SHARED_ROOT.
+app.config['HIPSGEN_PARTITIONS'] = 4
+app.config['HIPSGEN_PARTITION_MIN_INPUT'] = 4 * 1024 * 1024 * 1024
+app.config['HIPSGEN_PARTITION_HOSTS'] = []
+app.config['HIPSGEN_PARTITION_SHARED_ROOT'] = None
+# figures used by the dry-run cost estimate of /estimate_hips
+app.config['HIPS_TILE_WIDTH'] = 512
+app.config['HIPS_PNG_TILE_BYTES'] = 150 * 1024
+app.config['HIPSGEN_TILES_PER_S'] = 50
+app.config['HIPSGEN_STARTUP_S'] = 5
+# browser/proxy caching of the HiPS tiles. A finished HiPS can still be
+# regenerated under the same name, shared HiPS are never modified.
+app.config['HIPS_TILE_MAX_AGE'] = 3600
+app.config['SHARED_TILE_MAX_AGE'] = 365 * 24 * 3600
+# write a .gz sibling of each FITS tile once a HiPS is generated
+app.config['HIPS_PRECOMPRESS'] = True
+# HiPS deeper than this order are first published up to this order only,
+# so that they can be previewed during the generation (None: disabled)
+app.config['HIPS_PREVIEW_ORDER'] = 3
+
+# durable job queue: a worker leases a job for JOB_LEASE_S seconds and
+# renews the lease every JOB_HEARTBEAT_S. The job of a worker that stopped
+# renewing its lease is resumed by another worker, at most
+# JOB_MAX_ATTEMPTS times. Jobs are run by the web process, or only by
+# `python app.py worker` processes when JOB_IN_PROCESS_WORKERS is False.
+app.config['JOB_LEASE_S'] = 60
+app.config['JOB_HEARTBEAT_S'] = 5
+app.config['JOB_MAX_ATTEMPTS'] = 3
+app.config['JOB_IN_PROCESS_WORKERS'] = True
+# /progress_stream: the tasks are read, and their changes pushed, at most
+# once per PROGRESS_STREAM_INTERVAL seconds. A stream is closed after
+# PROGRESS_STREAM_MAX_S seconds and the browser opens a new one.
+app.config['PROGRESS_STREAM_INTERVAL'] = 1.0
+app.config['PROGRESS_STREAM_MAX_S'] = 300
+
+# Catalog HiPS builder: 'native' (tools/catalog_hips.py) or 'hipsgen-cat'
+app.config['CATALOG_HIPS_ENGINE'] = 'native'
+
+# /cutout: processes kept running between the cutouts, so that the numba
+# kernels stay compiled, largest cutout (pixels) and longest run (s)
+app.config['CUTOUT_WORKERS'] = 2
+# processes of each cutout worker for the pixel to sky transform of the
+# largest cutouts (hips2fits_cutout.PIX2WORLD_MIN_PIXELS)
+app.config['CUTOUT_PIX2WORLD_WORKERS'] = 4
+app.config['CUTOUT_MAX_PIXELS'] = 4096 * 4096
+app.config['CUTOUT_TIMEOUT_S'] = 120
+# cutouts waiting for a worker, /cutout answers 503 beyond. A timed out
+# cutout keeps its worker, and its place, until it really ends.
+app.config['CUTOUT_QUEUE'] = 8
+CUTOUT_MIMETYPES = {'fits': 'application/fits', 'png': 'image/png',
+                    'jpg': 'image/jpeg'}
+CUTOUT_STRETCHES = ('linear', 'sqrt', 'log', 'asinh')
+
+task_queue = {}
+upload_digests = {}
+chunked_uploads = {}
+chunked_uploads_lock = Lock()
+chunked_uploads_expired = 0.0
+cutout_pool = None
+cutout_pool_lock = Lock()
+cutout_slots = None
+db_local = local()
+progress_lock = Lock()
+# incremented, under its condition, each time the tasks of this process
+# change: the progress streams wait for it instead of polling
+progress_version = 0
+progress_changed = Condition()
+
+
+def publish_progress():
+    """Wake up the progress streams after a change of the tasks."""
+    global progress_version
+    with progress_changed:
+        progress_version += 1
+        progress_changed.notify_all()
+
+
+def allowed_file(filename):
+    """
+    Check if the file has a valid extension.
+
+    Args:
+        filename (str): Name of the file to check.
+
+    Returns:
+        bool: True if the file has a valid extension, False otherwise.
+    """
+    return (
+        '.' in filename and
+        filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    )
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS shared_pages (
+    public_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shared_pages_user ON shared_pages (user_id);
+CREATE TABLE IF NOT EXISTS shared_hips (
+    public_id TEXT NOT NULL
+        REFERENCES shared_pages (public_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (public_id, position)
+);
+CREATE TABLE IF NOT EXISTS hips (
+    hips_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hips_user ON hips (user_id);
+CREATE TABLE IF NOT EXISTS uploads (
+    user_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT,
+    hips_id TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (user_id, filename)
+);
+CREATE TABLE IF NOT EXISTS catalogs (
+    user_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    ra_col TEXT,
+    dec_col TEXT,
+    score_col TEXT,
+    created REAL NOT NULL,
+    PRIMARY KEY (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS job_resources (
+    hips_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    profile TEXT,
+    input_bytes INTEGER,
+    heap_bytes INTEGER,
+    threads INTEGER,
+    wall_s REAL,
+    cpu_s REAL,
+    max_rss_bytes INTEGER,
+    returncode INTEGER,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_resources_profile ON job_resources (profile);
+CREATE TABLE IF NOT EXISTS hips_inputs (
+    hips_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (hips_id, filename)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    state TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, seq);
+CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (job_id)
+    WHERE status IN ('queued', 'running', 'cancelling');
+"""
+
+
+def get_db():
+    """
+    Return the connection of the current thread to the metadata store.
+
+    The store is a SQLite database in WAL mode: readers never wait for a
+    writer, and each write is an atomic transaction (`with db:`).
+
+    Returns:
+        sqlite3.Connection: Connection to the metadata store.
+    """
+    db = getattr(db_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(app.config['DATABASE'], timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA foreign_keys=ON")
+        db_local.db = db
+    return db
+
+
+def init_db():
+    """
+    Create the tables of the metadata store, and import the shared pages
+    of `shared_pages.json` and the files already on disk the first time.
+    """
+    db = get_db()
+    with db:
+        db.executescript(SCHEMA)
+
+    scan_existing_files(db)
+
+    with db:
+        migrated = db.execute(
+            "SELECT value FROM meta WHERE key = 'shared_pages_json'"
+        ).fetchone()
+        if migrated or not os.path.exists(SHARED_PAGES_JSON):
+            return
+
+        with open(SHARED_PAGES_JSON, "r") as f:
+            data = json.load(f)
+        now = time.time()
+        for public_id, info in data.items():
+            db.execute(
+                "INSERT OR IGNORE INTO shared_pages VALUES (?, ?, ?)",
+                (public_id, info["user_id"], now),
+            )
+            db.executemany(
+                "INSERT OR IGNORE INTO shared_hips VALUES (?, ?, ?)",
+                [(public_id, i, name)
+                 for i, name in enumerate(info.get("hips", []))],
+            )
+        db.execute(
+            "INSERT INTO meta VALUES ('shared_pages_json', ?)", (str(now),)
+        )
+    print(f"🆗 {len(data)} shared pages imported from {SHARED_PAGES_JSON}")
+
+
+def _list_dirs(folder):
+    if not os.path.isdir(folder):
+        return []
+    return [d for d in os.listdir(folder)
+            if os.path.isdir(os.path.join(folder, d))]
+
+
+def scan_existing_files(db):
+    """
+    Register, once, the uploads, HiPS and catalogs already on disk when the
+    registry is created. Afterwards the registry is updated each time a
+    file is written or deleted, and the folders are never listed again.
+
+    Args:
+        db (sqlite3.Connection): Connection to the metadata store.
+    """
+    with db:
+        if db.execute(
+            "SELECT value FROM meta WHERE key = 'registry_scan'"
+        ).fetchone():
+            return
+
+        now = time.time()
+        upload_root = app.config['UPLOAD_FOLDER']
+        for user_id in _list_dirs(upload_root):
+            folder = os.path.join(upload_root, user_id)
+            for name in os.listdir(folder):
+                if allowed_file(name):
+                    db.execute(
+                        "INSERT OR IGNORE INTO uploads "
+                        "VALUES (?, ?, ?, NULL, NULL, ?, ?)",
+                        (user_id, name,
+                         os.path.getsize(os.path.join(folder, name)),
+                         now, now),
+                    )
+
+        for user_id in _list_dirs("hips"):
+            for name in _list_dirs(os.path.join("hips", user_id)):
+                properties = os.path.join("hips", user_id, name, "properties")
+                status = "complete" if os.path.exists(properties) else "error"
+                db.execute(
+                    "INSERT OR IGNORE INTO hips VALUES (?, ?, ?, ?, ?, ?)",
+                    (f"{user_id}/{name}", user_id, name, status, now, now),
+                )
+
+        for user_id in _list_dirs("user_catalogs"):
+            for name in _list_dirs(os.path.join("user_catalogs", user_id)):
+                db.execute(
+                    "INSERT OR IGNORE INTO catalogs "
+                    "VALUES (?, ?, NULL, NULL, NULL, ?)",
+                    (user_id, name, now),
+                )
+
+        db.execute("INSERT INTO meta VALUES ('registry_scan', ?)",
+                   (str(now),))
+
+
+def get_user_uploads(user_id):
+    """
+    Args:
+        user_id (str): Unique identifier for the user.
+
+    Returns:
+        list: `filename`, `hips_id` and `fileweight` (MB) of each upload of
+        the user, oldest first.
+    """
+    return [
+        {
+            "filename": row["filename"],
+            "hips_id": row["hips_id"],
+            "fileweight": round(row["size"] / (1024 * 1024), 2),
+        }
+        for row in get_db().execute(
+            "SELECT filename, hips_id, size FROM uploads "
+            "WHERE user_id = ? ORDER BY created, filename",
+            (user_id,),
+        )
+    ]
+
+
+def get_user_hips(user_id, status=None):
+    """
+    Args:
+        user_id (str): Unique identifier for the user.
+        status (str): Only return the HiPS with this status.
+
+    Returns:
+        list: Names of the HiPS of the user, oldest first. The HiPS whose
+        generation was cancelled or failed are only listed when a
+        previous version of the HiPS is still on disk.
+    """
+    query = "SELECT name, status FROM hips WHERE user_id = ?"
+    params = [user_id]
+    if status:
+        query += " AND status = ?"
+        params.append(status)
+    return [
+        row["name"] for row in get_db().execute(
+            query + " ORDER BY created, name", params)
+        if row["status"] not in ("cancelled", "error") or os.path.exists(
+            os.path.join("hips", user_id, row["name"], "properties"))
+    ]
+
+
+def get_user_catalogs(user_id):
+    """
+    Args:
+        user_id (str): Unique identifier for the user.
+
+    Returns:
+        list: Names of the catalogs of the user, oldest first.
+    """
+    return [row["name"] for row in get_db().execute(
+        "SELECT name FROM catalogs WHERE user_id = ? ORDER BY created, name",
+        (user_id,),
+    )]
+
+
+def like_pattern(query):
+    """
+    Return the SQL LIKE pattern (with '\\' as escape character) matching
+    the names that contain `query`.
+    """
+    escaped = (query.replace("\\", "\\\\").replace("%", "\\%")
+               .replace("_", "\\_"))
+    return f"%{escaped}%"
+
+
+def get_shared_page(public_id):
+    """
+    Args:
+        public_id (str): Public identifier of the shared page.
+
+    Returns:
+        dict: `user_id` and `hips` list of the shared page, or None.
+    """
+    db = get_db()
+    row = db.execute(
+        "SELECT user_id FROM shared_pages WHERE public_id = ?", (public_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    hips = [r["name"] for r in db.execute(
+        "SELECT name FROM shared_hips WHERE public_id = ? ORDER BY position",
+        (public_id,),
+    )]
+    return {"user_id": row["user_id"], "hips": hips}
+
+
+def get_user_shared_pages(user_id):
+    """
+    Args:
+        user_id (str): Unique identifier for the user.
+
+    Returns:
+        dict: `hips` list of each shared page of the user, by public id.
+    """
+    pages = {}
+    for row in get_db().execute(
+        "SELECT p.public_id, h.name FROM shared_pages p "
+        "LEFT JOIN shared_hips h ON h.public_id = p.public_id "
+        "WHERE p.user_id = ? ORDER BY p.created, h.position",
+        (user_id,),
+    ):
+        hips = pages.setdefault(row["public_id"], [])
+        if row["name"] is not None:
+            hips.append(row["name"])
+    return pages
+
+
+def record_hips(hips_id, status):
+    """
+    Record the status of a HiPS of a user in the metadata store.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS (`user_id/name`).
+        status (str): New status of the HiPS.
+    """
+    user_id, name = hips_id.split("/", 1)
+    now = time.time()
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT INTO hips VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (hips_id) DO UPDATE "
+            "SET status = excluded.status, updated = excluded.updated",
+            (hips_id, user_id, name, status, now, now),
+        )
+    publish_progress()
+
+
+def record_hips_inputs(hips_id, fits_paths):
+    """
+    Record the input files of a finished HiPS, so that files added later
+    to the project can be processed alone.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS.
+        fits_paths (list): Paths to the input FITS files.
+    """
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM hips_inputs WHERE hips_id = ?", (hips_id,))
+        db.executemany(
+            "INSERT OR REPLACE INTO hips_inputs VALUES (?, ?, ?)",
+            [(hips_id, os.path.basename(p), file_digest(p))
+             for p in fits_paths],
+        )
+
+
+def get_hips_inputs(hips_id):
+    """
+    Returns:
+        dict: sha256 of each input file name of a finished HiPS.
+    """
+    return {
+        row["filename"]: row["sha256"] for row in get_db().execute(
+            "SELECT filename, sha256 FROM hips_inputs WHERE hips_id = ?",
+            (hips_id,))
+    }
+
+
+def record_resources(hips_id, step, profile, usage):
+    """
+    Record the resources used by a Hipsgen command of a job, to tune the
+    execution profiles.
+
+    Args:
+        hips_id (str): Unique identifier for the task.
+        step (str): Hipsgen actions of the command.
+        profile (dict): Execution profile of the command.
+        usage (dict): Resource usage returned when running the command.
+    """
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT INTO job_resources "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (hips_id, step, profile['name'], profile['input_bytes'],
+             profile['memory'], profile['threads'], usage['wall_s'],
+             usage['cpu_s'], usage['max_rss_bytes'], usage['returncode'],
+             time.time()),
+        )
+
+
+db_ready = False
+db_ready_lock = Lock()
+
+
+@app.before_request
+def open_metadata_store():
+    """Create the metadata store, if needed, before the first request."""
+    global db_ready
+    with db_ready_lock:
+        if not db_ready:
+            init_db()
+            db_ready = True
+
+
+def input_fits_files(input_path):
+    """
+    Returns:
+        list: Paths of the FITS files of a Hipsgen input (file or folder).
+    """
+    if not os.path.isdir(input_path):
+        return [input_path]
+    return [
+        os.path.join(dirpath, name)
+        for dirpath, _, filenames in os.walk(input_path)
+        for name in filenames
+        if name.lower().endswith(('.fits', '.fit', '.fz'))
+    ]
+
+
+def fits_input_bytes(input_path):
+    """
+    Size of the image data of a Hipsgen input, read from the FITS headers.
+
+    Args:
+        input_path (str): Input FITS file or folder of FITS files.
+
+    Returns:
+        int: Bytes of image data. The file size is used for the files
+        whose header cannot be read.
+    """
+    total = 0
+    for path in input_fits_files(input_path):
+        try:
+            header = _read_image_header(path)
+            nbytes = abs(header['BITPIX']) // 8
+            for axis in range(1, header['NAXIS'] + 1):
+                nbytes *= header.get(f'NAXIS{axis}', 1)
+        except Exception:
+            nbytes = os.path.getsize(path)
+        total += nbytes
+    return total
+
+
+def available_memory():
+    """
+    Memory that can be used without swapping: MemAvailable of
+    /proc/meminfo, which counts the reclaimable page cache, or the free
+    memory where it is not known.
+
+    Returns:
+        int: Available memory (bytes), None if it is not known.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def hipsgen_profile(input_bytes):
+    """
+    Pick the execution profile of the Hipsgen commands of a job from the
+    size of its input and the resources of the host.
+
+    Args:
+        input_bytes (int): Bytes of image data of the input.
+
+    Returns:
+        dict: `name`, `input_bytes`, JVM heap `memory` (bytes), Hipsgen
+        `threads` and JVM `tmp_dir` of the profile.
+    """
+    profiles = app.config['HIPSGEN_PROFILES']
+    profile = next(
+        (p for p in profiles
+         if p['max_input'] is None or input_bytes <= p['max_input']),
+        profiles[-1],
+    )
+
+    cpus = os.cpu_count() or 1
+    memory = profile['memory']
+    available = available_memory()
+    if available is not None:
+        memory = min(memory, max(available * 3 // 4, 512 * 1024 * 1024))
+
+    return {
+        'name': profile['name'],
+        'input_bytes': input_bytes,
+        'memory': memory,
+        'threads': min(profile['threads'] or cpus, cpus),
+        'tmp_dir': (profile['tmp_dir'] or app.config['HIPSGEN_TMP_FOLDER']
+                    or tempfile.gettempdir()),
+    }
+
+
+def hipsgen_command(profile, *params):
+    """
+    Build a Hipsgen command line running with an execution profile.
+
+    Args:
+        profile (dict): Execution profile, None for the JVM defaults.
+        params (str): Hipsgen parameters and actions.
+
+    Returns:
+        list: Hipsgen command line.
+    """
+    if profile is None:
+        return ["java", "-jar", "tools/Hipsgen.jar", *params]
+    return [
+        "java",
+        f"-Xmx{profile['memory'] // (1024 * 1024)}m",
+        f"-Djava.io.tmpdir={profile['tmp_dir']}",
+        "-jar", "tools/Hipsgen.jar",
+        *params,
+        f"maxThread={profile['threads']}",
+    ]
+
+
+def generate_fits_index(output_folder, fits_file, profile=None,
+                        hips_id=None, params=()):
+    """
+    Generate the FITS index for the input file
+    and save it in the output folder,
+    using a Java command line.
+
+    Args:
+        output_folder (str): Path to the output folder.
+        fits_file (str): Path to the input FITS file.
+        profile (dict): Execution profile of the command.
+        hips_id (str): Task whose resource usage is recorded.
+        params (tuple): Additional Hipsgen parameters.
+
+    Returns:
+        bool: True if the index was generated successfully, False otherwise.
+    """
+    cmd = hipsgen_command(
+        profile,
+        f"in={fits_file}",
+        f"out={output_folder}",
+        "creator_did=test/P/HTTP/F658N",
+        *params,
+        "INDEX",
+    )
+    print("🆗 running command:", ' '.join(cmd))
+
+    returncode, output, usage = run_hipsgen(cmd)
+    if hips_id and profile:
+        record_resources(hips_id, "INDEX", profile, usage)
+    if returncode != 0:
+        print("❌ error generating fits index", output)
+        return False
+    return True
+
+
+def get_tiles_cmd(input_folder, output_folder, profile=None):
+    """
+    Generate the command to create the FITS tiles and their PNG previews.
+
+    Both actions run in the same Hipsgen invocation: the PNG action builds
+    its tiles from the FITS tiles just written, so the input files are
+    only read once and the JVM is only started once.
+
+    Args:
+        input_folder (str): Path to the input FITS file or folder.
+        output_folder (str): Path to the output HiPS folder.
+        profile (dict): Execution profile of the command.
+
+    Returns:
+        list: Hipsgen command line.
+    """
+    return hipsgen_command(
+        profile,
+        f"in={input_folder}",
+        f"out={output_folder}",
+        "creator_did=test/P/HTTP/F658N",
+        "pixelCut=0 5 log",
+        "TILES",
+        "PNG"
+    )
+
+
+class TileCounter:
+    """
+    Running count of the tiles written under a HiPS output folder.
+
+    Each directory listing is cached together with the directory mtime,
+    so a call to `count` only lists again the directories where Hipsgen
+    wrote something since the previous call, instead of walking the whole
+    tree. Directories modified during the last `HOT_DELAY` seconds are
+    always listed again, since the mtime resolution of the filesystem may
+    hide a write that happened just after the previous listing.
+    """
+
+    HOT_DELAY = 2 * 10**9  # ns
+
+    def __init__(self, root_dir, extensions):
+        self.root_dir = root_dir
+        self.extensions = tuple(extensions)
+        self._listings = {}
+
+    def count(self):
+        """
+        Returns:
+            int: Number of files with one of the counter extensions.
+        """
+        return self._count_dir(self.root_dir, time.time_ns())
+
+    def _count_dir(self, path, now):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+        cached = self._listings.get(path)
+        if (cached is None or cached[0] != mtime or
+                now - mtime < self.HOT_DELAY):
+            nb_files = 0
+            subdirs = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(self.extensions):
+                        nb_files += 1
+            cached = (mtime, nb_files, subdirs)
+            self._listings[path] = cached
+
+        return cached[1] + sum(self._count_dir(d, now) for d in cached[2])
+
+
+def _drain_output(stream, log):
+    """
+    Read the output of a process line by line into a bounded buffer, so
+    that the process never blocks on a full pipe.
+
+    Args:
+        stream (file): Output stream of the process.
+        log (collections.deque): Buffer keeping the last lines.
+    """
+    for line in iter(stream.readline, b''):
+        log.append(line.decode(errors='replace').rstrip())
+    stream.close()
+
+
+class HipsgenDaemonRun:
+    """
+    A Hipsgen command running in the Hipsgen daemon, with the subset of
+    the `subprocess.Popen` interface used to follow a Hipsgen process.
+
+    `lost` is set when the daemon went away before the end of the
+    command, which should then be run again with the CLI.
+    """
+
+    EXIT = b'@@EXIT '
+    # The daemon waits 30 s for the threads of a cancelled command.
+    STOP_TIMEOUT_S = 60
+
+    def __init__(self, sock, stream, client=None):
+        self._sock = sock
+        self._stream = stream
+        self._client = client
+        self._done = Event()
+        self._cancelled = False
+        self.stdout = self
+        self.returncode = None
+        self.lost = False
+
+    def readline(self):
+        """Return the next output line, b'' at the end of the command."""
+        if self._done.is_set():
+            return b''
+        try:
+            line = self._stream.readline()
+        except OSError:
+            line = b''
+        if line.startswith(self.EXIT):
+            self._finish(int(line[len(self.EXIT):]))
+            return b''
+        if not line:
+            self.lost = self.returncode is None and not self._cancelled
+            self._finish(-1)
+        return line
+
+    def _finish(self, returncode):
+        if self.returncode is None:
+            self.returncode = returncode
+        self._done.set()
+
+    def close(self):
+        self._stream.close()
+        self._sock.close()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        """
+        Wait for the end of the command. A cancelled command that the
+        daemon does not stop in time is stopped by killing the daemon.
+        """
+        if self._cancelled and not self._done.wait(self.STOP_TIMEOUT_S):
+            print("❌ Hipsgen daemon did not stop a cancelled command")
+            if self._client is not None:
+                self._client.kill()
+            if not self._done.wait(self.STOP_TIMEOUT_S):
+                self._finish(-9)
+        self._done.wait()
+        return self.returncode
+
+    def terminate(self):
+        """
+        Cancel the command by closing the sending side of the connection.
+        The daemon aborts the command and still sends its exit code once
+        all its threads ended, so `wait` returns when it really stopped.
+        """
+        self._cancelled = True
+        try:
+            self._sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            self._finish(-15)
+
+
+class HipsgenDaemonClient:
+    """
+    Client of the Hipsgen daemon (tools/HipsgenDaemon.java), a JVM kept
+    running between jobs so that Hipsgen commands do not pay the JVM
+    startup and warmup.
+
+    The daemon is started on first use and runs one command at a time:
+    `start` returns None when it is not ready or busy, and the caller
+    falls back to the CLI.
+    """
+
+    def __init__(self, socket_path, memory):
+        self.socket_path = os.path.abspath(socket_path)
+        self.memory = memory
+        self._proc = None
+        self._lock = Lock()
+
+    def _spawn(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                return
+            try:
+                self._proc = subprocess.Popen(
+                    ["java", f"-Xmx{self.memory // (1024 * 1024)}m",
+                     os.path.join("tools", "HipsgenDaemon.java"),
+                     self.socket_path],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+            except OSError as e:
+                print("❌ Hipsgen daemon not started:", e)
+
+    def kill(self):
+        """Kill the daemon, it is started again by the next command."""
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                return
+            try:
+                os.killpg(self._proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self._proc.wait()
+
+    def start(self, command):
+        """
+        Start a `java -jar <jar> <args>` command in the daemon. The JVM
+        options of the command are ignored, and commands asking for a
+        larger heap than the daemon's run with the CLI.
+
+        Returns:
+            HipsgenDaemonRun: The running command, None if the daemon is
+            not available.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            self._spawn()
+            return None
+
+        options, jar, params = split_java_command(command)
+        heap = next((int(o[4:-1]) * 1024 * 1024 for o in options
+                     if o.startswith('-Xmx') and o.endswith('m')), 0)
+        if heap > self.memory:
+            return None
+
+        request = [os.path.abspath(jar), *params, '', '']
+        stream = sock.makefile('rb')
+        try:
+            sock.sendall('\n'.join(request).encode())
+            if stream.readline() == b'OK\n':
+                return HipsgenDaemonRun(sock, stream, self)
+        except OSError:
+            pass
+        stream.close()
+        sock.close()
+        return None
+
+
+def split_java_command(command):
+    """
+    Returns:
+        tuple: (JVM options, jar, arguments) of a `java ... -jar` command.
+    """
+    i = command.index('-jar')
+    return command[1:i], command[i + 1], command[i + 2:]
+
+
+def popen_hipsgen(command):
+    """
+    Start a Hipsgen command, in the Hipsgen daemon when it is enabled and
+    idle, as a new java process otherwise.
+
+    Returns:
+        subprocess.Popen or HipsgenDaemonRun: The running command, its
+        output (stdout and stderr) is read from `stdout`.
+    """
+    if hipsgen_daemon is not None and command[0] == "java":
+        proc = hipsgen_daemon.start(command)
+        if proc is not None:
+            return proc
+    return subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def _reap(proc, block=False):
+    """
+    Return the exit code of a Hipsgen command, None while it runs. The
+    resource usage of a java process is kept in `proc.rusage`.
+    """
+    if isinstance(proc, subprocess.Popen) and proc.returncode is None:
+        pid, status, rusage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            proc.rusage = rusage
+    elif block:
+        proc.wait()
+    return proc.poll()
+
+
+def _usage(proc, start):
+    """
+    Returns:
+        dict: Wall time, CPU time (s) and peak memory (bytes) of a
+        finished Hipsgen command, and its exit code. CPU time and memory
+        are None for the commands run by the daemon.
+    """
+    rusage = getattr(proc, 'rusage', None)
+    return {
+        'wall_s': round(time.monotonic() - start, 3),
+        'cpu_s': (round(rusage.ru_utime + rusage.ru_stime, 3)
+                  if rusage else None),
+        'max_rss_bytes': rusage.ru_maxrss * 1024 if rusage else None,
+        'returncode': proc.returncode,
+    }
+
+
+def run_hipsgen(command):
+    """
+    Run a Hipsgen command to completion.
+
+    Returns:
+        tuple: (returncode, output, usage) of the command, `usage` as
+        returned by `_usage`.
+    """
+    log = deque(maxlen=app.config['HIPSGEN_LOG_LINES'])
+    start = time.monotonic()
+    proc = popen_hipsgen(command)
+    _drain_output(proc.stdout, log)
+    _reap(proc, block=True)
+    if getattr(proc, 'lost', False):
+        log.clear()
+        start = time.monotonic()
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        _drain_output(proc.stdout, log)
+        _reap(proc, block=True)
+    return proc.returncode, '\n'.join(log), _usage(proc, start)
+
+
+def _wait_hipsgen(proc, hips_id, report, log, stop=None):
+    """
+    Follow a running Hipsgen command until it ends, the job is cancelled
+    or `stop` is set.
+
+    Raises:
+        JobCancelled: If the job was cancelled or `stop` set.
+    """
+    reader = Thread(target=_drain_output, args=(proc.stdout, log),
+                    daemon=True)
+    reader.start()
+
+    while _reap(proc) is None:
+        if ((stop is not None and stop.is_set()) or
+                hips_scheduler.is_cancelled(hips_id)):
+            proc.terminate()
+            proc.wait()
+            raise JobCancelled(hips_id)
+        report()
+        time.sleep(0.5)
+
+    reader.join()
+
+
+def run_with_progress(command, hips_id, report, profile=None, step=None,
+                      stop=None):
+    """
+    Run a Hipsgen command as part of a job.
+
+    The output of the command is kept in a bounded log buffer stored in
+    the task, `report` is called every 0.5 s while the command runs, and
+    the command is terminated when the job is cancelled. The command runs
+    in the Hipsgen daemon when possible, and again as a new java process
+    if the daemon went away during the command.
+
+    Args:
+        command (list): Command to execute.
+        hips_id (str): Unique identifier for the task.
+        report (callable): Function updating the progress of the task.
+        profile (dict): Execution profile of the command, its resource
+            usage is recorded under `step` when given.
+        step (str): Name of the step in the recorded resource usage.
+        stop (Event): Terminates the command when set, as a cancel.
+
+    Returns:
+        dict: Resource usage of the command, as returned by `_usage`.
+
+    Raises:
+        JobCancelled: If the job was cancelled or `stop` set.
+        Exception: If the command failed, with its last output lines.
+    """
+    log = deque(maxlen=app.config['HIPSGEN_LOG_LINES'])
+    with progress_lock:
+        task_queue[hips_id]['log'] = log
+
+    start = time.monotonic()
+    proc = popen_hipsgen(command)
+    _wait_hipsgen(proc, hips_id, report, log, stop)
+    if getattr(proc, 'lost', False):
+        print("❌ Hipsgen daemon lost, running the command again")
+        log.clear()
+        start = time.monotonic()
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        _wait_hipsgen(proc, hips_id, report, log, stop)
+
+    usage = _usage(proc, start)
+    if profile:
+        record_resources(hips_id, step, profile, usage)
+
+    if proc.returncode != 0:
+        err = '\n'.join(log)
+        jar = split_java_command(command)[1]
+        raise Exception(f"{os.path.basename(jar)} failed: {err}")
+    return usage
+
+
+def generate_tiles_with_progress(command, output_folder,
+                                 total_tiles, start_pct,
+                                 span_pct, hips_id, profile=None):
+    """
+    Generate tiles with progress tracking.
+
+    The tile rate (tiles/s) and the remaining time of the step (s) are
+    reported next to the progress percentage.
+
+    Args:
+        command (list): Command to execute for tile generation.
+        output_folder (str): Path to the output folder.
+        total_tiles (int): Number of tiles to generate for each action
+            (TILES, PNG) of the command.
+        start_pct (int): Starting percentage for progress.
+        span_pct (int): Percentage span for progress.
+        hips_id (str): Unique identifier for the HIPS task.
+        profile (dict): Execution profile of the command, its resource
+            usage is recorded.
+    """
+    exts = [ext for action, ext in (('TILES', '.fits'), ('PNG', '.png'))
+            if action in command]
+    total_tiles *= len(exts)
+
+    counter = TileCounter(output_folder, exts)
+    start_count = counter.count()
+    start_time = time.time()
+
+    def report():
+        count = counter.count()
+        frac = min(count / total_tiles, 1.0)
+        pct = start_pct + int(frac * span_pct)
+
+        rate = (count - start_count) / max(time.time() - start_time, 1e-3)
+        eta = None
+        if rate > 0:
+            eta = round(max(total_tiles - count, 0) / rate)
+
+        with progress_lock:
+            task_queue[hips_id]['progress'] = pct
+            task_queue[hips_id]['tiles_per_s'] = round(rate, 1)
+            task_queue[hips_id]['eta'] = eta
+        publish_progress()
+
+    try:
+        step = ' '.join(arg for arg in command if arg.isupper())
+        run_with_progress(command, hips_id, report, profile, step)
+    finally:
+        with progress_lock:
+            task_queue[hips_id]['progress'] = start_pct + span_pct
+            task_queue[hips_id]['eta'] = None
+
+
+def partition_moc(moc, nb_regions):
+    """
+    Split a HiPS coverage into sky regions holding about the same number
+    of deepest order tiles.
+
+    Regions are unions of HEALPix cells of a partition order, contiguous
+    in the NESTED ordering so that each region stays compact on the sky.
+    The partition order is the lowest one (from 3) giving at least four
+    cells per region, so that the tiles of this order and deeper belong
+    to a single region. As in `count_moc_tiles`, the deepest tiles of
+    each cell are counted on the MOC ranges, without listing them.
+
+    Args:
+        moc (MOC): Coverage of the HiPS.
+        nb_regions (int): Wanted number of regions.
+
+    Returns:
+        tuple: (partition order, list of arrays of cells of this order),
+        without empty regions.
+    """
+    max_order = moc.max_order
+    order = min(3, max_order)
+    cells = moc_cells(moc, order)
+    while order < max_order and len(cells) < 4 * nb_regions:
+        order += 1
+        cells = moc_cells(moc, order)
+
+    # deepest tiles before each position of the NESTED ordering
+    shift = np.uint64(2 * (29 - max_order))
+    ranges = moc.to_depth29_ranges
+    lo = (ranges[:, 0] >> shift).astype(np.int64)
+    hi = (ranges[:, 1] >> shift).astype(np.int64)
+    before = np.cumsum(hi - lo) - (hi - lo)
+
+    def tiles_before(npix):
+        i = np.maximum(np.searchsorted(lo, npix, side='right') - 1, 0)
+        return np.where(npix > lo[i],
+                        before[i] + np.minimum(npix, hi[i]) - lo[i],
+                        before[i])
+
+    depth = 2 * (max_order - order)
+    counts = tiles_before((cells + 1) << depth) - tiles_before(cells << depth)
+
+    centers = np.cumsum(counts) - counts / 2
+    region = np.minimum(
+        (centers * nb_regions / counts.sum()).astype(np.int64),
+        nb_regions - 1,
+    )
+    return order, [cells[region == i] for i in range(nb_regions)
+                   if np.any(region == i)]
+
+
+def check_partition_hosts():
+    """
+    Check the configuration of the remote region builds: the hosts reach
+    the application folder at HIPSGEN_PARTITION_SHARED_ROOT, so every
+    file of a build must be inside this folder.
+
+    Raises:
+        RuntimeError: If the configuration cannot work.
+    """
+    if not app.config['HIPSGEN_PARTITION_HOSTS']:
+        return
+    root = app.config['HIPSGEN_PARTITION_SHARED_ROOT']
+    if not root or not os.path.isabs(root):
+        raise RuntimeError("HIPSGEN_PARTITION_HOSTS needs an absolute "
+                           "HIPSGEN_PARTITION_SHARED_ROOT")
+    base = os.path.realpath(os.getcwd())
+    for folder in ('hips', app.config['UPLOAD_FOLDER'],
+                   app.config['BLOB_FOLDER'], 'tools'):
+        path = os.path.realpath(folder)
+        if os.path.commonpath([base, path]) != base:
+            raise RuntimeError(f"{folder} is outside of the application "
+                               "folder, remote region builds cannot read it")
+
+
+def _shared_path(path):
+    """Path of a file of the application folder on the partition hosts."""
+    return os.path.relpath(os.path.realpath(path),
+                           os.path.realpath(os.getcwd()))
+
+
+def _remote_command(host, command):
+    """
+    Return `command` run over ssh on `host`, from the shared application
+    folder. A terminal is requested so that the remote command is hung up
+    when the ssh client is terminated.
+    """
+    remote = ' '.join(shlex.quote(arg) for arg in command)
+    root = shlex.quote(app.config['HIPSGEN_PARTITION_SHARED_ROOT'])
+    return ["ssh", "-tt", host, f"cd {root} && exec {remote}"]
+
+
+def _shared_inputs(input_path, input_dir):
+    """
+    Create an input folder readable from the partition hosts: relative
+    symlinks, inside the application folder, to the input files.
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    for name in os.listdir(input_path):
+        link = os.path.join(input_dir, name)
+        if not os.path.lexists(link):
+            os.symlink(os.path.relpath(
+                os.path.realpath(os.path.join(input_path, name)),
+                os.path.realpath(input_dir)), link)
+
+
+def _merge_region(region_dir, hips_output_dir, order, cells):
+    """
+    Move the tiles of a region build to the HiPS folder, keeping only the
+    tiles of `order` and deeper which lie inside the region cells.
+    """
+    cells = set(int(c) for c in cells)
+    for name in os.listdir(region_dir):
+        if not name.startswith("Norder"):
+            continue
+        tile_order = int(name[len("Norder"):])
+        if tile_order < order:
+            continue
+        shift = 2 * (tile_order - order)
+        for dirpath, _, filenames in os.walk(os.path.join(region_dir, name)):
+            dest_dir = os.path.join(
+                hips_output_dir, os.path.relpath(dirpath, region_dir))
+            for filename in filenames:
+                npix = os.path.splitext(filename)[0][len("Npix"):]
+                if not npix.isdigit() or int(npix) >> shift not in cells:
+                    continue
+                os.makedirs(dest_dir, exist_ok=True)
+                os.replace(os.path.join(dirpath, filename),
+                           os.path.join(dest_dir, filename))
+
+
+def generate_preview(hips_id, input_path, hips_output_dir, profile,
+                     max_order):
+    """
+    Publish the low orders of a HiPS before its deeper orders.
+
+    Hipsgen builds a HiPS from its deepest order up, so the Allsky and the
+    low orders only appear at the end of a run. A first run limited to
+    `HIPS_PREVIEW_ORDER` writes them quickly, and the properties then
+    announce the final order: Aladin Lite asks for the deeper tiles as the
+    main run writes them, and shows the low order tiles meanwhile.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS task.
+        input_path (str): Input FITS file or folder given to Hipsgen.
+        hips_output_dir (str): Path to the HiPS folder.
+        profile (dict): Execution profile of the job.
+        max_order (int): Deepest order of the finished HiPS.
+    """
+    cmd = hipsgen_command(
+        profile,
+        f"in={input_path}",
+        f"out={hips_output_dir}",
+        "creator_did=test/P/HTTP/F658N",
+        "pixelCut=0 5 log",
+        f"order={app.config['HIPS_PREVIEW_ORDER']}",
+        "TILES",
+        "PNG",
+    )
+    run_with_progress(cmd, hips_id, lambda: None, profile,
+                      "preview TILES PNG")
+    update_properties(os.path.join(hips_output_dir, "properties"),
+                      {"hips_order": max_order})
+
+    with progress_lock:
+        task_queue[hips_id]["previewable"] = True
+    record_hips(hips_id, "previewable")
+
+
+def generate_partitioned_tiles(hips_id, input_path, hips_output_dir, moc,
+                               total_tiles, profile, start_pct=2,
+                               resume=False):
+    """
+    Generate the tiles of a HiPS as sky regions built in parallel.
+
+    The coverage found by the INDEX step is split with `partition_moc`,
+    and each region is tiled by its own Hipsgen TILES run (`region=`) in a
+    separate folder, locally or on the `HIPSGEN_PARTITION_HOSTS`. The
+    tiles of the partition order and deeper are then moved to the HiPS
+    folder, and a last Hipsgen run rebuilds the lower orders (TREE), the
+    Allsky files and the PNG tiles once for the whole HiPS.
+
+    When resumed, the region folders left on disk are completed
+    (`mode=keeptile`), and the regions are skipped altogether when they
+    were already merged.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS task.
+        input_path (str): Input folder given to Hipsgen.
+        hips_output_dir (str): Path to the HiPS folder, holding the index.
+        moc (MOC): Coverage of the HiPS, from the index.
+        total_tiles (int): Number of tiles of the HiPS.
+        profile (dict): Execution profile of the job.
+        start_pct (int): Progress of the job when the tiling starts.
+        resume (bool): Complete the tiles left by an interrupted run.
+
+    Raises:
+        JobCancelled: If the job was cancelled.
+        Exception: If a Hipsgen run failed.
+    """
+    order, regions = partition_moc(moc, app.config['HIPSGEN_PARTITIONS'])
+    print(f"🆗 {hips_id}: {len(regions)} regions at order {order}")
+
+    regions_dir = os.path.join(hips_output_dir, "regions")
+    merged = (resume and not os.path.isdir(regions_dir) and
+              os.path.isdir(os.path.join(hips_output_dir, f"Norder{order}")))
+    if not merged:
+        _generate_regions(hips_id, input_path, hips_output_dir, regions_dir,
+                          order, regions, total_tiles, profile, start_pct,
+                          resume)
+
+    cmd_tree = hipsgen_command(
+        profile,
+        f"in={input_path}",
+        f"out={hips_output_dir}",
+        "creator_did=test/P/HTTP/F658N",
+        "pixelCut=0 5 log",
+        "mode=replacetile",
+        "TREE",
+        "ALLSKY",
+        "PNG",
+    )
+    generate_tiles_with_progress(
+        cmd_tree,
+        hips_output_dir,
+        total_tiles,
+        start_pct=82,
+        span_pct=17,
+        hips_id=hips_id,
+        profile=profile,
+    )
+
+
+def _generate_regions(hips_id, input_path, hips_output_dir, regions_dir,
+                      order, regions, total_tiles, profile, start_pct,
+                      resume):
+    """
+    Tile each region of `generate_partitioned_tiles` in its own folder,
+    then merge the tiles into the HiPS folder. When a region build fails,
+    the others are terminated.
+
+    On the partition hosts, the paths are relative to the shared
+    application folder, and the input folder (a temporary folder of this
+    host) is replaced by one inside the regions folder.
+    """
+    hosts = app.config['HIPSGEN_PARTITION_HOSTS']
+    region_profile = dict(profile)
+    if hosts:
+        path = _shared_path
+        input_dir = os.path.join(regions_dir, "input")
+        _shared_inputs(input_path, input_dir)
+    else:
+        path = str
+        input_dir = input_path
+        region_profile['memory'] = max(profile['memory'] // len(regions),
+                                       512 * 1024 * 1024)
+        region_profile['threads'] = max(profile['threads'] // len(regions),
+                                        1)
+
+    region_dirs = []
+    commands = []
+    for i, cells in enumerate(regions):
+        region_dir = os.path.join(regions_dir, str(i))
+        os.makedirs(region_dir, exist_ok=resume)
+        # the index is only read by TILES, the properties are rewritten
+        if not os.path.isdir(os.path.join(region_dir, "HpxFinder")):
+            link_tree(os.path.join(hips_output_dir, "HpxFinder"),
+                      os.path.join(region_dir, "HpxFinder"))
+        if os.path.exists(os.path.join(hips_output_dir, "properties")):
+            shutil.copy2(os.path.join(hips_output_dir, "properties"),
+                         region_dir)
+        region_moc = os.path.join(regions_dir, f"region{i}.fits")
+        MOC.from_healpix_cells(
+            cells, np.full(len(cells), order, dtype=np.uint8), order,
+        ).save(region_moc, format='fits', overwrite=True)
+
+        cmd = hipsgen_command(
+            region_profile,
+            f"in={path(input_dir)}",
+            f"out={path(region_dir)}",
+            "creator_did=test/P/HTTP/F658N",
+            f"region={path(region_moc)}",
+            *(("mode=keeptile",) if resume else ()),
+            "TILES",
+        )
+        if hosts:
+            cmd = _remote_command(hosts[i % len(hosts)], cmd)
+        region_dirs.append(region_dir)
+        commands.append(cmd)
+
+    counters = [TileCounter(d, ('.fits',)) for d in region_dirs]
+    start_count = sum(c.count() for c in counters)
+    start_time = time.time()
+
+    def report():
+        count = sum(c.count() for c in counters)
+        frac = min(count / total_tiles, 1.0)
+        rate = (count - start_count) / max(time.time() - start_time, 1e-3)
+        with progress_lock:
+            task_queue[hips_id]['progress'] = (
+                start_pct + int(frac * (82 - start_pct)))
+            task_queue[hips_id]['tiles_per_s'] = round(rate, 1)
+            task_queue[hips_id]['eta'] = (
+                round(max(total_tiles - count, 0) / rate) if rate else None)
+        publish_progress()
+
+    failed = Event()
+
+    def run_region(i, cmd):
+        try:
+            run_with_progress(cmd, hips_id, report, region_profile,
+                              f"TILES region {i}", stop=failed)
+        except BaseException:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [executor.submit(run_region, i, cmd)
+                   for i, cmd in enumerate(commands)]
+        errors = [f.exception() for f in futures if f.exception()]
+    # the regions stopped because another one failed raise JobCancelled
+    errors.sort(key=lambda e: isinstance(e, JobCancelled))
+    if errors:
+        raise errors[0]
+
+    for region_dir, cells in zip(region_dirs, regions):
+        _merge_region(region_dir, hips_output_dir, order, cells)
+    if os.path.exists(os.path.join(region_dirs[0], "properties")):
+        shutil.copy2(os.path.join(region_dirs[0], "properties"),
+                     hips_output_dir)
+    shutil.rmtree(regions_dir)
+
+
+def count_moc_tiles(moc, max_order=None):
+    """
+    Count the HiPS tiles needed to cover a MOC, for every order from 0 to
+    `max_order`.
+
+    The count works on the MOC ranges: each range of depth 29 cells is
+    degraded to a range of cells of the wanted order, and the union of
+    these ranges is measured, so no cell index is ever materialised.
+
+    Args:
+        moc (MOC): Coverage of the HiPS.
+        max_order (int): Deepest order to count, defaults to the MOC order.
+
+    Returns:
+        int: Total number of tiles.
+    """
+    if max_order is None:
+        max_order = moc.max_order
+
+    ranges = moc.to_depth29_ranges
+    if len(ranges) == 0:
+        return 0
+
+    total = 0
+    for order in range(max_order + 1):
+        shift = np.uint64(2 * (29 - order))
+        lo = ranges[:, 0] >> shift
+        hi = ((ranges[:, 1] - np.uint64(1)) >> shift) + np.uint64(1)
+        # ranges are sorted and disjoint, so after degradation a range can
+        # only overlap the end of the previous one
+        starts = lo.astype(np.int64)
+        starts[1:] = np.maximum(starts[1:], hi[:-1].astype(np.int64))
+        total += int(np.maximum(hi.astype(np.int64) - starts, 0).sum())
+    return total
+
+
+def get_tile_order(resolution, tile_width=512):
+    """
+    Return the deepest HiPS tile order needed to keep the resolution of an
+    image, the way Hipsgen picks it.
+
+    Args:
+        resolution (float): Image resolution (degree/pixel).
+        tile_width (int): Width of a tile in pixels.
+
+    Returns:
+        int: HiPS tile order.
+    """
+    shift_order = int(np.log2(tile_width))
+    for order in range(0, 30 - shift_order):
+        hpx_res = np.degrees(np.sqrt(4 * np.pi / (12 * 4 ** order)))
+        if hpx_res / tile_width <= resolution:
+            return order
+    return 29 - shift_order
+
+
+def _read_image_header(fits_path):
+    """Return the header of the first HDU of a FITS file holding an image."""
+    with fits.open(fits_path, memmap=True) as hdul:
+        for hdu in hdul:
+            if hdu.header.get('NAXIS', 0) >= 2:
+                return hdu.header.copy()
+    raise ValueError(f"no image found in {fits_path}")
+
+
+def estimate_fits_coverage(fits_path, tile_width=512):
+    """
+    Estimate the HiPS coverage of a FITS image from its header only.
+
+    Args:
+        fits_path (str): Path to the FITS file.
+        tile_width (int): Width of a tile in pixels.
+
+    Returns:
+        tuple: (MOC of the image footprint at the HiPS tile order,
+            BITPIX of the image).
+    """
+    header = _read_image_header(fits_path)
+    wcs = WCS(header).celestial
+    order = get_tile_order(min(proj_plane_pixel_scales(wcs)), tile_width)
+    footprint = wcs.calc_footprint()
+    moc = MOC.from_polygon_skycoord(
+        SkyCoord(footprint[:, 0], footprint[:, 1], unit='deg'),
+        max_depth=order,
+    )
+    return moc, header['BITPIX']
+
+
+def estimate_hips_cost(fits_paths):
+    """
+    Dry-run cost estimate of a HiPS generation, computed before the job is
+    queued from the FITS headers of the inputs.
+
+    Args:
+        fits_paths (list): Paths to the input FITS files.
+
+    Returns:
+        dict: Expected number of tiles, disk size (bytes) and runtime (s).
+    """
+    tile_width = app.config['HIPS_TILE_WIDTH']
+    moc = None
+    bytes_per_pixel = 0
+    for path in fits_paths:
+        file_moc, bitpix = estimate_fits_coverage(path, tile_width)
+        moc = file_moc if moc is None else moc.union(file_moc)
+        bytes_per_pixel = max(bytes_per_pixel, abs(bitpix) // 8)
+
+    tiles = count_moc_tiles(moc) if moc is not None else 0
+    fits_tile_bytes = tile_width * tile_width * bytes_per_pixel + 2880
+    disk_bytes = tiles * (fits_tile_bytes + app.config['HIPS_PNG_TILE_BYTES'])
+    # index run, then one run writing the FITS tiles and the PNG tiles
+    runtime = (2 * app.config['HIPSGEN_STARTUP_S'] +
+               2 * tiles / app.config['HIPSGEN_TILES_PER_S'])
+
+    return {
+        'tiles': tiles,
+        'max_order': moc.max_order if moc is not None else None,
+        'disk_bytes': disk_bytes,
+        'runtime_s': round(runtime),
+    }
+
+
+def _gzip_file(path):
+    with open(path, 'rb') as f_in:
+        data = f_in.read()
+    tmp_path = path + '.gz.tmp'
+    with open(tmp_path, 'wb') as f_out:
+        f_out.write(gzip.compress(data, compresslevel=6, mtime=0))
+    os.replace(tmp_path, path + '.gz')
+
+
+def precompress_tiles(hips_output_dir):
+    """
+    Write a gzip compressed sibling of every FITS tile of a HiPS, served
+    by `send_tile` to the clients accepting gzip. PNG tiles are already
+    compressed and are left as is.
+
+    Args:
+        hips_output_dir (str): Path to the HiPS folder.
+    """
+    paths = [
+        os.path.join(dirpath, name)
+        for dirpath, _, filenames in os.walk(hips_output_dir)
+        if os.path.basename(dirpath) != 'HpxFinder'
+        for name in filenames
+        if name.endswith('.fits')
+    ]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_gzip_file, paths))
+
+
+def send_tile(directory, filename, max_age=None, immutable=False):
+    """
+    Send a HiPS file, with HTTP caching.
+
+    The response carries an ETag and a Last-Modified date, so that
+    conditional requests are answered with 304, and supports HTTP Range.
+    When the client accepts it, a precompressed `.br` or `.gz` sibling of
+    the file is sent instead, with the matching Content-Encoding.
+
+    Args:
+        directory (str): Root directory of the files.
+        filename (str): Path to the file within the directory.
+        max_age (int): Cache-Control max-age, None to always revalidate.
+        immutable (bool): Mark the file immutable for the max-age.
+
+    Returns:
+        Response: The requested file as a Flask response.
+    """
+    path = safe_join(directory, filename)
+    if path is None:
+        abort(404)
+
+    encodings = request.accept_encodings
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if encodings[encoding] and os.path.isfile(path + ext):
+            mimetype = (mimetypes.guess_type(filename)[0] or
+                        'application/octet-stream')
+            rv = send_from_directory(
+                directory, filename + ext, mimetype=mimetype,
+                download_name=os.path.basename(filename), max_age=max_age,
+            )
+            rv.headers['Content-Encoding'] = encoding
+            break
+    else:
+        rv = send_from_directory(directory, filename, max_age=max_age)
+
+    rv.vary.add('Accept-Encoding')
+    if immutable and max_age:
+        rv.cache_control.immutable = True
+    return rv
+
+
+class JobCancelled(Exception):
+    """Raised inside a HiPS job when the user cancelled it."""
+
+
+def default_worker_count():
+    """
+    Compute how many Hipsgen jobs may run at the same time on this host.
+
+    Hipsgen is itself multithreaded, so we keep one job for two cores,
+    and never start more jobs than the available memory can hold when
+    they all use the largest execution profile.
+
+    Returns:
+        int: Maximum number of concurrent Hipsgen jobs (at least 1).
+    """
+    if app.config['HIPSGEN_MAX_WORKERS']:
+        return app.config['HIPSGEN_MAX_WORKERS']
+
+    workers = max(1, (os.cpu_count() or 1) // 2)
+    available = available_memory()
+    if available is None:
+        return workers
+    job_memory = max([app.config['HIPSGEN_JOB_MEMORY']] +
+                     [p['memory'] for p in app.config['HIPSGEN_PROFILES']])
+    return max(1, min(workers, available // job_memory))
+
+
+JOB_TARGETS = {}
+
+
+def job_target(resumable=False, on_abort=None, cleanup=None):
+    """
+    Register a function as a kind of job of `HipsJobScheduler`. Jobs are
+    stored with the name of their function and their arguments (JSON), so
+    that any worker process can run them.
+
+    Args:
+        resumable (bool): The function takes a `resume` flag, set when the
+            job is run again after its worker died.
+        on_abort (callable): Called with the job id and the final status
+            ('cancelled' or 'error') when the job ends without being run,
+            or without reaching the end of the function.
+        cleanup (callable): Called with the job arguments once the job
+            ended, whatever its final status.
+    """
+    def register(func):
+        JOB_TARGETS[func.__name__] = (func, resumable, on_abort, cleanup)
+        return func
+    return register
+
+
+class HipsJobScheduler:
+    """
+    Durable queue of the HiPS generation jobs, and the pool of worker
+    threads running them.
+
+    Jobs are stored in the `jobs` table of the metadata store and wait
+    in submission order. A worker claims a job with a lease of
+    `JOB_LEASE_S` seconds, and only when its user is below the per-user
+    limit of running jobs. A heartbeat renews
+    the leases of the jobs of the process and saves a snapshot of their
+    task (progress, ...), so that `/get_progress` can report jobs run by
+    another process. A job whose lease expired, because its worker died,
+    is claimed again and resumed.
+
+    The workers run in the web process (started on the first request), or
+    in separate `python app.py worker` processes.
+    """
+
+    POLL_S = 1.0
+    FINISHED_TTL_S = 10
+    FINISHED_CACHE_SIZE = 10000
+
+    def __init__(self, max_workers, max_jobs_per_user):
+        self.max_workers = max_workers
+        self.max_jobs_per_user = max_jobs_per_user
+        self.owner = None
+        self._cond = Condition()
+        self._running = {}
+        self._cancel_events = {}
+        self._workers = []
+        # hips_id: (time, task) of the finished or unknown jobs
+        self._finished = {}
+
+    def submit(self, hips_id, user_id, target, args, state=None):
+        """
+        Queue a job.
+
+        Args:
+            hips_id (str): Unique identifier for the HiPS task.
+            user_id (str): Owner of the job, used for the per-user limit.
+            target (callable): Function running the job, registered with
+                `job_target`.
+            args (tuple): Arguments given to `target`, JSON serializable.
+            state (dict): Initial values of the task, next to `progress`
+                and `status`.
+
+        Returns:
+            bool: False if a job with the same hips_id is already queued
+            or running, True otherwise.
+        """
+        if target.__name__ not in JOB_TARGETS:
+            raise ValueError(f"{target.__name__} is not a job target")
+
+        task = dict(state or {}, progress=0, status="queued")
+        with progress_lock:
+            task_queue.pop(hips_id, None)
+        self._finished.pop(hips_id, None)
+        now = time.time()
+        db = get_db()
+        try:
+            with db:
+                db.execute(
+                    "INSERT INTO jobs (job_id, user_id, kind, args, status, "
+                    "state, created, updated) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+                    (hips_id, user_id, target.__name__, json.dumps(args),
+                     json.dumps(task), now, now),
+                )
+        except sqlite3.IntegrityError:
+            return False
+
+        with self._cond:
+            self._cond.notify_all()
+        publish_progress()
+        return True
+
+    def cancel(self, hips_id):
+        """
+        Cancel a queued or running job. A job running in another process
+        stops at its next heartbeat.
+
+        Args:
+            hips_id (str): Unique identifier for the HiPS task.
+
+        Returns:
+            bool: True if the job was found, False otherwise.
+        """
+        now = time.time()
+        db = get_db()
+        with db:
+            cur = db.execute(
+                "UPDATE jobs SET status = 'cancelled', state = ?, "
+                "updated = ? WHERE job_id = ? AND status = 'queued' "
+                "RETURNING kind, args",
+                (json.dumps({"progress": 100, "status": "cancelled"}), now,
+                 hips_id),
+            )
+            queued = cur.fetchone()
+            running = queued is None and db.execute(
+                "UPDATE jobs SET status = 'cancelling', updated = ? "
+                "WHERE job_id = ? AND status = 'running'",
+                (now, hips_id),
+            ).rowcount
+        if queued is None and not running:
+            return False
+
+        if queued is not None:
+            _, _, on_abort, cleanup = JOB_TARGETS[queued["kind"]]
+            if on_abort:
+                on_abort(hips_id, "cancelled")
+            if cleanup:
+                cleanup(json.loads(queued["args"]))
+        with self._cond:
+            event = self._cancel_events.get(hips_id)
+        if event is not None:
+            event.set()
+        publish_progress()
+        return True
+
+    def is_active(self, hips_id):
+        """Return True if the job `hips_id` is queued or running."""
+        with self._cond:
+            if hips_id in self._cancel_events:
+                return True
+        return get_db().execute(
+            "SELECT 1 FROM jobs WHERE job_id = ? "
+            "AND status IN ('queued', 'running', 'cancelling')",
+            (hips_id,),
+        ).fetchone() is not None
+
+    def is_cancelled(self, hips_id):
+        """Return True if the running job `hips_id` has been cancelled."""
+        event = self._cancel_events.get(hips_id)
+        return event is not None and event.is_set()
+
+    def position(self, hips_id):
+        """
+        Return the 1-based position of a job in the queue, or None when
+        the job is not waiting.
+        """
+        db = get_db()
+        row = db.execute(
+            "SELECT seq FROM jobs WHERE job_id = ? AND status = 'queued'",
+            (hips_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND seq < ?",
+            (row["seq"],),
+        ).fetchone()[0] + 1
+
+    def active_jobs(self, user_id):
+        """Return the ids of the queued or running jobs of a user."""
+        return [row["job_id"] for row in get_db().execute(
+            "SELECT job_id FROM jobs WHERE user_id = ? "
+            "AND status IN ('queued', 'running', 'cancelling') ORDER BY seq",
+            (user_id,),
+        )]
+
+    def state(self, hips_id):
+        """
+        Return the last snapshot of the task of a job, as stored by the
+        heartbeat of its worker.
+
+        The tasks of finished and unknown jobs are kept in memory for
+        `FINISHED_TTL_S`: every tile of a HiPS served asks for its task.
+        Jobs submitted by this process are read again at once, those
+        submitted by another process after at most this delay.
+
+        Args:
+            hips_id (str): Unique identifier for the HiPS task.
+
+        Returns:
+            dict: Task of the latest job with this id, None if there is
+            none.
+        """
+        cached = self._finished.get(hips_id)
+        if (cached is not None and
+                time.monotonic() - cached[0] < self.FINISHED_TTL_S):
+            return dict(cached[1]) if cached[1] is not None else None
+
+        row = get_db().execute(
+            "SELECT status, state FROM jobs WHERE job_id = ? "
+            "ORDER BY seq DESC LIMIT 1",
+            (hips_id,),
+        ).fetchone()
+        task = None
+        if row is not None:
+            task = json.loads(row["state"] or "{}")
+            task["status"] = (
+                row["status"]
+                if row["status"] in ("queued", "complete", "error",
+                                     "cancelled")
+                else "running"
+            )
+        if task is None or task["status"] not in ("queued", "running"):
+            if len(self._finished) >= self.FINISHED_CACHE_SIZE:
+                self._finished.clear()
+            self._finished[hips_id] = (time.monotonic(), task)
+            task = dict(task) if task is not None else None
+        return task
+
+    def start(self):
+        """
+        Start the worker threads and the heartbeat of this process, once.
+        """
+        with self._cond:
+            if self._workers:
+                return
+            self.owner = (f"{socket.gethostname()}:{os.getpid()}:"
+                          f"{uuid.uuid4().hex[:8]}")
+            for _ in range(self.max_workers):
+                self._workers.append(Thread(target=self._work, daemon=True))
+            self._workers.append(Thread(target=self._heartbeat, daemon=True))
+            for thread in self._workers:
+                thread.start()
+
+    def _claim(self):
+        """
+        Lease the next job that can be started, in a write transaction so
+        that two workers never claim the same job. Expired jobs that were
+        being cancelled, or that failed too many times, are closed.
+
+        Returns:
+            sqlite3.Row: The claimed job, None when there is none.
+        """
+        db = get_db()
+        while True:
+            now = time.time()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                job = db.execute(
+                    "SELECT * FROM jobs WHERE (status = 'queued' OR "
+                    "(status IN ('running', 'cancelling') AND "
+                    "lease_expires < ?)) AND user_id NOT IN "
+                    "(SELECT user_id FROM jobs WHERE status IN "
+                    "('running', 'cancelling') AND lease_expires >= ? "
+                    "GROUP BY user_id HAVING COUNT(*) >= ?) "
+                    "ORDER BY seq LIMIT 1",
+                    (now, now, self.max_jobs_per_user),
+                ).fetchone()
+                aborted = None
+                if job is None:
+                    pass
+                elif job["status"] == "cancelling":
+                    aborted = "cancelled"
+                elif job["attempts"] >= app.config['JOB_MAX_ATTEMPTS']:
+                    aborted = "error"
+                else:
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', owner = ?, "
+                        "lease_expires = ?, attempts = attempts + 1, "
+                        "updated = ? WHERE seq = ?",
+                        (self.owner, now + app.config['JOB_LEASE_S'], now,
+                         job["seq"]),
+                    )
+                if aborted:
+                    task = json.loads(job["state"] or "{}")
+                    task.update(progress=100, status=aborted)
+                    db.execute(
+                        "UPDATE jobs SET status = ?, state = ?, "
+                        "owner = NULL, lease_expires = NULL, updated = ? "
+                        "WHERE seq = ?",
+                        (aborted, json.dumps(task), now, job["seq"]),
+                    )
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+
+            if not aborted:
+                return job
+            print(f"❌ job {job['job_id']} abandoned by its worker:",
+                  aborted)
+            _, _, on_abort, cleanup = JOB_TARGETS[job["kind"]]
+            if on_abort:
+                on_abort(job["job_id"], aborted)
+            if cleanup:
+                cleanup(json.loads(job["args"]))
+
+    def _save(self, seq, hips_id, status=None):
+        """
+        Save the snapshot of the task of a job run by this process, and
+        renew its lease or close it with its final `status`.
+
+        Returns:
+            str: Status of the job in the store, None if the job was
+            claimed by another worker.
+        """
+        with progress_lock:
+            task = dict(task_queue.get(hips_id, {}))
+        task.pop('log', None)
+        now = time.time()
+        db = get_db()
+        with db:
+            if status:
+                closed = db.execute(
+                    "UPDATE jobs SET status = ?, state = ?, owner = NULL, "
+                    "lease_expires = NULL, updated = ? "
+                    "WHERE seq = ? AND owner = ?",
+                    (status, json.dumps(task), now, seq, self.owner),
+                ).rowcount
+                return status if closed else None
+            row = db.execute(
+                "UPDATE jobs SET state = ?, lease_expires = ?, updated = ? "
+                "WHERE seq = ? AND owner = ? "
+                "AND status IN ('running', 'cancelling') RETURNING status",
+                (json.dumps(task), now + app.config['JOB_LEASE_S'], now, seq,
+                 self.owner),
+            ).fetchone()
+        return row["status"] if row else None
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(app.config['JOB_HEARTBEAT_S'])
+            with self._cond:
+                running = dict(self._running)
+            # the steps of the jobs are published at least this often
+            if running:
+                publish_progress()
+            for hips_id, seq in running.items():
+                try:
+                    status = self._save(seq, hips_id)
+                except sqlite3.Error as e:
+                    print("❌ job heartbeat failed:", e)
+                    continue
+                if status != 'running':
+                    # cancelled by another process, or lease lost
+                    with self._cond:
+                        event = self._cancel_events.get(hips_id)
+                    if event is not None:
+                        event.set()
+
+    def _work(self):
+        while True:
+            job = self._claim()
+            if job is None:
+                with self._cond:
+                    self._cond.wait(self.POLL_S)
+                continue
+
+            hips_id = job["job_id"]
+            target, resumable, on_abort, cleanup = JOB_TARGETS[job["kind"]]
+            resume = job["attempts"] > 0
+            task = json.loads(job["state"] or "{}")
+            task["status"] = "running"
+            with self._cond:
+                self._running[hips_id] = job["seq"]
+                self._cancel_events[hips_id] = Event()
+            with progress_lock:
+                task_queue[hips_id] = task
+            publish_progress()
+
+            args = json.loads(job["args"])
+            kwargs = {}
+            if resume:
+                print("🆗 resuming job", hips_id)
+                if resumable:
+                    kwargs["resume"] = True
+            try:
+                target(*args, **kwargs)
+            except Exception as e:
+                print("❌ HiPS job failed:", e)
+                with progress_lock:
+                    task_queue[hips_id].update(progress=100, status="error")
+                if on_abort:
+                    on_abort(hips_id, "error")
+            finally:
+                with progress_lock:
+                    status = task_queue[hips_id]["status"]
+                if status not in ("complete", "error", "cancelled"):
+                    status = "error"
+                # a job whose lease was lost is run by another worker
+                if self._save(job["seq"], hips_id, status) and cleanup:
+                    cleanup(args)
+                with self._cond:
+                    del self._running[hips_id]
+                    del self._cancel_events[hips_id]
+                    self._cond.notify_all()
+                publish_progress()
+
+
+hips_scheduler = HipsJobScheduler(
+    default_worker_count(),
+    app.config['HIPSGEN_MAX_JOBS_PER_USER'],
+)
+
+
+@app.before_request
+def start_job_workers():
+    """Run the queued jobs in the web process, from its first request."""
+    if app.config['JOB_IN_PROCESS_WORKERS'] and not hips_scheduler.owner:
+        check_partition_hosts()
+        remove_orphan_project_inputs()
+        hips_scheduler.start()
+
+
+def get_task(hips_id):
+    """
+    Return the task of a job: from `task_queue` when this process runs or
+    ran it, otherwise from the last snapshot in the job store.
+
+    Args:
+        hips_id (str): Unique identifier for the task.
+
+    Returns:
+        dict: Copy of the task, None if the job is unknown.
+    """
+    with progress_lock:
+        task = task_queue.get(hips_id)
+        if task is not None:
+            return dict(task)
+    return hips_scheduler.state(hips_id)
+
+
+hipsgen_daemon = (
+    HipsgenDaemonClient(app.config['HIPSGEN_DAEMON_SOCKET'],
+                        app.config['HIPSGEN_JOB_MEMORY'])
+    if app.config['HIPSGEN_DAEMON_SOCKET'] else None
+)
+
+
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link `src` to `dst`. When linking is not possible, clone it
+    (reflink, on filesystems supporting it) or copy it as a last resort.
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    try:
+        with open(src, 'rb') as f_src, open(dst, 'wb') as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    """
+    Copy a directory tree with hard links instead of copying the files.
+
+    Args:
+        src (str): Path to the source directory.
+        dst (str): Path to the destination directory, must not exist.
+    """
+    shutil.copytree(src, dst, copy_function=_link_or_copy)
+
+
+def store_upload(file_storage, path):
+    """
+    Stream an uploaded file into the blob store while hashing it, and
+    link it to its place in the user folder.
 
-user_files = {}
-task_queue = {}
-progress_lock = Lock()
+    A file uploaded again, under any name, is only stored once.
+
+    Args:
+        file_storage (FileStorage): The uploaded file.
+        path (str): Path of the file in the user folder.
+
+    Returns:
+        str: sha256 of the file content.
+    """
+    blob_folder = app.config['BLOB_FOLDER']
+    os.makedirs(blob_folder, exist_ok=True)
+
+    sha = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=blob_folder, suffix='.part')
+    with os.fdopen(fd, 'wb') as out:
+        for chunk in iter(
+            lambda: file_storage.stream.read(app.config['UPLOAD_CHUNK_SIZE']),
+            b'',
+        ):
+            sha.update(chunk)
+            out.write(chunk)
+    digest = sha.hexdigest()
+    add_blob(tmp_path, digest, path)
+    return digest
 
 
-def allowed_file(filename):
+def add_blob(tmp_path, digest, path):
     """
-    Check if the file has a valid extension.
+    Move a file into the blob store and link it to its place in the user
+    folder.
 
     Args:
-        filename (str): Name of the file to check.
+        tmp_path (str): Path to the file, in the blob folder.
+        digest (str): sha256 of the file content.
+        path (str): Path of the file in the user folder.
+    """
+    blob_path = os.path.join(app.config['BLOB_FOLDER'], digest)
+    if os.path.exists(blob_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, blob_path)
+
+    if os.path.lexists(path):
+        release_upload(path)
+    _link_or_copy(blob_path, path)
+    st = os.stat(path)
+    upload_digests[(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)] = digest
+
+
+def known_digest(path):
+    """
+    Return the sha256 of an upload without reading it.
+
+    The digest is the one registered for the upload (followed through the
+    symlinks of the project input folders), as long as the file was not
+    modified since it was registered. An upload linked to its blob is
+    always recognised, the blob being named by its sha256.
+
+    Args:
+        path (str): Path to the file.
 
     Returns:
-        bool: True if the file has a valid extension, False otherwise.
+        str: sha256 of the file content, None when it is not known yet.
     """
-    return (
-        '.' in filename and
-        filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-    )
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    digest = upload_digests.get(key)
+    if digest is not None:
+        return digest
+
+    folder, name = os.path.split(os.path.realpath(path))
+    row = get_db().execute(
+        "SELECT sha256, size, updated FROM uploads "
+        "WHERE user_id = ? AND filename = ?",
+        (os.path.basename(folder), name),
+    ).fetchone()
+    if row is None or row["sha256"] is None:
+        return None
+    blob_path = os.path.join(app.config['BLOB_FOLDER'], row["sha256"])
+    try:
+        linked = os.path.samestat(st, os.stat(blob_path))
+    except FileNotFoundError:
+        linked = False
+    if not linked and (row["size"] != st.st_size or
+                       st.st_mtime_ns > row["updated"] * 1e9):
+        return None
+    upload_digests[key] = row["sha256"]
+    return row["sha256"]
 
 
-def generate_fits_index(output_folder, fits_file):
+def file_digest(path):
     """
-    Generate the FITS index for the input file
-    and save it in the output folder,
-    using a Java command line.
+    Return the sha256 of a file, read from the file when it is not known
+    (see `known_digest`). Reading multi-GB files is slow, it is only done
+    by the jobs and the upload indexer, never while answering a request.
 
     Args:
-        output_folder (str): Path to the output folder.
-        fits_file (str): Path to the input FITS file.
+        path (str): Path to the file.
 
     Returns:
-        bool: True if the index was generated successfully, False otherwise.
+        str: sha256 of the file content.
     """
-    cmd = [
-        "java", "-jar", "tools/Hipsgen.jar",
-        f"in={fits_file}",
-        f"out={output_folder}",
-        "creator_did=test/P/HTTP/F658N",
-        "INDEX",
-    ]
-    print("🆗 running command:", ' '.join(cmd))
+    digest = known_digest(path)
+    if digest is None:
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(
+                lambda: f.read(app.config['UPLOAD_CHUNK_SIZE']), b''
+            ):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        upload_digests[key] = digest
+    return digest
+
+
+def release_upload(path):
+    """
+    Remove a file of a user folder, and its blob when no other upload
+    links to it anymore.
 
+    Args:
+        path (str): Path of the file in the user folder.
+    """
+    digest = known_digest(path)
+    os.remove(path)
+    if digest is None:
+        # not indexed yet, so not linked to a blob
+        return
+    blob_path = os.path.join(app.config['BLOB_FOLDER'], digest)
     try:
-        subprocess.run(
-            cmd,
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-        return True
+        if os.stat(blob_path).st_nlink <= 1:
+            os.remove(blob_path)
+    except FileNotFoundError:
+        pass
+
+
+def index_uploads():
+    """
+    Hash the uploads registered without sha256 (found on disk by
+    `scan_existing_files`), link them to the blob store and record their
+    sha256, so that requests never have to read them.
+    """
+    db = get_db()
+    rows = db.execute(
+        "SELECT user_id, filename FROM uploads WHERE sha256 IS NULL"
+    ).fetchall()
+    for row in rows:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], row["user_id"],
+                            row["filename"])
+        try:
+            st = os.stat(path)
+            digest = file_digest(path)
+            blob_path = os.path.join(app.config['BLOB_FOLDER'], digest)
+            os.makedirs(app.config['BLOB_FOLDER'], exist_ok=True)
+            if not os.path.exists(blob_path):
+                _link_or_copy(path, blob_path)
+        except OSError as e:
+            print("❌ upload not indexed:", path, e)
+            continue
+        with db:
+            db.execute(
+                "UPDATE uploads SET sha256 = ?, updated = ? "
+                "WHERE user_id = ? AND filename = ? AND size = ?",
+                (digest, max(time.time(), st.st_mtime), row["user_id"],
+                 row["filename"], st.st_size),
+            )
+    if rows:
+        print(f"🆗 {len(rows)} uploads indexed")
+
+
+upload_indexer = None
+upload_indexer_lock = Lock()
 
-    except subprocess.CalledProcessError as e:
-        print("❌ error generating fits index", e.stderr)
-        return False
 
+@app.before_request
+def start_upload_indexer():
+    """Index the uploads found on disk in the background, once."""
+    global upload_indexer
+    with upload_indexer_lock:
+        if upload_indexer is None:
+            upload_indexer = Thread(target=index_uploads, daemon=True)
+            upload_indexer.start()
 
-def get_fits_tiles_cmd(input_folder, output_folder):
+
+def hips_cache_key(digests):
     """
-    Generate the command to create tiles from a FITS file.
+    Key of the HiPS built from some inputs with the current Hipsgen
+    parameters: same inputs and parameters give the same HiPS.
 
     Args:
-        filename (str): Name of the file to check.
+        digests (list): sha256 of the input FITS files.
 
     Returns:
-        bool: True if the file has a valid extension, False otherwise.
+        str: Hex digest identifying the HiPS.
     """
-    return [
-        "java", "-jar", "tools/Hipsgen.jar",
-        f"in={input_folder}",
-        f"out={output_folder}",
-        "creator_did=test/P/HTTP/F658N",
-        "TILES"
-    ]
+    params = [arg for arg in get_tiles_cmd('', '')
+              if not arg.startswith(('in=', 'out='))]
+    key = hashlib.sha256()
+    for digest in sorted(digests):
+        key.update(digest.encode())
+    key.update('\0'.join(params).encode())
+    return key.hexdigest()
 
 
-def get_png_tiles_cmd(input_folder, output_folder):
+def store_hips_in_cache(cache_key, hips_output_dir):
     """
-    Generate the command to create png from a FITS file.
+    Keep a hard linked copy of a finished HiPS in the result cache.
 
     Args:
-        filename (str): Name of the file to check.
+        cache_key (str): Key returned by `hips_cache_key`.
+        hips_output_dir (str): Path to the finished HiPS.
+    """
+    cache_dir = os.path.join(app.config['HIPS_CACHE_FOLDER'], cache_key)
+    if os.path.isdir(cache_dir):
+        return
+    os.makedirs(app.config['HIPS_CACHE_FOLDER'], exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=app.config['HIPS_CACHE_FOLDER'])
+    os.rmdir(tmp_dir)
+    link_tree(hips_output_dir, tmp_dir)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # stored meanwhile by another job
+        shutil.rmtree(tmp_dir)
+        return
+    evict_hips_cache()
+
 
+def _tree_size(folder):
+    """
     Returns:
-        bool: True if the file has a valid extension, False otherwise.
+        int: Size in bytes of the files of a directory tree.
     """
-    return [
-        "java", "-jar", "tools/Hipsgen.jar",
-        f"in={input_folder}",
-        f"out={output_folder}",
-        "creator_did=test/P/HTTP/F658N",
-        "pixelCut=0 5 log",
-        "PNG"
-    ]
+    size = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def evict_hips_cache():
+    """
+    Remove the least recently used HiPS of the result cache until it holds
+    at most `HIPS_CACHE_MAX_BYTES`. A HiPS is used when it is stored or
+    restored, which sets the modification time of its folder. The HiPS
+    linked from the cache keep their files, only the space of the HiPS
+    deleted since is freed.
+    """
+    cache_folder = app.config['HIPS_CACHE_FOLDER']
+    entries = []
+    for entry in os.scandir(cache_folder):
+        # the other folders are being stored or removed
+        if len(entry.name) != 64 or not entry.is_dir():
+            continue
+        try:
+            used = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        entries.append((used, _tree_size(entry.path), entry.path))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, cache_dir in entries:
+        if total <= app.config['HIPS_CACHE_MAX_BYTES']:
+            break
+        total -= size
+        # renamed first, so that it is never restored half deleted
+        tmp_dir = tempfile.mkdtemp(dir=cache_folder)
+        try:
+            os.rename(cache_dir, os.path.join(tmp_dir, "evicted"))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(tmp_dir)
+
+
+def hips_name(name):
+    """
+    Returns:
+        str: A HiPS name usable as a folder name from a project or file
+        name, None when nothing is left of it (such as `..`).
+    """
+    name = secure_filename(name)
+    return name if name not in ('', '.', '..') else None
+
+
+def check_hips_folder(hips_output_dir):
+    """
+    Check that a HiPS folder (`hips/<user_id>/<name>`) lies inside the
+    folder of its user, before it is deleted or replaced.
+
+    Raises:
+        ValueError: If the folder is outside of the folder of its user.
+    """
+    root = os.path.realpath("hips")
+    user_id = os.path.relpath(hips_output_dir, "hips").split(os.sep)[0]
+    user_dir = os.path.realpath(os.path.join("hips", user_id))
+    path = os.path.realpath(hips_output_dir)
+    if (os.path.dirname(user_dir) != root or path == user_dir or
+            os.path.commonpath([user_dir, path]) != user_dir):
+        raise ValueError(f"invalid HiPS folder {hips_output_dir}")
 
 
-def count_tiles_by_extension(root_dir, extension):
+def restore_hips_from_cache(cache_key, hips_output_dir):
     """
-    Count the number of files with a specific extension in a directory.
+    Link a cached HiPS to its output folder.
 
     Args:
-        root_dir (str): Path to the root directory.
-        extension (str): File extension to count.
+        cache_key (str): Key returned by `hips_cache_key`.
+        hips_output_dir (str): Path to the HiPS to create.
 
     Returns:
-        int: Number of files with the specified extension.
+        bool: True if the HiPS was in the cache, False otherwise.
     """
-    count = 0
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        count += sum(1 for f in filenames if f.lower().endswith(extension))
-    return count
+    cache_dir = os.path.join(app.config['HIPS_CACHE_FOLDER'], cache_key)
+    if not os.path.isdir(cache_dir):
+        return False
+    check_hips_folder(hips_output_dir)
+    if os.path.exists(hips_output_dir):
+        shutil.rmtree(hips_output_dir)
+    try:
+        link_tree(cache_dir, hips_output_dir)
+    except (FileNotFoundError, shutil.Error):
+        # evicted meanwhile
+        shutil.rmtree(hips_output_dir, ignore_errors=True)
+        return False
+    try:
+        os.utime(cache_dir)
+    except FileNotFoundError:
+        pass
+    return True
 
 
-def generate_tiles_with_progress(command, output_folder,
-                                 total_tiles, start_pct,
-                                 span_pct, hips_id):
+def make_project_inputs(upload_dir, names):
     """
-    Generate tiles with progress tracking.
+    Create the input folder of a project job, with a symlink to each of
+    its uploads. The folder belongs to the job, `remove_project_inputs`
+    deletes it once the job ended.
 
     Args:
-        command (list): Command to execute for tile generation.
-        output_folder (str): Path to the output folder.
-        total_tiles (int): Total number of tiles to generate.
-        start_pct (int): Starting percentage for progress.
-        span_pct (int): Percentage span for progress.
-        hips_id (str): Unique identifier for the HIPS task.
+        upload_dir (str): Upload folder of the user.
+        names (list): Names of the uploads of the project.
+
+    Returns:
+        str: Path to the input folder.
     """
-    proc = subprocess.Popen(
-        command,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
-    )
-    ext = '.png' if command[-1] == 'PNG' else '.fits'
+    os.makedirs(app.config['JOB_INPUT_FOLDER'], exist_ok=True)
+    input_dir = tempfile.mkdtemp(dir=app.config['JOB_INPUT_FOLDER'])
+    for name in names:
+        os.symlink(os.path.join(os.path.abspath(upload_dir), name),
+                   os.path.join(input_dir, name))
+    return input_dir
 
-    try:
-        while proc.poll() is None:
-            count = count_tiles_by_extension(output_folder, ext)
-            frac = min(count / total_tiles, 1.0)
-            pct = start_pct + int(frac * span_pct)
-            with progress_lock:
-                task_queue[hips_id]['progress'] = pct
-            time.sleep(0.5)
 
-        if proc.returncode != 0:
-            err = proc.stderr.read().decode()
-            raise Exception(f"Hipsgen failed ({ext}): {err}")
+def remove_project_inputs(args):
+    """
+    Delete the project input folders among the arguments of a HiPS job,
+    the single file inputs are uploads and are kept.
 
-    finally:
-        with progress_lock:
-            task_queue[hips_id]['progress'] = start_pct + span_pct
+    Args:
+        args (list): Arguments of the job.
+    """
+    root = os.path.abspath(app.config['JOB_INPUT_FOLDER'])
+    for arg in args:
+        if (isinstance(arg, str) and
+                os.path.dirname(os.path.abspath(arg)) == root):
+            shutil.rmtree(arg, ignore_errors=True)
+
+
+def remove_orphan_project_inputs(min_age=3600):
+    """
+    Delete the project input folders of no queued or running job, left by
+    a process that died before submitting or cleaning up its job. Recent
+    folders may belong to a job being submitted, and are kept.
+
+    Args:
+        min_age (float): Age (s) of the folders that may be deleted.
+    """
+    root = app.config['JOB_INPUT_FOLDER']
+    if not os.path.isdir(root):
+        return
+    used = set()
+    for row in get_db().execute(
+            "SELECT args FROM jobs "
+            "WHERE status IN ('queued', 'running', 'cancelling')"):
+        used.update(os.path.abspath(arg) for arg in json.loads(row["args"])
+                    if isinstance(arg, str))
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            old = time.time() - os.stat(path).st_mtime > min_age
+        except FileNotFoundError:
+            continue
+        if old and os.path.abspath(path) not in used:
+            print("🆗 removing orphan job inputs:", path)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+TILE_NAME = re.compile(r"Npix\d+\.(fits|png)")
+PNG_END = b"IEND\xaeB`\x82"
+
+
+def clean_partial_hips(hips_output_dir, rebuilt_order=None):
+    """
+    Prepare the folder of an interrupted HiPS generation to be resumed.
 
+    The tiles being written when the worker died may be truncated: FITS
+    tiles whose size is not a multiple of the 2880 bytes FITS block, and
+    PNG tiles without their IEND chunk, are removed. Hipsgen then runs with
+    `mode=keeptile` and only generates the tiles missing on disk. The
+    Allsky files and the .gz siblings are always written again.
 
-def background_task(hips_id, filename, fits_path, user_id):
+    Args:
+        hips_output_dir (str): Path to the HiPS folder.
+        rebuilt_order (int): The orders up to this one are removed too,
+            None to keep them.
+
+    Returns:
+        int: Number of tiles kept.
+    """
+    kept = 0
+    for dirpath, dirnames, filenames in os.walk(hips_output_dir):
+        if dirpath == hips_output_dir:
+            for name in list(dirnames):
+                if name == "HpxFinder" or (
+                        rebuilt_order is not None and
+                        name.startswith("Norder") and
+                        int(name[len("Norder"):]) <= rebuilt_order):
+                    dirnames.remove(name)
+                    if name != "HpxFinder":
+                        shutil.rmtree(os.path.join(dirpath, name))
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.startswith("Allsky") or filename.endswith(".gz"):
+                os.remove(path)
+                continue
+            if not TILE_NAME.fullmatch(filename):
+                continue
+            size = os.path.getsize(path)
+            if filename.endswith(".fits"):
+                complete = size > 0 and size % 2880 == 0
+            else:
+                with open(path, "rb") as f:
+                    f.seek(max(size - len(PNG_END), 0))
+                    complete = f.read() == PNG_END
+            if complete:
+                kept += 1
+            else:
+                os.remove(path)
+    return kept
+
+
+@job_target(resumable=True, on_abort=record_hips,
+            cleanup=remove_project_inputs)
+def background_task(hips_id, filename, fits_path, user_id, cache_key=None,
+                    fits_paths=None, resume=False):
     """
     Background task to generate HiPS tiles and PNGs.
     This function runs in a separate thread. It generates the FITS index,
@@ -186,64 +2713,572 @@ def background_task(hips_id, filename, fits_path, user_id):
         filename (str): Name of the input FITS file.
         fits_path (str): Path to the input FITS file.
         user_id (str): Unique identifier for the user.
+        cache_key (str): Key under which the finished HiPS is cached,
+            None when the sha256 of the inputs were not known when the
+            job was queued: they are then read by the job, and the HiPS
+            is linked from the result cache when it is there.
+        fits_paths (list): Paths to the input FITS files, recorded once
+            the HiPS is finished.
+        resume (bool): Complete the HiPS left on disk by an interrupted
+            run of the job: its index is kept, and only the tiles missing
+            on disk are generated (see `clean_partial_hips`).
     """
     with progress_lock:
         task_queue[hips_id] = {"progress": 0, "status": "running"}
+    record_hips(hips_id, "running")
 
     try:
         hips_output_dir = os.path.join("hips", hips_id)
-        os.makedirs(hips_output_dir, exist_ok=True)
+        moc_path = os.path.join(hips_output_dir, "HpxFinder", "Moc.fits")
+        # the index is complete once its MOC is written
+        resume = resume and os.path.exists(moc_path)
+        if cache_key is None and fits_paths:
+            cache_key = hips_cache_key([file_digest(p) for p in fits_paths])
+            if not resume and restore_hips_from_cache(cache_key,
+                                                      hips_output_dir):
+                print("🆗 HiPS restored from cache:", hips_id)
+                record_hips_inputs(hips_id, fits_paths)
+                with progress_lock:
+                    task_queue[hips_id]["progress"] = 100
+                    task_queue[hips_id]["status"] = "complete"
+                record_hips(hips_id, "complete")
+                return
+        if not resume:
+            # start from an empty folder: files of a previous HiPS may be
+            # hard links shared with the result cache
+            check_hips_folder(hips_output_dir)
+            if os.path.exists(hips_output_dir):
+                shutil.rmtree(hips_output_dir)
+            os.makedirs(hips_output_dir, exist_ok=True)
+
+        profile = hipsgen_profile(fits_input_bytes(fits_path))
+        with progress_lock:
+            task_queue[hips_id]["profile"] = profile['name']
 
-        if not generate_fits_index(hips_output_dir, fits_path):
+        if not resume and not generate_fits_index(
+                hips_output_dir, fits_path, profile, hips_id):
             raise Exception("Failed to generate FITS index")
 
+        if hips_scheduler.is_cancelled(hips_id):
+            raise JobCancelled(hips_id)
+
         with progress_lock:
             task_queue[hips_id]["progress"] = 2
 
-        moc_path = os.path.join(hips_output_dir, "HpxFinder", "Moc.fits")
         moc = MOC.load(moc_path)
-        order_max = moc.max_order
-
-        total_tiles = sum(
-            len(moc.degrade_to_order(o).flatten())
-            for o in range(order_max + 1)
-        )
+        total_tiles = count_moc_tiles(moc)
 
         if total_tiles == 0:
             raise Exception("No tiles found")
 
-        cmd_tiles = get_fits_tiles_cmd(fits_path, hips_output_dir)
-        generate_tiles_with_progress(
-            cmd_tiles,
-            hips_output_dir,
-            total_tiles,
-            start_pct=2,
-            span_pct=48,
-            hips_id=hips_id,
-        )
+        start_pct = 2
+        # the index MOC is at the deepest order Hipsgen will tile
+        max_order = moc.max_order
+        preview = (app.config['HIPS_PREVIEW_ORDER'] is not None and
+                   max_order > app.config['HIPS_PREVIEW_ORDER'])
+        if resume:
+            # the preview tiles were not built from the deeper tiles, and
+            # Hipsgen would keep them: they are generated again at the end
+            kept = clean_partial_hips(
+                hips_output_dir,
+                app.config['HIPS_PREVIEW_ORDER'] if preview else None,
+            )
+            print(f"🆗 {hips_id}: resumed with {kept} tiles on disk")
+            preview = False
+        if preview:
+            generate_preview(hips_id, fits_path, hips_output_dir, profile,
+                             max_order)
+            start_pct = 8
+            with progress_lock:
+                task_queue[hips_id]["progress"] = start_pct
+
+        if (os.path.isdir(fits_path) and
+                app.config['HIPSGEN_PARTITIONS'] > 1 and
+                profile['input_bytes'] >=
+                app.config['HIPSGEN_PARTITION_MIN_INPUT']):
+            generate_partitioned_tiles(hips_id, fits_path, hips_output_dir,
+                                       moc, total_tiles, profile, start_pct,
+                                       resume)
+        else:
+            cmd_tiles = get_tiles_cmd(fits_path, hips_output_dir, profile)
+            if preview:
+                # the tiles of the preview are written again
+                cmd_tiles.append("mode=replacetile")
+            elif resume:
+                cmd_tiles.append("mode=keeptile")
+            generate_tiles_with_progress(
+                cmd_tiles,
+                hips_output_dir,
+                total_tiles,
+                start_pct=start_pct,
+                span_pct=99 - start_pct,
+                hips_id=hips_id,
+                profile=profile,
+            )
 
-        cmd_png = get_png_tiles_cmd(fits_path, hips_output_dir)
-        generate_tiles_with_progress(
-            cmd_png,
-            hips_output_dir,
-            total_tiles,
-            start_pct=50,
-            span_pct=49,
-            hips_id=hips_id,
-        )
+        if app.config['HIPS_PRECOMPRESS']:
+            precompress_tiles(hips_output_dir)
+
+        if cache_key:
+            store_hips_in_cache(cache_key, hips_output_dir)
+        if fits_paths:
+            record_hips_inputs(hips_id, fits_paths)
 
         with progress_lock:
             task_queue[hips_id]["progress"] = 100
             task_queue[hips_id]["status"] = "complete"
+        record_hips(hips_id, "complete")
+
+    except JobCancelled:
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 100
+            task_queue[hips_id]["status"] = "cancelled"
+        record_hips(hips_id, "cancelled")
+
+        print("🆗 Background task cancelled:", hips_id)
 
     except Exception as e:
         with progress_lock:
             task_queue[hips_id]["progress"] = 100
             task_queue[hips_id]["status"] = "error"
+        record_hips(hips_id, "error")
 
         print("❌ Background task failed:", e)
 
 
+class UpdateNotPossible(Exception):
+    """The new files of a project need a complete HiPS generation."""
+
+
+def _unshare(path):
+    """
+    Give a file its own inode before it is modified in place, so that the
+    shared pages and the result cache linked to it keep their content.
+    """
+    try:
+        if os.stat(path).st_nlink < 2:
+            return
+    except FileNotFoundError:
+        return
+    tmp_path = path + '.unshare'
+    shutil.copy2(path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_file(path, data):
+    """Replace a file with a new one holding `data` (bytes)."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _index_order(hips_output_dir):
+    """Return the order of the HpxFinder index of a HiPS, None if none."""
+    try:
+        orders = [int(name[len("Norder"):]) for name in
+                  os.listdir(os.path.join(hips_output_dir, "HpxFinder"))
+                  if name.startswith("Norder")]
+    except FileNotFoundError:
+        return None
+    return max(orders, default=None)
+
+
+INDEX_PATH = re.compile(rb'("path"\s*:\s*")([^"]*)(")')
+
+
+def _read_index_file(path, input_dir):
+    """
+    Read the lines of a HpxFinder index file, pointing their input paths
+    to the files of `input_dir`.
+    """
+    def relocate(match):
+        name = os.path.basename(match.group(2).decode())
+        new_path = os.path.join(input_dir, name)
+        if not os.path.exists(new_path):
+            return match.group(0)
+        return match.group(1) + new_path.encode() + match.group(3)
+
+    with open(path, 'rb') as f:
+        return [INDEX_PATH.sub(relocate, line)
+                for line in f.read().splitlines()]
+
+
+def merge_index(src_index, dst_index, input_dir):
+    """
+    Add the entries of a HpxFinder index to another one. Each index file
+    lists one input file per line, the lines of a cell present in both
+    indexes are merged.
+
+    The input folder of a project is created again for each generation,
+    so the paths of both indexes are moved to `input_dir`.
+
+    Args:
+        src_index (str): Path to the HpxFinder folder to add.
+        dst_index (str): Path to the HpxFinder folder to update.
+        input_dir (str): Folder with all the inputs of the project.
+    """
+    input_dir = os.path.abspath(input_dir)
+    merged = set()
+    for dirpath, _, filenames in os.walk(src_index):
+        rel = os.path.relpath(dirpath, src_index)
+        if not rel.startswith("Norder"):
+            continue
+        dest_dir = os.path.join(dst_index, rel)
+        os.makedirs(dest_dir, exist_ok=True)
+        for name in filenames:
+            lines = _read_index_file(os.path.join(dirpath, name), input_dir)
+            dest = os.path.join(dest_dir, name)
+            if os.path.exists(dest):
+                old = _read_index_file(dest, input_dir)
+                lines = old + [line for line in lines if line not in old]
+            _write_file(dest, b'\n'.join(lines) + b'\n')
+            merged.add(dest)
+
+    for dirpath, _, filenames in os.walk(dst_index):
+        if not os.path.relpath(dirpath, dst_index).startswith("Norder"):
+            continue
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if path not in merged:
+                lines = _read_index_file(path, input_dir)
+                _write_file(path, b'\n'.join(lines) + b'\n')
+
+
+def update_properties(properties_path, values):
+    """
+    Set some keys of a properties file, keeping the other lines as is.
+
+    Args:
+        properties_path (str): Path to the properties file.
+        values (dict): New value of the keys.
+    """
+    values = dict(values)
+    lines = []
+    with open(properties_path) as f:
+        for line in f:
+            key = line.split('=', 1)[0].strip()
+            if '=' in line and key in values:
+                line = f"{key:<20} = {values.pop(key)}\n"
+            lines.append(line)
+    lines += [f"{key:<20} = {value}\n" for key, value in values.items()]
+    _write_file(properties_path, ''.join(lines).encode())
+
+
+def moc_cells(moc, order):
+    """
+    Return the HEALPix cells of an order covering a MOC, also for orders
+    deeper than the MOC order.
+    """
+    ranges = moc.to_depth29_ranges
+    if len(ranges) == 0:
+        return np.empty(0, dtype=np.int64)
+    shift = np.uint64(2 * (29 - order))
+    lo = (ranges[:, 0] >> shift).astype(np.int64)
+    hi = ((ranges[:, 1] - np.uint64(1)) >> shift).astype(np.int64) + 1
+    counts = hi - lo
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    return np.unique(np.repeat(lo, counts) + offsets)
+
+
+def _tile_paths(hips_output_dir, order, cells):
+    """Return the FITS and PNG tile paths of some cells of an order."""
+    return [
+        os.path.join(hips_output_dir, f"Norder{order}",
+                     f"Dir{(npix // 10000) * 10000}", f"Npix{npix}{ext}")
+        for npix in cells
+        for ext in ('.fits', '.png')
+    ]
+
+
+def record_update_abort(hips_id, status):
+    """
+    Record the status of a HiPS whose update ended without being run, or
+    was abandoned: the previous HiPS is left complete, and files can be
+    added to it again.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS.
+        status (str): Final status of the update job.
+    """
+    if os.path.exists(os.path.join("hips", hips_id, "properties")):
+        status = "complete"
+    record_hips(hips_id, status)
+
+
+@job_target(resumable=True, on_abort=record_update_abort,
+            cleanup=remove_project_inputs)
+def update_task(hips_id, input_path, new_paths, user_id, cache_key,
+                fits_paths, resume=False):
+    """
+    Background task adding new files to the HiPS of a project.
+
+    Only the new files are indexed, and their index is merged into the
+    index of the HiPS. The deepest tiles covered by the new files are
+    generated again from all the inputs (`region=`), then their parents
+    up to the lowest order, the Allsky files and the PNG tiles of this
+    region are rebuilt from the tiles on disk.
+
+    The update works in a hard linked copy of the HiPS, which replaces
+    the HiPS once complete: a cancelled or failed update leaves the
+    previous HiPS in place. The files of the copy that may be written
+    are first given their own inode (`_unshare`), so that the HiPS, the
+    shared pages and the result cache linked to them keep their content.
+
+    Falls back to a complete generation (`background_task`) when the new
+    files need a different index order.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS task.
+        input_path (str): Folder with all the inputs of the project.
+        new_paths (list): Paths to the FITS files added to the project.
+        user_id (str): Unique identifier for the user.
+        cache_key (str): Key under which the updated HiPS is cached, None
+            when the sha256 of the inputs are read by the job.
+        fits_paths (list): Paths to all the input FITS files.
+        resume (bool): The update was interrupted, its copy of the HiPS
+            is dropped and the update done again.
+    """
+    hips_output_dir = os.path.join("hips", hips_id)
+    # on the filesystem of the HiPS, for the swap, and out of the user
+    # folders (user ids are generated, they never start with a dot)
+    work_dir = os.path.join("hips", ".update", hips_id)
+    old_dir = os.path.join("hips", ".old", hips_id)
+    if resume:
+        print("🆗 interrupted HiPS update, updating again:", hips_id)
+        if not os.path.isdir(hips_output_dir) and os.path.isdir(work_dir):
+            # interrupted between the two renames of the swap
+            os.rename(work_dir, hips_output_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    with progress_lock:
+        task_queue[hips_id] = {"progress": 0, "status": "running",
+                               "mode": "update"}
+    record_hips(hips_id, "running")
+
+    scratch_dir = tempfile.mkdtemp(prefix="hips-update-")
+    try:
+        new_dir = os.path.join(scratch_dir, "inputs")
+        os.makedirs(new_dir)
+        for path in new_paths:
+            os.symlink(os.path.abspath(path),
+                       os.path.join(new_dir, os.path.basename(path)))
+
+        max_order = int(read_properties(
+            os.path.join(hips_output_dir, "properties"))["hips_order"])
+        profile = hipsgen_profile(fits_input_bytes(new_dir))
+
+        index_dir = os.path.join(scratch_dir, "hips")
+        if not generate_fits_index(
+            index_dir, new_dir, profile, hips_id,
+            params=(f"order={max_order}",),
+        ):
+            raise Exception("Failed to generate FITS index")
+        if _index_order(index_dir) != _index_order(hips_output_dir):
+            raise UpdateNotPossible(hips_id)
+        if hips_scheduler.is_cancelled(hips_id):
+            raise JobCancelled(hips_id)
+
+        os.makedirs(os.path.dirname(work_dir), exist_ok=True)
+        link_tree(hips_output_dir, work_dir)
+        new_moc = MOC.load(os.path.join(index_dir, "HpxFinder", "Moc.fits"))
+        merge_index(os.path.join(index_dir, "HpxFinder"),
+                    os.path.join(work_dir, "HpxFinder"), input_path)
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 10
+
+        # the deepest tiles of the region are generated again, the other
+        # tiles of the region are rewritten by Hipsgen, as well as tiles
+        # around it: the neighbours of the region at each order are also
+        # unshared
+        orders = [int(name[len("Norder"):])
+                  for name in os.listdir(work_dir)
+                  if name.startswith("Norder")]
+        affected = []
+        for order in range(min(orders), max_order + 1):
+            paths = _tile_paths(work_dir, order, moc_cells(new_moc, order))
+            around = (new_moc.degrade_to_order(order)
+                      if order < new_moc.max_order else new_moc)
+            around = around.add_neighbours()
+            if order == max_order:
+                for path in paths:
+                    for stale in (path, path + '.gz'):
+                        if os.path.exists(stale):
+                            os.remove(stale)
+            for path in _tile_paths(work_dir, order,
+                                    moc_cells(around, order)):
+                _unshare(path)
+            affected += paths
+        allsky = [os.path.join(work_dir, f"Norder{order}", name)
+                  for order in orders
+                  for name in ("Allsky.fits", "Allsky.png")]
+        properties_path = os.path.join(work_dir, "properties")
+        for path in [properties_path,
+                     os.path.join(work_dir, "Moc.fits"), *allsky]:
+            _unshare(path)
+        affected += allsky
+
+        with open(properties_path, 'rb') as f:
+            old_properties = f.read()
+        region_path = os.path.join(scratch_dir, "region.fits")
+        new_moc.save(region_path, format='fits', overwrite=True)
+
+        params = (
+            f"in={input_path}",
+            f"out={work_dir}",
+            "creator_did=test/P/HTTP/F658N",
+            "pixelCut=0 5 log",
+            f"region={region_path}",
+        )
+        run_with_progress(hipsgen_command(profile, *params, "TILES"),
+                          hips_id, lambda: None, profile, "update TILES")
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 60
+        run_with_progress(
+            hipsgen_command(profile, *params, "TREE", "ALLSKY", "PNG"),
+            hips_id, lambda: None, profile, "update TREE ALLSKY PNG",
+        )
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 90
+
+        # Hipsgen describes the region only, the HiPS covers both
+        moc_path = os.path.join(work_dir, "Moc.fits")
+        index_moc_path = os.path.join(work_dir, "HpxFinder", "Moc.fits")
+        moc = MOC.load(index_moc_path).union(new_moc)
+        for path in (moc_path, index_moc_path):
+            _unshare(path)
+            moc.save(path, format='fits', overwrite=True)
+        _write_file(properties_path, old_properties)
+        update_properties(properties_path, {
+            "moc_sky_fraction": f"{moc.sky_fraction:.6g}",
+            "hips_release_date": time.strftime("%Y-%m-%dT%H:%MZ",
+                                               time.gmtime()),
+        })
+
+        if app.config['HIPS_PRECOMPRESS']:
+            for path in affected:
+                if path.endswith('.fits') and os.path.exists(path):
+                    _gzip_file(path)
+
+        if hips_scheduler.is_cancelled(hips_id):
+            raise JobCancelled(hips_id)
+        os.makedirs(os.path.dirname(old_dir), exist_ok=True)
+        os.rename(hips_output_dir, old_dir)
+        os.rename(work_dir, hips_output_dir)
+        shutil.rmtree(old_dir)
+
+        if cache_key is None:
+            cache_key = hips_cache_key([file_digest(p) for p in fits_paths])
+        store_hips_in_cache(cache_key, hips_output_dir)
+        record_hips_inputs(hips_id, fits_paths)
+
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 100
+            task_queue[hips_id]["status"] = "complete"
+        record_hips(hips_id, "complete")
+
+    except UpdateNotPossible:
+        print("🆗 HiPS update not possible, generating it again:", hips_id)
+        background_task(hips_id, None, input_path, user_id, cache_key,
+                        fits_paths)
+
+    # the previous HiPS is left complete after a cancelled or failed update
+    except JobCancelled:
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 100
+            task_queue[hips_id]["status"] = "cancelled"
+        record_hips(hips_id, "complete")
+
+    except Exception as e:
+        with progress_lock:
+            task_queue[hips_id]["progress"] = 100
+            task_queue[hips_id]["status"] = "error"
+        record_hips(hips_id, "complete")
+
+        print("❌ HiPS update failed:", e)
+
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def project_new_files(hips_id, fits_paths):
+    """
+    Find the files added to a project since its HiPS was generated.
+
+    Returns:
+        list: Paths of the new files, None when the HiPS must be generated
+        again (no finished HiPS, or files removed or modified).
+    """
+    row = get_db().execute("SELECT status FROM hips WHERE hips_id = ?",
+                           (hips_id,)).fetchone()
+    previous = get_hips_inputs(hips_id)
+    if (row is None or row["status"] != "complete" or not previous or
+            not os.path.exists(os.path.join("hips", hips_id, "properties"))):
+        return None
+
+    current = {os.path.basename(p): p for p in fits_paths}
+    for name, digest in previous.items():
+        # a file not indexed yet is taken as modified
+        if name not in current or known_digest(current[name]) != digest:
+            return None
+    return [p for name, p in current.items() if name not in previous] or None
+
+
+def start_hips_job(hips_id, user_id, filename, input_path, fits_paths):
+    """
+    Queue the generation of a HiPS, or link it from the result cache when
+    the same inputs were already processed with the same parameters. When
+    files were only added to a project, only these files are processed.
+
+    Args:
+        hips_id (str): Unique identifier for the HiPS task.
+        user_id (str): Unique identifier for the user.
+        filename (str): Name of the input FITS file, None for a project.
+        input_path (str): Input file or folder given to Hipsgen.
+        fits_paths (list): Paths to the input FITS files.
+
+    The input folder of a project (`make_project_inputs`) is deleted
+    when no job is queued.
+
+    Returns:
+        bool: False if a job for this HiPS is already queued or running.
+    """
+    if hips_scheduler.is_active(hips_id):
+        remove_project_inputs([input_path])
+        return False
+
+    # the inputs whose sha256 is not known yet are hashed by the job
+    digests = [known_digest(p) for p in fits_paths]
+    cache_key = hips_cache_key(digests) if all(digests) else None
+    if cache_key and restore_hips_from_cache(cache_key,
+                                             os.path.join("hips", hips_id)):
+        print("🆗 HiPS restored from cache:", hips_id)
+        record_hips_inputs(hips_id, fits_paths)
+        remove_project_inputs([input_path])
+        with progress_lock:
+            task_queue[hips_id] = {"progress": 100, "status": "complete"}
+        record_hips(hips_id, "complete")
+        return True
+
+    target = background_task
+    args = (hips_id, filename, input_path, user_id, cache_key, fits_paths)
+    new_paths = None if filename else project_new_files(hips_id, fits_paths)
+    if new_paths:
+        print(f"🆗 adding {len(new_paths)} files to {hips_id}")
+        target = update_task
+        args = (hips_id, input_path, new_paths, user_id, cache_key,
+                fits_paths)
+
+    if not hips_scheduler.submit(hips_id, user_id, target, args):
+        remove_project_inputs([input_path])
+        return False
+    record_hips(hips_id, "queued")
+    return True
+
+
 @app.route("/")
 def home():
     """
@@ -251,8 +3286,8 @@ def home():
     This function checks if the user has a unique identifier as a cookie.
     If not, it generates a new one and sets it in the cookies.
     It also creates a folder for the user to store uploaded files.
-    If the user has already uploaded files, it retrieves them from the folder
-    and displays them in the upload form.
+    If the user has already uploaded files, it retrieves them from the
+    registry and displays them in the upload form.
 
     Returns:
         Response:
@@ -262,40 +3297,13 @@ def home():
     user_folder = os.path.join(app.config["UPLOAD_FOLDER"], user_id)
     os.makedirs(user_folder, exist_ok=True)
 
-    if user_id not in user_files:
-        user_files[user_id] = []
-
-    existing_filenames = {f["filename"] for f in user_files[user_id]}
-    for f in os.listdir(user_folder):
-        if f.endswith(".fits") and f not in existing_filenames:
-            full_path = os.path.join(user_folder, f)
-            size_mb = round(os.path.getsize(full_path) / (1024 * 1024), 2)
-            hips_id = next((file.get("hips_id") for file in user_files[user_id]
-                            if file["filename"] == f), None)
-            user_files[user_id].append({
-                "filename": f,
-                "hips_id": hips_id,
-                "fileweight": size_mb,
-            })
-
-    files = user_files[user_id]
+    files = get_user_uploads(user_id)
     latest = next(
         (f["hips_id"] for f in reversed(files) if f["hips_id"]), None)
 
-    folder = os.path.join("hips", user_id)
-    if os.path.exists(folder):
-        hips_list = [d for d in os.listdir(folder)
-                     if os.path.isdir(os.path.join(folder, d))]
-    else:
-        hips_list = []
+    hips_list = get_user_hips(user_id)
 
-    shared_pages_path = "shared-pages/shared_pages.json"
-    web_list = []
-    if os.path.exists(shared_pages_path):
-        with open(shared_pages_path, "r") as f:
-            shared_pages = json.load(f)
-        web_list = [page_id for page_id, data in shared_pages.items()
-                    if data.get("user_id") == user_id]
+    web_list = list(get_user_shared_pages(user_id))
 
     resp = make_response(
         render_template(
@@ -326,21 +3334,7 @@ def fits_images():
     if not user_id:
         return redirect('/')
 
-    folder = os.path.join(app.config["UPLOAD_FOLDER"], user_id)
-    os.makedirs(folder, exist_ok=True)
-
-    files = []
-    for f in os.listdir(folder):
-        if f.endswith(".fits"):
-            full_path = os.path.join(folder, f)
-            size_mb = round(os.path.getsize(full_path) / (1024 * 1024), 2)
-            hips_id = next((file.get("hips_id") for file in user_files.get(
-                user_id, []) if file["filename"] == f), None)
-            files.append({
-                "filename": f,
-                "fileweight": size_mb,
-                "hips_id": hips_id,
-            })
+    files = get_user_uploads(user_id)
     return render_template("fits_images.html", files=files)
 
 
@@ -351,13 +3345,7 @@ def hips_images():
         flash("❌ unknown user")
         return redirect('/')
 
-    folder = os.path.join("hips", user_id)
-    if not os.path.exists(folder):
-        flash("❌ no folder found")
-        return redirect('/')
-
-    hips_list = [d for d in os.listdir(folder)
-                 if os.path.isdir(os.path.join(folder, d))]
+    hips_list = get_user_hips(user_id)
 
     if not hips_list:
         flash("❌ no hips found")
@@ -386,15 +3374,7 @@ def visu():
         flash("❌ unknown user")
         return redirect('/')
 
-    hips_folder = os.path.join("hips", user_id)
-    if not os.path.exists(hips_folder):
-        flash("❌ no folder found")
-        return redirect('/')
-
-    hips_list = [
-        d for d in os.listdir(hips_folder)
-        if os.path.isdir(os.path.join(hips_folder, d))
-    ]
+    hips_list = get_user_hips(user_id)
     if not hips_list:
         flash("❌ no hips found")
         return redirect('/fits-images')
@@ -418,13 +3398,7 @@ def visu():
 
     hips_url = f"/hips/{user_id}/{selected_file}/" if selected_file else None
 
-    catalog_dir = os.path.join("user_catalogs", user_id)
-    user_catalogs = []
-    if os.path.exists(catalog_dir):
-        user_catalogs = [
-            name for name in os.listdir(catalog_dir)
-            if os.path.isdir(os.path.join(catalog_dir, name))
-        ]
+    user_catalogs = get_user_catalogs(user_id)
 
     return render_template(
         "visualiser.html",
@@ -446,26 +3420,15 @@ def web_pages():
         flash("❌ unknown user")
         return redirect('/')
 
-    folder = os.path.join("hips", user_id)
-    hips_list = []
-    if os.path.isdir(folder):
-        for name in os.listdir(folder):
-            index_path = os.path.join(folder, name, 'index.html')
-            if os.path.isfile(index_path):
-                hips_list.append(name)
+    hips_list = get_user_hips(user_id, status="complete")
 
     shared_hips_list = []
-    metadata_path = os.path.join("shared-pages", "shared_pages.json")
-    if os.path.exists(metadata_path):
-        with open(metadata_path, "r") as f:
-            data = json.load(f)
-        for public_id, info in data.items():
-            if info["user_id"] == user_id:
-                shared_hips_list.append({
-                    "id": public_id,
-                    "name": f"Shared HiPS ({', '.join(info['hips'])})",
-                    "hips": info["hips"]
-                })
+    for public_id, hips in get_user_shared_pages(user_id).items():
+        shared_hips_list.append({
+            "id": public_id,
+            "name": f"Shared HiPS ({', '.join(hips)})",
+            "hips": hips
+        })
 
     print(f"[DEBUG] shared_hips_list: {shared_hips_list}")
 
@@ -509,19 +3472,363 @@ def upload_file():
     for f in valid:
         name = secure_filename(f.filename)
         path = os.path.join(folder, name)
-        f.save(path)
-        file_size_mb = round(os.path.getsize(path) / (1024 * 1024), 2)
-        if not any(e['filename'] == name for e in user_files.setdefault(
-            user_id, [])
-        ):
-            user_files[user_id].append({
-                "filename": name,
-                "hips_id": None,
-                "fileweight": file_size_mb,
-            })
+        digest = store_upload(f, path)
+        register_upload(user_id, name, path, digest)
     return redirect('/fits-images')
 
 
+def register_upload(user_id, name, path, digest):
+    """
+    Add an uploaded file to the user's file registry.
+
+    Args:
+        user_id (str): Unique identifier for the user.
+        name (str): Name of the file.
+        path (str): Path of the file in the user folder.
+        digest (str): sha256 of the file content.
+    """
+    now = time.time()
+    db = get_db()
+    with db:
+        db.execute(
+            "INSERT INTO uploads VALUES (?, ?, ?, ?, NULL, ?, ?) "
+            "ON CONFLICT (user_id, filename) DO UPDATE SET "
+            "size = excluded.size, sha256 = excluded.sha256, "
+            "updated = excluded.updated",
+            (user_id, name, os.path.getsize(path), digest, now, now),
+        )
+
+
+def forget_uploads(user_id, filenames):
+    """
+    Remove files from the user's file registry.
+
+    Args:
+        user_id (str): Unique identifier for the user.
+        filenames (list): Names of the files.
+    """
+    db = get_db()
+    with db:
+        db.executemany(
+            "DELETE FROM uploads WHERE user_id = ? AND filename = ?",
+            [(user_id, name) for name in filenames],
+        )
+
+
+def check_fits_header(data):
+    """
+    Check that the first bytes of an upload look like a FITS file.
+
+    Args:
+        data (bytes): First bytes of the file.
+
+    Returns:
+        str: The error found, or None if the header is valid or not
+        complete yet.
+    """
+    if not data.startswith(b'SIMPLE  ='):
+        return "not a FITS file"
+    for i in range(0, len(data) - 79, 80):
+        if data[i:i + 8] == b'END     ':
+            try:
+                header = fits.Header.fromstring(data[:i + 80])
+            except Exception as e:
+                return f"invalid FITS header: {e}"
+            if not header.get('SIMPLE'):
+                return "not a standard FITS file"
+            return None
+    return None
+
+
+def _chunked_upload_state_path(upload_id):
+    return os.path.join(app.config['BLOB_FOLDER'], f"{upload_id}.json")
+
+
+def _init_chunked_hash(state):
+    """
+    Add to the state of a chunked upload the sha256 of its first chunks,
+    fed by `_hash_received_chunks`. These fields (prefixed with '_') are
+    not saved: after a restart the file is hashed again from its start.
+    """
+    state['_sha'] = hashlib.sha256()
+    state['_hashed'] = 0
+    state['_hash_lock'] = Lock()
+    state['_completing'] = False
+    # chunks being written: the upload is not completed meanwhile
+    state['_writing'] = 0
+
+
+def _hash_received_chunks(state, wait=False):
+    """
+    Feed the sha256 of a chunked upload with the chunks received, in
+    order, since the previous call, so that the file is hashed while it
+    is uploaded. Chunks are read back from the file, while they are still
+    in the page cache.
+
+    Args:
+        state (dict): State of the upload.
+        wait (bool): Wait for the thread currently hashing the upload,
+            instead of leaving the new chunks to it.
+    """
+    if not state['_hash_lock'].acquire(blocking=wait):
+        return
+    try:
+        with open(state['part_path'], 'rb') as f:
+            while True:
+                with chunked_uploads_lock:
+                    ready = state['_hashed'] in state['received']
+                if not ready:
+                    break
+                f.seek(state['_hashed'] * state['chunk_size'])
+                state['_sha'].update(f.read(state['chunk_size']))
+                state['_hashed'] += 1
+    finally:
+        state['_hash_lock'].release()
+
+
+def expire_chunked_uploads():
+    """
+    Remove the chunked uploads whose state and data were not written to
+    for `CHUNKED_UPLOAD_EXPIRE_S`, and the .part files left in the blob
+    store by interrupted uploads.
+    """
+    folder = app.config['BLOB_FOLDER']
+    limit = time.time() - app.config['CHUNKED_UPLOAD_EXPIRE_S']
+
+    def expired(path):
+        try:
+            return os.path.getmtime(path) < limit
+        except FileNotFoundError:
+            return True
+
+    bases = {os.path.splitext(name)[0] for name in os.listdir(folder)
+             if name.endswith(('.part', '.json'))}
+    for base in bases:
+        part_path = os.path.join(folder, base + '.part')
+        state_path = os.path.join(folder, base + '.json')
+        with chunked_uploads_lock:
+            state = chunked_uploads.get(base)
+            busy = state and (state['_completing'] or state['_writing'])
+            if busy or not (expired(part_path) and expired(state_path)):
+                continue
+            chunked_uploads.pop(base, None)
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        print("🆗 expired upload removed:", base)
+
+
+def _load_chunked_upload(upload_id, user_id):
+    """
+    Return the state of a chunked upload of a user, or None.
+    """
+    if not upload_id.isalnum():
+        return None
+    with chunked_uploads_lock:
+        state = chunked_uploads.get(upload_id)
+        if state is None:
+            try:
+                with open(_chunked_upload_state_path(upload_id)) as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                return None
+            state['received'] = set(state['received'])
+            _init_chunked_hash(state)
+            chunked_uploads[upload_id] = state
+    if state['user_id'] != user_id:
+        return None
+    return state
+
+
+def _save_chunked_upload(upload_id, state):
+    """Write the state of a chunked upload, so it survives a restart."""
+    tmp_path = _chunked_upload_state_path(upload_id) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({key: value for key, value in state.items()
+                   if not key.startswith('_')} |
+                  {'received': sorted(state['received'])}, f)
+    os.replace(tmp_path, _chunked_upload_state_path(upload_id))
+
+
+def _drop_chunked_upload(upload_id, state):
+    with chunked_uploads_lock:
+        chunked_uploads.pop(upload_id, None)
+        for path in (state['part_path'],
+                     _chunked_upload_state_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@app.route("/upload/init", methods=["POST"])
+def init_chunked_upload():
+    """
+    Start a resumable chunked upload.
+
+    The file is sent in chunks of `chunk_size` bytes with
+    `/upload/<upload_id>/<index>`, in any order and in parallel, then
+    assembled with `/upload/<upload_id>/complete`. The chunks are written
+    at their offset in a file of the blob store, which becomes the blob
+    once the upload is complete, so the data is never copied.
+
+    Returns:
+        Response: A JSON response with the `upload_id`.
+    """
+    user_id = request.cookies.get('userID')
+    filename = request.form.get('filename', '')
+    try:
+        size = int(request.form['size'])
+        chunk_size = int(request.form['chunk_size'])
+    except (KeyError, ValueError):
+        return jsonify(error='size and chunk_size are required'), 400
+
+    if not user_id or not allowed_file(filename):
+        return jsonify(error='no valid file'), 400
+    if not 0 < size <= app.config['MAX_CONTENT_LENGTH']:
+        return jsonify(error='file too large'), 413
+    if not 0 < chunk_size <= app.config['MAX_CHUNK_SIZE']:
+        return jsonify(error='invalid chunk size'), 400
+
+    global chunked_uploads_expired
+    os.makedirs(app.config['BLOB_FOLDER'], exist_ok=True)
+    if time.time() - chunked_uploads_expired > 3600:
+        chunked_uploads_expired = time.time()
+        expire_chunked_uploads()
+    upload_id = uuid.uuid4().hex
+    part_path = os.path.join(app.config['BLOB_FOLDER'], f"{upload_id}.part")
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+
+    state = {
+        'user_id': user_id,
+        'filename': secure_filename(filename),
+        'size': size,
+        'chunk_size': chunk_size,
+        'part_path': part_path,
+        'received': set(),
+    }
+    _init_chunked_hash(state)
+    with chunked_uploads_lock:
+        chunked_uploads[upload_id] = state
+        _save_chunked_upload(upload_id, state)
+
+    return jsonify(upload_id=upload_id)
+
+
+@app.route("/upload/<upload_id>", methods=["GET"])
+def chunked_upload_status(upload_id):
+    """
+    Return the chunks already received, so that an interrupted upload can
+    be resumed by sending the missing ones.
+    """
+    state = _load_chunked_upload(upload_id, request.cookies.get('userID'))
+    if state is None:
+        return jsonify(error='unknown upload'), 404
+    return jsonify(received=sorted(state['received']),
+                   size=state['size'], chunk_size=state['chunk_size'])
+
+
+@app.route("/upload/<upload_id>/<int:index>", methods=["PUT"])
+def upload_chunk(upload_id, index):
+    """
+    Receive one chunk of a chunked upload.
+
+    The body is the raw chunk, and the `X-Chunk-Sha256` header its sha256.
+    A chunk with a wrong checksum is rejected and has to be sent again.
+    The FITS header is checked as soon as the first chunk arrives, and
+    the whole upload is rejected if it is not valid.
+    """
+    state = _load_chunked_upload(upload_id, request.cookies.get('userID'))
+    if state is None:
+        return jsonify(error='unknown upload'), 404
+    if state['_completing']:
+        return jsonify(error='upload being completed'), 409
+
+    offset = index * state['chunk_size']
+    length = min(state['chunk_size'], state['size'] - offset)
+    if length <= 0:
+        return jsonify(error='invalid chunk index'), 400
+
+    data = request.stream.read(length + 1)
+    if len(data) != length:
+        return jsonify(error='invalid chunk size'), 400
+    if (hashlib.sha256(data).hexdigest() !=
+            request.headers.get('X-Chunk-Sha256', '').lower()):
+        return jsonify(error='checksum mismatch'), 400
+
+    if index == 0:
+        error = check_fits_header(data)
+        if error:
+            _drop_chunked_upload(upload_id, state)
+            return jsonify(error=error), 415
+
+    with chunked_uploads_lock:
+        if state['_completing']:
+            return jsonify(error='upload being completed'), 409
+        state['_writing'] += 1
+    try:
+        fd = os.open(state['part_path'], os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+    finally:
+        with chunked_uploads_lock:
+            state['_writing'] -= 1
+
+    with chunked_uploads_lock:
+        state['received'].add(index)
+        _save_chunked_upload(upload_id, state)
+    _hash_received_chunks(state)
+
+    return jsonify(received=index)
+
+
+@app.route("/upload/<upload_id>/complete", methods=["POST"])
+def complete_chunked_upload(upload_id):
+    """
+    Finish a chunked upload once all its chunks are received: the file is
+    moved to the blob store and linked to the user folder. Its sha256 was
+    computed while the chunks arrived.
+
+    The upload is completed once: the other calls made meanwhile get a
+    409, and the calls made afterwards a 404.
+    """
+    user_id = request.cookies.get('userID')
+    state = _load_chunked_upload(upload_id, user_id)
+    if state is None:
+        return jsonify(error='unknown upload'), 404
+
+    nb_chunks = -(-state['size'] // state['chunk_size'])
+    with chunked_uploads_lock:
+        missing = sorted(set(range(nb_chunks)) - state['received'])
+        if missing:
+            return jsonify(error='missing chunks', missing=missing), 409
+        if state['_completing']:
+            return jsonify(error='upload being completed'), 409
+        if state['_writing']:
+            return jsonify(error='chunks being written'), 409
+        state['_completing'] = True
+
+    try:
+        _hash_received_chunks(state, wait=True)
+        folder = os.path.join(app.config['UPLOAD_FOLDER'], user_id)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, state['filename'])
+        digest = state['_sha'].hexdigest()
+        add_blob(state['part_path'], digest, path)
+        register_upload(user_id, state['filename'], path, digest)
+    except BaseException:
+        with chunked_uploads_lock:
+            state['_completing'] = False
+        raise
+
+    with chunked_uploads_lock:
+        chunked_uploads.pop(upload_id, None)
+        os.remove(_chunked_upload_state_path(upload_id))
+
+    return jsonify(filename=state['filename'])
+
+
 @app.route("/generate_hips", methods=["POST"])
 def generate_hips():
     user_id = request.cookies.get('userID')
@@ -536,41 +3843,26 @@ def generate_hips():
         if not project_name:
             flash("❌ name your project")
             return redirect('/')
+        safe_project_name = hips_name(project_name)
+        if safe_project_name is None:
+            flash("❌ invalid project name")
+            return redirect('/')
 
         files = []
         for all_files in selected:
             files += all_files.split(',')
 
-        temp_dir = tempfile.mkdtemp()
         upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], user_id)
-        for name in files:
-            src = os.path.join(os.path.abspath(upload_dir), name)
-            dst = os.path.join(temp_dir, name)
-            os.symlink(src, dst)
+        temp_dir = make_project_inputs(upload_dir, files)
 
-        safe_project_name = project_name.replace("/", "_").replace("\\", "_")
         hips_id = f"{user_id}/{safe_project_name}"
 
-        Thread(
-            target=background_task,
-            args=(hips_id,
-                  None,
-                  temp_dir,
-                  user_id,
-                  )).start()
+        fits_paths = [os.path.join(upload_dir, name) for name in files]
+        if not start_hips_job(hips_id, user_id, None, temp_dir, fits_paths):
+            return jsonify({'error': 'HiPS generation already queued'}), 409
 
         properties_path = os.path.join("hips", hips_id, "properties")
-        hips_ra = hips_dec = hips_fov = None
-
-        if os.path.exists(properties_path):
-            with open(properties_path) as f:
-                for line in f:
-                    if line.startswith("hips_initial_ra"):
-                        hips_ra = float(line.split("=")[1].strip())
-                    elif line.startswith("hips_initial_dec"):
-                        hips_dec = float(line.split("=")[1].strip())
-                    elif line.startswith("hips_initial_fov"):
-                        hips_fov = float(line.split("=")[1].strip())
+        hips_ra, hips_dec, hips_fov = get_initial_view(properties_path)
 
         print("🆗 ra : " + str(hips_ra))
         print("🆗 dec : " + str(hips_dec))
@@ -585,10 +3877,11 @@ def generate_hips():
 
     # Cas fichier unique
     filename = selected[0]
-    entry = next((
-        e for e in user_files.get(user_id, []) if e['filename'] == filename),
-        None
-    )
+    db = get_db()
+    entry = db.execute(
+        "SELECT 1 FROM uploads WHERE user_id = ? AND filename = ?",
+        (user_id, filename),
+    ).fetchone()
 
     if not entry:
         flash("❌ file not found")
@@ -596,35 +3889,28 @@ def generate_hips():
 
     fits_path = os.path.join(app.config["UPLOAD_FOLDER"], user_id, filename)
 
-    base_name = project_name if project_name else os.path.splitext(filename)[0]
+    base_name = hips_name(project_name or os.path.splitext(filename)[0])
+    if base_name is None:
+        flash("❌ invalid project name")
+        return redirect('/')
     hips_id = f"{user_id}/{base_name}"
-    entry["hips_id"] = hips_id
-
-    Thread(
-        target=background_task,
-        args=(
-            hips_id,
-            filename,
-            fits_path,
-            user_id,
-        ),
-    ).start()
+    with db:
+        db.execute(
+            "UPDATE uploads SET hips_id = ?, updated = ? "
+            "WHERE user_id = ? AND filename = ?",
+            (hips_id, time.time(), user_id, filename),
+        )
+
+    if not start_hips_job(hips_id, user_id, filename, fits_path,
+                          [fits_path]):
+        return jsonify({'error': 'HiPS generation already queued'}), 409
 
     properties_path = os.path.join(
         "hips",
         hips_id,
         "properties",
     )
-    hips_ra = hips_dec = hips_fov = None
-    if os.path.exists(properties_path):
-        with open(properties_path) as f:
-            for line in f:
-                if line.startswith("hips_initial_ra"):
-                    hips_ra = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_dec"):
-                    hips_dec = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_fov"):
-                    hips_fov = float(line.split("=")[1].strip())
+    hips_ra, hips_dec, hips_fov = get_initial_view(properties_path)
 
     print("🆗 ra : " + str(hips_ra))
     print("🆗 dec : " + str(hips_dec))
@@ -638,6 +3924,41 @@ def generate_hips():
     }
 
 
+@app.route("/estimate_hips", methods=["POST"])
+def estimate_hips():
+    """
+    Dry-run cost estimate of a HiPS generation.
+
+    Takes the same `selected_files` as `/generate_hips` and returns the
+    expected tile count, disk size and runtime, without queuing any job.
+
+    Returns:
+        Response: A JSON response containing:
+            - tiles (int): Expected number of tiles, all orders included.
+            - max_order (int): Deepest tile order.
+            - disk_bytes (int): Expected disk size of the FITS+PNG HiPS.
+            - runtime_s (int): Expected generation time in seconds.
+    """
+    user_id = request.cookies.get('userID')
+    selected = request.form.getlist('selected_files')
+    if not user_id or not selected:
+        return jsonify({'error': 'user unknown or no file selected'}), 400
+
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], user_id)
+    paths = []
+    for all_files in selected:
+        for name in all_files.split(','):
+            path = os.path.join(upload_dir, secure_filename(name))
+            if not os.path.isfile(path):
+                return jsonify({'error': f'{name} not found'}), 404
+            paths.append(path)
+
+    try:
+        return jsonify(estimate_hips_cost(paths))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+
 @app.route("/get_progress")
 def get_progress():
     """
@@ -650,16 +3971,144 @@ def get_progress():
     Returns:
         Response: A JSON response containing:
             - progress (int): Progress percentage of the HiPS task.
-            - status (str): Current status of the HiPS task.
+            - status (str): Current status of the HiPS task
+              (queued, running, complete, error or cancelled).
+            - previewable (bool): True once the low orders of the HiPS
+              can be shown, while the deeper orders are generated.
+            - position (int): Position in the queue, when queued.
+            - tiles_per_s (float): Tile generation rate of the current step.
+            - eta (int): Estimated remaining seconds of the current step.
+            - rows (int): Rows of the catalog, for catalog tasks.
+            - rows_read (int): Rows read so far, for catalog tasks.
+            - tiles (int): Tiles written so far, for catalog tasks.
     """
     hips_id = request.args.get('hips_id')
     if not hips_id:
         return jsonify(progress=0, status='unknown')
-    with progress_lock:
-        task = task_queue.get(hips_id)
+    return jsonify(progress_payload(hips_id))
+
+
+FINISHED_STATUSES = ('complete', 'error', 'cancelled', 'unknown')
+
+
+def progress_payload(hips_id):
+    """
+    Args:
+        hips_id (str): Unique identifier for the task.
+
+    Returns:
+        dict: Fields of `/get_progress` for the task.
+    """
+    task = get_task(hips_id)
     if not task:
-        return jsonify(progress=0, status='unknown')
-    return jsonify(progress=task['progress'], status=task['status'])
+        return {'progress': 0, 'status': 'unknown'}
+    return {
+        'progress': task['progress'],
+        'status': task['status'],
+        'previewable': task.get('previewable', False),
+        'position': hips_scheduler.position(hips_id),
+        'tiles_per_s': task.get('tiles_per_s'),
+        'eta': task.get('eta'),
+        'rows': task.get('rows'),
+        'rows_read': task.get('rows_read'),
+        'tiles': task.get('tiles'),
+    }
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/progress_stream")
+def progress_stream():
+    """
+    Stream the progress of a task (`hips_id`), or of the active tasks of
+    the current user, as Server-Sent Events.
+
+    The tasks are read again when the tasks of this process change
+    (`publish_progress`), and every `PROGRESS_STREAM_INTERVAL` seconds
+    for the tasks run by other processes, but never more than once per
+    `PROGRESS_STREAM_INTERVAL` seconds. A `progress` event with the
+    fields of `/get_progress` and the `hips_id` is sent for each task
+    that changed since the previous event, so status transitions and
+    errors are pushed once. The stream ends with an `end` event when the
+    task is finished, or when the user has no active task left. Clients
+    without EventSource keep polling `/get_progress`.
+
+    Returns:
+        Response: A `text/event-stream` response.
+    """
+    hips_id = request.args.get('hips_id')
+    user_id = request.cookies.get('userID')
+    if not hips_id and not user_id:
+        return jsonify(error='unknown user'), 403
+    interval = app.config['PROGRESS_STREAM_INTERVAL']
+
+    def events():
+        deadline = time.monotonic() + app.config['PROGRESS_STREAM_MAX_S']
+        sent = {}
+        last_event = time.monotonic()
+        yield f"retry: {int(interval * 1000)}\n\n"
+        while time.monotonic() < deadline:
+            read_at = time.monotonic()
+            with progress_changed:
+                version = progress_version
+            if hips_id:
+                job_ids = [hips_id]
+            else:
+                # the tasks finished since the previous read are sent once
+                job_ids = hips_scheduler.active_jobs(user_id) + [
+                    job_id for job_id, payload in sent.items()
+                    if payload['status'] not in FINISHED_STATUSES]
+            for job_id in dict.fromkeys(job_ids):
+                payload = progress_payload(job_id)
+                if payload != sent.get(job_id):
+                    sent[job_id] = payload
+                    last_event = time.monotonic()
+                    yield _sse('progress', dict(payload, hips_id=job_id))
+
+            if hips_id and sent[hips_id]['status'] in FINISHED_STATUSES:
+                yield _sse('end', {'hips_id': hips_id})
+                return
+            if not hips_id and all(payload['status'] in FINISHED_STATUSES
+                                   for payload in sent.values()):
+                yield _sse('end', {})
+                return
+            if time.monotonic() - last_event > 15:
+                yield ": keep-alive\n\n"
+                last_event = time.monotonic()
+
+            with progress_lock:
+                remote = any(job_id not in task_queue for job_id in sent)
+            timeout = interval if remote else 15
+            with progress_changed:
+                progress_changed.wait_for(
+                    lambda: progress_version != version, timeout)
+            # the changes published meanwhile are read together
+            time.sleep(max(0, read_at + interval - time.monotonic()))
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.route("/cancel_hips", methods=["POST"])
+def cancel_hips():
+    """
+    Cancel a queued or running HiPS generation task of the current user.
+
+    Returns:
+        Response: A JSON response with the `cancelled` flag.
+    """
+    user_id = request.cookies.get('userID')
+    hips_id = request.form.get('hips_id', '')
+    if not user_id or not hips_id.startswith(
+        (f"{user_id}/", f"catalog:{user_id}/")
+    ):
+        return jsonify(cancelled=False, error='unknown task'), 403
+    return jsonify(cancelled=hips_scheduler.cancel(hips_id))
 
 
 @app.route('/hips/<path:filename>')
@@ -670,10 +4119,17 @@ def serve_hips(filename):
     Args:
         filename (str): Path to the file within the 'hips' directory.
 
+    Finished HiPS are cached by clients for `HIPS_TILE_MAX_AGE`, HiPS
+    still being generated are always revalidated.
+
     Returns:
         Response: The requested file as a Flask response.
     """
-    return send_from_directory('hips', filename)
+    hips_id = '/'.join(filename.split('/')[:2])
+    status = (get_task(hips_id) or {}).get('status')
+    finished = status not in ('queued', 'running')
+    max_age = app.config['HIPS_TILE_MAX_AGE'] if finished else None
+    return send_tile('hips', filename, max_age=max_age)
 
 
 @app.route("/deleteAll", methods=["POST"])
@@ -683,24 +4139,25 @@ def delete_all():
 
     This function identifies the user by their cookie.
     If the user is known, it deletes all their uploaded files
-    from the server and clears their entry from the user_files list.
+    from the server and removes them from the file registry.
     A flash message is displayed based on the result.
     """
     user_id = request.cookies.get('userID')
-    if not user_id or user_id not in user_files:
+    if not user_id:
         flash("❌ unknown user")
         return redirect('/')
 
     folder = os.path.join(app.config['UPLOAD_FOLDER'], user_id)
     counter = 0
 
-    for e in user_files[user_id]:
-        path = os.path.join(folder, e['filename'])
+    filenames = [e['filename'] for e in get_user_uploads(user_id)]
+    for filename in filenames:
+        path = os.path.join(folder, filename)
         if os.path.exists(path):
-            os.remove(path)
+            release_upload(path)
             counter += 1
 
-    user_files[user_id] = []
+    forget_uploads(user_id, filenames)
 
     flash(f"✅ {counter} deleted" if counter else "ℹ️ nothing to delete")
     return redirect('/fits-images')
@@ -719,7 +4176,7 @@ def delete_file(filename):
     """
     user_id = request.cookies.get('userID')
 
-    if not user_id or user_id not in user_files:
+    if not user_id:
         flash("❌ unknown user")
         return redirect('/')
 
@@ -727,9 +4184,8 @@ def delete_file(filename):
     path = os.path.join(folder, filename)
 
     if os.path.exists(path):
-        os.remove(path)
-        user_files[user_id] = [e for e in user_files[user_id]
-                               if e['filename'] != filename]
+        release_upload(path)
+        forget_uploads(user_id, [filename])
         flash(f"✅ {filename} deleted")
     else:
         flash(f"❌ {filename} not found")
@@ -758,8 +4214,19 @@ def delete_hips(user_id, hipex_id):
         flash("❌ unknown or unauthorized user")
         return redirect('/visualiser')
     folder = os.path.join("hips", user_id, hipex_id)
+    try:
+        check_hips_folder(folder)
+    except ValueError:
+        flash(f"❌ HiPS folder '{hipex_id}' not found")
+        return redirect('/visualiser')
     if os.path.exists(folder):
         shutil.rmtree(folder)
+        db = get_db()
+        with db:
+            db.execute("DELETE FROM hips WHERE hips_id = ?",
+                       (f"{user_id}/{hipex_id}",))
+            db.execute("DELETE FROM hips_inputs WHERE hips_id = ?",
+                       (f"{user_id}/{hipex_id}",))
         flash(f"✅ HiPS folder '{hipex_id}' deleted")
     else:
         flash(f"❌ HiPS folder '{hipex_id}' not found")
@@ -791,30 +4258,32 @@ def generate_web_page():
         flash("❌ please select at least one HiPS to share")
         return redirect('/web-pages')
 
+    busy = [hips_id for hips_id in selected_hips
+            if hips_scheduler.is_active(f"{user_id}/{hips_id}")]
+    if busy:
+        flash(f"❌ {', '.join(busy)} still being generated")
+        return redirect('/web-pages')
+
     public_id = secrets.token_hex(8)
     shared_dir = os.path.join("shared-pages", public_id)
     os.makedirs(shared_dir, exist_ok=True)
 
+    # the shared HiPS is a snapshot made of hard links to the files of the
+    # HiPS: no data is copied, and deleting or regenerating the HiPS (which
+    # starts from an empty folder) leaves the snapshot untouched
     for hips_id in selected_hips:
         source_path = os.path.join("hips", user_id, hips_id)
         dest_path = os.path.join(shared_dir, hips_id)
         if os.path.isdir(source_path):
-            shutil.copytree(source_path, dest_path)
-
-    metadata_path = os.path.join("shared-pages", "shared_pages.json")
-    if os.path.exists(metadata_path):
-        with open(metadata_path, "r") as f:
-            data = json.load(f)
-    else:
-        data = {}
+            link_tree(source_path, dest_path)
 
-    data[public_id] = {
-        "user_id": user_id,
-        "hips": selected_hips
-    }
-
-    with open(metadata_path, "w") as f:
-        json.dump(data, f)
+    db = get_db()
+    with db:
+        db.execute("INSERT INTO shared_pages VALUES (?, ?, ?)",
+                   (public_id, user_id, time.time()))
+        db.executemany("INSERT INTO shared_hips VALUES (?, ?, ?)",
+                       [(public_id, i, name)
+                        for i, name in enumerate(selected_hips)])
 
     flash("✅ web page generated successfully ")
     return redirect("/web-pages")
@@ -827,21 +4296,12 @@ def serve_shared_hips(filename):
 
 @app.route("/shared/<public_id>", methods=["GET", "POST"])
 def shared_page(public_id):
-    metadata_path = os.path.join("shared-pages", "shared_pages.json")
-
-    if not os.path.exists(metadata_path):
-        flash("❌ no available shared pages")
-        return redirect("/")
-
-    with open(metadata_path, "r") as f:
-        data = json.load(f)
-
-    if public_id not in data:
+    info = get_shared_page(public_id)
+    if info is None:
         flash("❌ shared page not found")
         return redirect("/")
 
-    info = data[public_id]
-    hips_list = info.get("hips", [])
+    hips_list = info["hips"]
 
     selected_file = None
     hips_url = None
@@ -867,7 +4327,9 @@ def shared_page(public_id):
 @app.route('/shared-pages/<public_id>/<path:filename>')
 def shared_pages(public_id, filename):
     directory = os.path.join('shared-pages', public_id)
-    return send_from_directory(directory, filename)
+    return send_tile(directory, filename,
+                     max_age=app.config['SHARED_TILE_MAX_AGE'],
+                     immutable=True)
 
 
 @app.route("/infos", methods=["GET"])
@@ -886,17 +4348,7 @@ def infos():
     user_id = request.cookies.get('userID')
     hips_id = request.args.get('hips_id')
     properties_path = os.path.join("hips", user_id, hips_id, "properties")
-    hips_ra = hips_dec = hips_fov = None
-
-    if os.path.exists(properties_path):
-        with open(properties_path) as f:
-            for line in f:
-                if line.startswith("hips_initial_ra"):
-                    hips_ra = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_dec"):
-                    hips_dec = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_fov"):
-                    hips_fov = float(line.split("=")[1].strip())
+    hips_ra, hips_dec, hips_fov = get_initial_view(properties_path)
 
     print("🆗 ra : " + str(hips_ra))
     print("🆗 dec : " + str(hips_dec))
@@ -926,17 +4378,7 @@ def infosvis():
     user_id = request.cookies.get('userID')
     hips_id = request.args.get('hips_id')
     properties_path = os.path.join("hips", user_id, hips_id, "properties")
-    hips_ra = hips_dec = hips_fov = None
-
-    if os.path.exists(properties_path):
-        with open(properties_path) as f:
-            for line in f:
-                if line.startswith("hips_initial_ra"):
-                    hips_ra = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_dec"):
-                    hips_dec = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_fov"):
-                    hips_fov = float(line.split("=")[1].strip())
+    hips_ra, hips_dec, hips_fov = get_initial_view(properties_path)
 
     print("🆗 ra : " + str(hips_ra))
     print("🆗 dec : " + str(hips_dec))
@@ -963,20 +4405,13 @@ def shared_infos():
                                    selected_file,
                                    "properties")
 
-    hips_ra = hips_dec = hips_fov = None
-
-    if os.path.exists(properties_path):
-        with open(properties_path) as f:
-            for line in f:
-                if line.startswith("hips_initial_ra"):
-                    hips_ra = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_dec"):
-                    hips_dec = float(line.split("=")[1].strip())
-                elif line.startswith("hips_initial_fov"):
-                    hips_fov = float(line.split("=")[1].strip())
-    else:
+    try:
+        read_properties(properties_path)
+    except FileNotFoundError:
         return jsonify({'error': 'Properties file not found'}), 404
 
+    hips_ra, hips_dec, hips_fov = get_initial_view(properties_path)
+
     return jsonify({
         'hips_id': hips_id,
         'hips_ra': hips_ra,
@@ -989,18 +4424,9 @@ def shared_infos():
 def delete_shared_group(public_id):
     """
     Delete an entire shared HiPS group
-    and update shared_pages.json accordingly.
+    and remove it from the metadata store accordingly.
     """
-    metadata_path = os.path.join("shared-pages", "shared_pages.json")
-
-    if not os.path.exists(metadata_path):
-        flash("❌ No shared pages available")
-        return redirect("/web-pages")
-
-    with open(metadata_path, "r") as f:
-        data = json.load(f)
-
-    if public_id not in data:
+    if get_shared_page(public_id) is None:
         flash("❌ Shared page not found")
         return redirect("/web-pages")
 
@@ -1011,10 +4437,10 @@ def delete_shared_group(public_id):
     else:
         flash("❌ Group directory not found")
 
-    del data[public_id]
-
-    with open(metadata_path, "w") as f:
-        json.dump(data, f, indent=4)
+    db = get_db()
+    with db:
+        db.execute("DELETE FROM shared_pages WHERE public_id = ?",
+                   (public_id,))
 
     return redirect("/web-pages")
 
@@ -1035,13 +4461,22 @@ def search():
         return jsonify([])
 
     user_id = request.cookies.get('userID')
-    if not user_id or user_id not in user_files:
+    if not user_id:
         return jsonify([])
 
-    results = []
-    for file in user_files[user_id]:
-        if query.lower() in file['filename'].lower():
-            results.append(file)
+    results = [
+        {
+            "filename": row["filename"],
+            "hips_id": row["hips_id"],
+            "fileweight": round(row["size"] / (1024 * 1024), 2),
+        }
+        for row in get_db().execute(
+            "SELECT filename, hips_id, size FROM uploads "
+            "WHERE user_id = ? AND filename LIKE ? ESCAPE '\\' "
+            "ORDER BY created, filename",
+            (user_id, like_pattern(query)),
+        )
+    ]
 
     return jsonify(results)
 
@@ -1056,27 +4491,163 @@ def search_shared():
     if not query:
         return jsonify([])
 
-    metadata_path = os.path.join("shared-pages", "shared_pages.json")
-    if not os.path.exists(metadata_path):
-        return jsonify([])
+    results = [
+        {"file": row["name"], "public_id": row["public_id"]}
+        for row in get_db().execute(
+            "SELECT public_id, name FROM shared_hips "
+            "WHERE name LIKE ? ESCAPE '\\' ORDER BY public_id, position",
+            (like_pattern(query),),
+        )
+    ]
 
-    with open(metadata_path, "r") as f:
-        shared_data = json.load(f)
+    return jsonify(results)
 
-    results = []
-    for public_id, data in shared_data.items():
-        for file_name in data.get("files", []):
-            if query in file_name.lower():
-                results.append({
-                    "file": file_name,
-                    "public_id": public_id
-                })
 
-    return jsonify(results)
+def get_catalog_cmd(name, csv_path, ra_col, dec_col, score_col, output_dir):
+    """
+    Generate the command to create a catalog HiPS from a CSV file.
+
+    Returns:
+        list: Hipsgen-cat command line.
+    """
+    return [
+        'java', '-jar', 'Hipsgen-cat.jar',
+        '-cat', name,
+        '-in', csv_path,
+        '-ra', ra_col,
+        '-dec', dec_col,
+        '-score', score_col,
+        '-simple', '-lM', '11',
+        '-out', output_dir
+    ]
+
+
+def save_csv(csv_file, csv_path):
+    """
+    Stream an uploaded CSV file to disk, counting its rows.
+
+    Args:
+        csv_file (FileStorage): The uploaded file.
+        csv_path (str): Path of the file on disk.
+
+    Returns:
+        int: Number of rows, header excluded.
+    """
+    lines = 0
+    last = b'\n'
+    with open(csv_path, 'wb') as out:
+        for chunk in iter(
+            lambda: csv_file.stream.read(app.config['UPLOAD_CHUNK_SIZE']),
+            b'',
+        ):
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+            out.write(chunk)
+    if last != b'\n':
+        lines += 1
+    return max(lines - 1, 0)
+
+
+@job_target()
+def catalog_task(job_id, user_id, name, csv_path, columns, output_dir):
+    """
+    Background task generating a catalog HiPS, with the native builder or
+    Hipsgen-cat depending on `CATALOG_HIPS_ENGINE`.
+
+    The task holds the number of `rows` of the catalog (counted when it
+    was uploaded) and the number of `tiles` written. The native builder
+    also reports the rows read (`rows_read`) and the `progress` of the
+    job: the first half while the CSV file is read, the second half as
+    its rows are written to the tiles. Hipsgen-cat does not report its
+    progress, only its tiles are counted.
+
+    Args:
+        job_id (str): Unique identifier for the task.
+        user_id (str): Unique identifier for the user.
+        name (str): Name of the catalog.
+        csv_path (str): Path to the CSV file.
+        columns (tuple): RA, Dec and score column names.
+        output_dir (str): Path to the output catalog HiPS.
+    """
+    with progress_lock:
+        task_queue[job_id]["status"] = "running"
+
+    try:
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        if app.config['CATALOG_HIPS_ENGINE'] == 'native':
+            def check_cancel():
+                if hips_scheduler.is_cancelled(job_id):
+                    raise JobCancelled(job_id)
+
+            def progress(rows_read, rows_written=0, tiles=0):
+                with progress_lock:
+                    task = task_queue[job_id]
+                    read = (1.0 if rows_written else
+                            min(rows_read / max(task['rows'], 1), 1.0))
+                    task.update(
+                        rows_read=rows_read,
+                        tiles=tiles,
+                        progress=int(50 * read +
+                                     49 * rows_written / max(rows_read, 1)),
+                    )
+                publish_progress()
+
+            build_catalog_hips(csv_path, output_dir, *columns,
+                               name=f"{user_id}_{name}",
+                               check_cancel=check_cancel, progress=progress)
+        else:
+            cmd = get_catalog_cmd(f"{user_id}_{name}", csv_path, *columns,
+                                  output_dir)
+            counter = TileCounter(output_dir, ('.tsv',))
+
+            def report():
+                tiles = counter.count()
+                with progress_lock:
+                    task_queue[job_id]['tiles'] = tiles
+                publish_progress()
+
+            run_with_progress(cmd, job_id, report)
+            report()
+
+        db = get_db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO catalogs VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, name, *columns, time.time()),
+            )
+
+        with progress_lock:
+            task_queue[job_id]["progress"] = 100
+            task_queue[job_id]["status"] = "complete"
+
+    except JobCancelled:
+        with progress_lock:
+            task_queue[job_id]["progress"] = 100
+            task_queue[job_id]["status"] = "cancelled"
+
+    except Exception as e:
+        with progress_lock:
+            task_queue[job_id]["progress"] = 100
+            task_queue[job_id]["status"] = "error"
+
+        print("❌ Catalog task failed:", e)
 
 
 @app.route('/generate_catalog', methods=['POST'])
 def generate_catalog():
+    """
+    Queue the generation of a catalog HiPS from an uploaded CSV file.
+
+    The CSV file is streamed to disk and the job id is returned at once;
+    the progress of the job (`rows`, `tiles`) is read from `/get_progress`
+    with `hips_id=<job_id>`.
+
+    Returns:
+        Response: A JSON response with `job_id`, `hips_url` and `name`.
+    """
     user_id = request.cookies.get('userID')
     try:
         ra_col = request.form['ra_col']
@@ -1090,6 +4661,10 @@ def generate_catalog():
         original_filename = os.path.splitext(csv_file.filename)[0]
         safe_filename = secure_filename(original_filename)
 
+        job_id = f"catalog:{user_id}/{safe_filename}"
+        if hips_scheduler.is_active(job_id):
+            raise ValueError("Ce catalogue est déjà en cours de génération.")
+
         base_dir = os.path.join(
             'user_catalogs',
             secure_filename(user_id),
@@ -1100,38 +4675,148 @@ def generate_catalog():
         csv_path = os.path.join(base_dir, 'input.csv')
         output_dir = os.path.join(base_dir, 'hips')
 
-        if os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-        os.makedirs(output_dir, exist_ok=True)
-
-        csv_file.save(csv_path)
-
-        cmd = [
-            'java', '-jar', 'Hipsgen-cat.jar',
-            '-cat', f"{user_id}_{safe_filename}",
-            '-in', csv_path,
-            '-ra', ra_col,
-            '-dec', dec_col,
-            '-score', score_col,
-            '-simple', '-lM', '11',
-            '-out', output_dir
-        ]
-
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        rows = save_csv(csv_file, csv_path)
 
-        if result.returncode != 0:
-            raise RuntimeError(f"Hipsgen-cat failed:\n{result.stderr}")
+        if not hips_scheduler.submit(
+            job_id,
+            user_id,
+            catalog_task,
+            (job_id, user_id, safe_filename, csv_path,
+             (ra_col, dec_col, score_col), output_dir),
+            state={'rows': rows, 'rows_read': 0, 'tiles': 0},
+        ):
+            raise ValueError("Ce catalogue est déjà en cours de génération.")
 
         hips_url = f"/user_catalogs/{user_id}/{safe_filename}/hips"
-        return jsonify(success=True, hips_url=hips_url, name=safe_filename)
+        return jsonify(success=True, job_id=job_id, hips_url=hips_url,
+                       name=safe_filename)
 
     except Exception as e:
         return jsonify(success=False, error=str(e))
 
 
+def get_cutout_pool(reset=False):
+    """
+    Return the pool of cutout worker processes, started on first use.
+
+    The workers are spawned rather than forked from the threads of the
+    web server, and live as long as the web process: the numba kernels
+    are compiled once per worker by `warm_up`.
+
+    Args:
+        reset (bool): Replace the pool, after one of its workers died.
+
+    Returns:
+        ProcessPoolExecutor: The cutout pool.
+    """
+    global cutout_pool, cutout_slots
+    with cutout_pool_lock:
+        if cutout_slots is None:
+            # kept when the pool is replaced: the futures of the previous
+            # pool give their place back once they end
+            cutout_slots = BoundedSemaphore(
+                app.config['CUTOUT_WORKERS'] + app.config['CUTOUT_QUEUE'])
+        if reset and cutout_pool is not None:
+            cutout_pool.shutdown(wait=False, cancel_futures=True)
+            cutout_pool = None
+        if cutout_pool is None:
+            cutout_pool = ProcessPoolExecutor(
+                max_workers=app.config['CUTOUT_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=warm_up,
+                initargs=(app.config['CUTOUT_PIX2WORLD_WORKERS'],),
+            )
+        return cutout_pool
+
+
+@app.route('/cutout')
+def cutout():
+    """
+    Cut an image out of a HiPS with `hips2fits_cutout.generate`.
+
+    Query parameters: `hips_id` (`user_id/name`), `ra`, `dec` and `fov`
+    (degrees), `width` and `height` (pixels, 500 by default), `format`
+    (fits, png or jpg) and, for png and jpg, `stretch`, `cmap`, `min_cut`
+    and `max_cut` (values or percentiles such as `99.5%`).
+
+    The cutout runs in the cutout pool, and its content is sent back as
+    it comes from the worker, without going through a file.
+
+    At most `CUTOUT_QUEUE` cutouts wait for a worker: a cutout that
+    timed out cannot be stopped, and keeps its place until it ends.
+
+    Returns:
+        Response: The cutout, or a JSON error (400: invalid parameters,
+        404: unknown HiPS, 503: too many cutouts running, 504: the cutout
+        took too long).
+    """
+    args = request.args
+    hips_dir = safe_join('hips', args.get('hips_id', ''))
+    if not hips_dir or not os.path.exists(
+            os.path.join(hips_dir, 'properties')):
+        return jsonify(error='unknown HiPS'), 404
+
+    try:
+        ra = float(args['ra'])
+        dec = float(args['dec'])
+        fov = float(args['fov'])
+        width = int(args.get('width', 500))
+        height = int(args.get('height', 500))
+    except (KeyError, ValueError):
+        return jsonify(error='ra, dec and fov (degrees) are required, '
+                             'width and height are integers'), 400
+    img_format = args.get('format', 'fits').lower().replace('jpeg', 'jpg')
+    stretch = args.get('stretch', 'linear')
+    if img_format not in CUTOUT_MIMETYPES:
+        return jsonify(error=f"unknown format {img_format}"), 400
+    if stretch not in CUTOUT_STRETCHES:
+        return jsonify(error=f"unknown stretch {stretch}"), 400
+    if not (-90 <= dec <= 90 and 0 < fov <= 180 and width > 0 and
+            height > 0 and
+            width * height <= app.config['CUTOUT_MAX_PIXELS']):
+        return jsonify(error='dec, fov or image size out of range'), 400
+
+    pool = get_cutout_pool()
+    if not cutout_slots.acquire(blocking=False):
+        return jsonify(error='too many cutouts running, retry later'), 503
+    try:
+        future = pool.submit(
+            generate_bytes, ra, dec, fov, width, height, hips_dir,
+            format=img_format,
+            min_cut=args.get('min_cut'),
+            max_cut=args.get('max_cut'),
+            stretch=stretch,
+            cmap=args.get('cmap', 'Greys_r'),
+        )
+    except BaseException:
+        cutout_slots.release()
+        raise
+    future.add_done_callback(lambda _: cutout_slots.release())
+    try:
+        data = future.result(timeout=app.config['CUTOUT_TIMEOUT_S'])
+    except FutureTimeout:
+        # only stops a cutout still waiting for a worker
+        future.cancel()
+        return jsonify(error='cutout timed out'), 504
+    except BrokenProcessPool:
+        get_cutout_pool(reset=True)
+        return jsonify(error='cutout worker died'), 500
+    except FileNotFoundError:
+        return jsonify(error='HiPS tiles not found'), 404
+    except (KeyError, ValueError) as e:
+        return jsonify(error=str(e)), 400
+
+    return Response(
+        data,
+        mimetype=CUTOUT_MIMETYPES[img_format],
+        headers={'Content-Disposition':
+                 f'inline; filename="cutout.{img_format}"'},
+    )
+
+
 @app.route('/user_catalogs/<path:filename>')
 def serve_user_catalog(filename):
-    return send_from_directory('user_catalogs', filename)
+    return send_tile('user_catalogs', filename)
 
 
 @app.errorhandler(413)
@@ -1150,4 +4835,13 @@ def too_large(e):
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    if sys.argv[1:] == ["worker"]:
+        # job worker only: `JOB_IN_PROCESS_WORKERS = False` in the web app
+        init_db()
+        check_partition_hosts()
+        remove_orphan_project_inputs()
+        hips_scheduler.start()
+        print(f"🆗 job worker {hips_scheduler.owner} started")
+        Event().wait()
+    else:
+        app.run(debug=True)
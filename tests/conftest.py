@@ -0,0 +1,21 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """A new app module, working in an empty application folder."""
+    monkeypatch.chdir(tmp_path)
+    os.symlink(os.path.join(ROOT, "tools"), "tools")
+    # imported again, so that no state is shared between the tests
+    monkeypatch.delitem(sys.modules, "app", raising=False)
+    app = importlib.import_module("app")
+    monkeypatch.setitem(app.app.config, 'JOB_IN_PROCESS_WORKERS', False)
+    app.init_db()
+    return app
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+
+def test_hips_name(app_module):
+    assert app_module.hips_name("my field") == "my_field"
+    assert app_module.hips_name("../../uploads") == "uploads"
+    for name in ("", ".", "..", "/"):
+        assert app_module.hips_name(name) is None
+
+
+def test_check_hips_folder(app_module):
+    os.makedirs(os.path.join("hips", "user", "field"))
+    os.makedirs("uploads")
+    app_module.check_hips_folder(os.path.join("hips", "user", "field"))
+    app_module.check_hips_folder(os.path.join("hips", "user", "new"))
+    for folder in (os.path.join("hips", "user"),
+                   os.path.join("hips", "user", "."),
+                   os.path.join("hips", "user", ".."),
+                   os.path.join("hips", "user", "..", "..", "uploads"),
+                   os.path.join("hips", "..", "uploads")):
+        with pytest.raises(ValueError):
+            app_module.check_hips_folder(folder)
+    os.symlink(os.path.abspath("uploads"), os.path.join("hips", "user", "up"))
+    with pytest.raises(ValueError):
+        app_module.check_hips_folder(os.path.join("hips", "user", "up"))
+
+
+def _make_hips(folder, size):
+    os.makedirs(folder)
+    with open(os.path.join(folder, "properties"), "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_cache_evicts_least_recently_used(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'HIPS_CACHE_MAX_BYTES', 250)
+    keys = [str(i) * 64 for i in range(3)]
+    for key in keys[:2]:
+        _make_hips(os.path.join("hips", "user", key[:1]), 100)
+        app_module.store_hips_in_cache(key, os.path.join("hips", "user",
+                                                         key[:1]))
+    assert app_module.restore_hips_from_cache(
+        keys[0], os.path.join("hips", "user", "copy"))
+
+    _make_hips(os.path.join("hips", "user", "2"), 100)
+    app_module.store_hips_in_cache(keys[2], os.path.join("hips", "user", "2"))
+
+    assert sorted(os.listdir("hips_cache")) == [keys[0], keys[2]]
+    assert not app_module.restore_hips_from_cache(
+        keys[1], os.path.join("hips", "user", "copy"))
+    # the HiPS linked from the evicted entry keep their files
+    with open(os.path.join("hips", "user", "1", "properties"), "rb") as f:
+        assert f.read() == b"x" * 100
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord, angular_separation
+
+from tools import hips2fits_cutout
+
+
+def _pix2world_state(*args, **kwargs):
+    # the pool a make_cutout of this worker would use
+    return repr((hips2fits_cutout.PIX2WORLD_WORKERS,
+                 hips2fits_cutout._pix2world_pool)).encode()
+
+
+def test_list_workers_have_no_pix2world_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(hips2fits_cutout, 'generate_bytes', _pix2world_state)
+    rows = [(i, str(tmp_path / f"{i}.fits"), dict(
+        ra=0, dec=0, fov=1, width=10, height=10, hips='hips', format='fits',
+        min_cut=None, max_cut=None, stretch='linear', cmap='Greys_r'))
+        for i in range(4)]
+    chunks = [rows[:2], rows[2:]]
+
+    for result in hips2fits_cutout._pool_results(chunks, 2, False):
+        for row_id, output, _, status, error in result:
+            assert status == 'ok', error
+            assert (tmp_path / f"{row_id}.fits").read_text() == "(1, None)"
+    assert hips2fits_cutout._lost_rows(rows[:1], False)[0][3] == 'ok'
+    assert (tmp_path / "0.fits").read_text() == "(1, None)"
+    assert hips2fits_cutout.PIX2WORLD_WORKERS > 1
+
+
+@pytest.mark.parametrize('coordsys', ['icrs', 'galactic'])
+@pytest.mark.parametrize('hips_frame', ['equatorial', 'galactic'])
+@pytest.mark.parametrize('ra, dec', [(83.6, 22.0), (210.0, -60.0),
+                                     (40.0, 89.9), (300.0, -89.95)])
+def test_pix2world_deg_matches_astropy(coordsys, hips_frame, ra, dec):
+    center = SkyCoord(ra, dec, unit='deg', frame='icrs')
+    wcs = hips2fits_cutout._create_wcs_object(center, 64, 48, 1.0, coordsys)
+    xv, yv = np.meshgrid(np.arange(0, 64), np.arange(0, 48))
+
+    lon, lat = hips2fits_cutout.pix2world_deg(wcs, xv, yv, hips_frame)
+    ref_lon, ref_lat = hips2fits_cutout.compute_pix2world(wcs, xv, yv,
+                                                          hips_frame)
+
+    assert np.all((lon >= 0) & (lon < 360))
+    # the distance, longitudes being meaningless at the poles
+    separation = angular_separation(np.radians(lon), np.radians(lat),
+                                    ref_lon.rad, ref_lat.rad)
+    assert np.degrees(separation).max() < 1e-9
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+from mocpy import MOC
+
+
+def _moc(order, cells):
+    cells = np.asarray(cells, dtype=np.uint64)
+    return MOC.from_healpix_cells(
+        cells, np.full(len(cells), order, dtype=np.uint8), order)
+
+
+def test_partition_moc_balances_contiguous_regions(app_module):
+    order = 9
+    rng = np.random.default_rng(1)
+    tiles = np.unique(np.concatenate([
+        np.arange(1000, 60000),
+        rng.integers(200000, 3000000, 20000),
+    ]))
+    moc = _moc(order, tiles)
+
+    part_order, regions = app_module.partition_moc(moc, 4)
+
+    assert len(regions) == 4
+    cells = np.concatenate(regions)
+    assert np.all(np.diff(cells) > 0)  # contiguous, in NESTED order
+    shift = 2 * (order - part_order)
+    assert set(cells) == set(tiles >> shift)
+    counts = [np.isin(tiles >> shift, r).sum() for r in regions]
+    assert sum(counts) == len(tiles)
+    assert max(counts) < 2 * len(tiles) / 4
+
+
+def test_partition_moc_small_moc(app_module):
+    part_order, regions = app_module.partition_moc(_moc(2, [5, 6, 7]), 4)
+    assert part_order == 2
+    assert sorted(np.concatenate(regions)) == [5, 6, 7]
+
+
+def _write_tile(hips_dir, order, npix):
+    folder = os.path.join(hips_dir, f"Norder{order}",
+                          f"Dir{(npix // 10000) * 10000}")
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"Npix{npix}.fits")
+    with open(path, "w") as f:
+        f.write(str(npix))
+    return path
+
+
+def test_merge_region_keeps_tiles_of_its_cells(app_module, tmp_path):
+    region_dir = str(tmp_path / "region")
+    hips_dir = str(tmp_path / "hips")
+    # cell 1 of order 3 holds the tiles 4..7 of order 4
+    for order, npix in [(2, 0), (3, 1), (3, 2), (4, 5), (4, 9)]:
+        _write_tile(region_dir, order, npix)
+
+    app_module._merge_region(region_dir, hips_dir, 3, [1])
+
+    merged = sorted(
+        os.path.relpath(os.path.join(d, f), hips_dir)
+        for d, _, files in os.walk(hips_dir) for f in files)
+    assert merged == ["Norder3/Dir0/Npix1.fits", "Norder4/Dir0/Npix5.fits"]
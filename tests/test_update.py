@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+from mocpy import MOC
+
+
+def _moc(order, cells):
+    cells = np.asarray(cells, dtype=np.uint64)
+    return MOC.from_healpix_cells(
+        cells, np.full(len(cells), order, dtype=np.uint8), order)
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # in place, as Hipsgen does
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _contents(folder):
+    result = {}
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                result[os.path.relpath(path, folder)] = f.read()
+    return result
+
+
+def _make_hips(hips_dir):
+    _write(os.path.join(hips_dir, "properties"), "hips_order = 3\n")
+    _write(os.path.join(hips_dir, "Norder2", "Allsky.fits"), "old")
+    _write(os.path.join(hips_dir, "Norder2", "Dir0", "Npix1.fits"), "old")
+    for npix in (4, 6, 7):
+        _write(os.path.join(hips_dir, "Norder3", "Dir0", f"Npix{npix}.fits"),
+               "old")
+    _write(os.path.join(hips_dir, "HpxFinder", "Norder3", "Dir0", "Npix4"),
+           '{ "path": "a.fits" }')
+    _moc(3, [4, 6, 7]).save(os.path.join(hips_dir, "Moc.fits"),
+                            format='fits')
+    _moc(3, [4, 6, 7]).save(os.path.join(hips_dir, "HpxFinder", "Moc.fits"),
+                            format='fits')
+
+
+def test_update_keeps_shared_copy(app_module, monkeypatch):
+    app = app_module
+    hips_id = "u1/project"
+    hips_dir = os.path.join("hips", hips_id)
+    _make_hips(hips_dir)
+    shared_dir = os.path.join("shared-pages", "page")
+    os.makedirs("shared-pages")
+    app.link_tree(hips_dir, shared_dir)
+    shared = _contents(shared_dir)
+
+    os.makedirs("inputs")
+    for name in ("a.fits", "b.fits"):
+        fits.PrimaryHDU(np.zeros((4, 4), dtype=np.float32)).writeto(
+            os.path.join("inputs", name))
+
+    def fake_index(output_folder, fits_file, *args, **kwargs):
+        _write(os.path.join(output_folder, "HpxFinder", "Norder3", "Dir0",
+                            "Npix5"), '{ "path": "b.fits" }')
+        _moc(3, [5]).save(os.path.join(output_folder, "HpxFinder",
+                                       "Moc.fits"), format='fits')
+        return True
+
+    def fake_hipsgen(command, *args, **kwargs):
+        out = next(a[4:] for a in command if a.startswith("out="))
+        if "TILES" in command:
+            _write(os.path.join(out, "Norder3", "Dir0", "Npix5.fits"), "new")
+        else:
+            # the tree step also rewrites a neighbour of the region
+            for path in ("Norder3/Dir0/Npix6.fits", "Norder2/Dir0/Npix1.fits",
+                         "Norder2/Allsky.fits", "properties"):
+                _write(os.path.join(out, path), "new")
+
+    monkeypatch.setattr(app, "generate_fits_index", fake_index)
+    monkeypatch.setattr(app, "run_with_progress", fake_hipsgen)
+
+    app.update_task(hips_id, "inputs", [os.path.join("inputs", "b.fits")],
+                    "u1", "key", [os.path.join("inputs", "a.fits"),
+                                  os.path.join("inputs", "b.fits")])
+
+    assert app.task_queue[hips_id]["status"] == "complete"
+    assert _contents(shared_dir) == shared
+    updated = _contents(hips_dir)
+    for path in ("Norder3/Dir0/Npix5.fits", "Norder3/Dir0/Npix6.fits",
+                 "Norder2/Dir0/Npix1.fits", "Norder2/Allsky.fits"):
+        assert updated[path] == b"new"
+    assert updated["Norder3/Dir0/Npix4.fits"] == b"old"
+    assert b"hips_order" in updated["properties"]
+    assert not os.path.exists(os.path.join("hips", ".update", hips_id))
+
+
+def test_cancelled_update_keeps_hips(app_module, monkeypatch):
+    app = app_module
+    hips_id = "u1/project"
+    hips_dir = os.path.join("hips", hips_id)
+    _make_hips(hips_dir)
+    before = _contents(hips_dir)
+    os.makedirs("inputs")
+    fits.PrimaryHDU(np.zeros((4, 4), dtype=np.float32)).writeto(
+        os.path.join("inputs", "b.fits"))
+
+    def fake_index(output_folder, fits_file, *args, **kwargs):
+        _write(os.path.join(output_folder, "HpxFinder", "Norder3", "Dir0",
+                            "Npix5"), '{ "path": "b.fits" }')
+        _moc(3, [5]).save(os.path.join(output_folder, "HpxFinder",
+                                       "Moc.fits"), format='fits')
+        return True
+
+    def cancelled_hipsgen(command, hips_id, *args, **kwargs):
+        out = next(a[4:] for a in command if a.startswith("out="))
+        _write(os.path.join(out, "Norder3", "Dir0", "Npix5.fits"), "new")
+        _write(os.path.join(out, "Norder3", "Dir0", "Npix6.fits"), "new")
+        raise app.JobCancelled(hips_id)
+
+    monkeypatch.setattr(app, "generate_fits_index", fake_index)
+    monkeypatch.setattr(app, "run_with_progress", cancelled_hipsgen)
+
+    app.update_task(hips_id, "inputs", [os.path.join("inputs", "b.fits")],
+                    "u1", "key", [os.path.join("inputs", "b.fits")])
+
+    assert app.task_queue[hips_id]["status"] == "cancelled"
+    assert _contents(hips_dir) == before
+
+
+def test_cancelled_queued_update_keeps_hips_complete(app_module):
+    app = app_module
+    hips_id = "u1/project"
+    _make_hips(os.path.join("hips", hips_id))
+    os.makedirs("inputs")
+    paths = []
+    for name in ("a.fits", "b.fits"):
+        paths.append(os.path.join("inputs", name))
+        fits.PrimaryHDU(np.zeros((4, 4), dtype=np.float32)).writeto(
+            paths[-1])
+    app.record_hips_inputs(hips_id, paths[:1])
+    app.record_hips(hips_id, "complete")
+    assert app.project_new_files(hips_id, paths) == paths[1:]
+
+    assert app.hips_scheduler.submit(
+        hips_id, "u1", app.update_task,
+        (hips_id, "inputs", paths[1:], "u1", None, paths))
+    app.record_hips(hips_id, "queued")
+    assert app.hips_scheduler.cancel(hips_id)
+
+    row = app.get_db().execute("SELECT status FROM hips WHERE hips_id = ?",
+                               (hips_id,)).fetchone()
+    assert row["status"] == "complete"
+    assert app.project_new_files(hips_id, paths) == paths[1:]
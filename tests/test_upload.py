@@ -0,0 +1,49 @@
+import hashlib
+import io
+import os
+
+import numpy as np
+from astropy.io import fits
+
+
+def _fits_bytes():
+    data = io.BytesIO()
+    fits.PrimaryHDU(np.zeros((30, 30), dtype=np.float32)).writeto(data)
+    return data.getvalue()
+
+
+def test_upload_not_completed_while_a_chunk_is_written(app_module,
+                                                       monkeypatch):
+    client = app_module.app.test_client()
+    client.set_cookie('userID', 'u1')
+    content = _fits_bytes()
+    upload_id = client.post("/upload/init", data={
+        'filename': "a.fits", 'size': len(content), 'chunk_size': 2880,
+    }).json['upload_id']
+
+    def put(index):
+        chunk = content[index * 2880:(index + 1) * 2880]
+        return client.put(
+            f"/upload/{upload_id}/{index}", data=chunk,
+            headers={'X-Chunk-Sha256': hashlib.sha256(chunk).hexdigest()})
+
+    for index in range(len(content) // 2880):
+        assert put(index).status_code == 200
+
+    completed = []
+    pwrite = os.pwrite
+
+    def completing_pwrite(fd, data, offset):
+        # a chunk sent again, being written when the upload is completed
+        completed.append(client.post(f"/upload/{upload_id}/complete"))
+        return pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, "pwrite", completing_pwrite)
+    assert put(0).status_code == 200
+    monkeypatch.setattr(os, "pwrite", pwrite)
+    assert completed[0].status_code == 409
+
+    response = client.post(f"/upload/{upload_id}/complete")
+    assert response.status_code == 200
+    with open(os.path.join("uploads", "u1", "a.fits"), "rb") as f:
+        assert f.read() == content
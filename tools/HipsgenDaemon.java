@@ -0,0 +1,391 @@
+/*
+ * Long-lived Hipsgen worker.
+ *
+ * Keeps a JVM running between Hipsgen jobs, so that small jobs do not pay
+ * the JVM startup and JIT warmup of a new `java -jar Hipsgen.jar` process
+ * each time. Started by app.py (JDK 16 or later, source-file mode):
+ *
+ *     java -Xmx2g tools/HipsgenDaemon.java <socket path>
+ *
+ * Protocol, over the Unix socket, one job per connection:
+ *
+ *     client: <path of the jar>\n<arg 1>\n...<arg n>\n\n
+ *     daemon: BUSY\n                     when a job is already running
+ *     daemon: OK\n<output lines>@@EXIT <code>\n
+ *
+ * Jobs run one at a time, since Hipsgen keeps some static state. Each job
+ * runs in its own thread group, so that the threads started by Hipsgen
+ * are known. The exit code is sent, and the next job accepted, once all
+ * of them ended. The exit code is 1 when the job threw, when it logged an
+ * error, or when Hipsgen reports it aborted, and 130 when it was
+ * cancelled.
+ *
+ * Closing the client side of the connection cancels the running job:
+ * Hipsgen is asked to abort and its threads are interrupted. When they
+ * do not end within STOP_TIMEOUT_MS, the daemon exits, so that no thread
+ * of a cancelled job keeps writing to its HiPS, and is started again by
+ * the client.
+ */
+
+import java.io.ByteArrayOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.Field;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.StandardProtocolFamily;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.net.UnixDomainSocketAddress;
+import java.nio.channels.Channels;
+import java.nio.channels.ServerSocketChannel;
+import java.nio.channels.SocketChannel;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.Locale;
+import java.util.Map;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.jar.JarFile;
+
+public class HipsgenDaemon {
+
+    private static final long STOP_TIMEOUT_MS = 30_000;
+    private static final Map<String, Class<?>> MAIN_CLASSES = new ConcurrentHashMap<>();
+    private static final InheritableThreadLocal<PrintStream> JOB_OUT = new InheritableThreadLocal<>();
+    private static boolean busy = false;
+
+    public static void main(String[] args) throws IOException {
+        Path path = Path.of(args[0]);
+        Files.deleteIfExists(path);
+
+        PrintStream console = System.out;
+        PrintStream dispatch = new PrintStream(new OutputStream() {
+            private PrintStream target() {
+                PrintStream out = JOB_OUT.get();
+                return out != null ? out : console;
+            }
+
+            @Override
+            public void write(int b) {
+                target().write(b);
+            }
+
+            @Override
+            public void write(byte[] b, int off, int len) {
+                target().write(b, off, len);
+            }
+
+            @Override
+            public void flush() {
+                target().flush();
+            }
+        }, true);
+        System.setOut(dispatch);
+        System.setErr(dispatch);
+
+        try (ServerSocketChannel server = ServerSocketChannel.open(StandardProtocolFamily.UNIX)) {
+            server.bind(UnixDomainSocketAddress.of(path));
+            path.toFile().setReadable(false, false);
+            path.toFile().setWritable(false, false);
+            path.toFile().setReadable(true, true);
+            path.toFile().setWritable(true, true);
+            console.println("Hipsgen daemon listening on " + path);
+            while (true) {
+                SocketChannel client = server.accept();
+                new Thread(() -> handle(client)).start();
+            }
+        }
+    }
+
+    private static Class<?> mainClass(String jar) throws Exception {
+        Class<?> cls = MAIN_CLASSES.get(jar);
+        if (cls == null) {
+            String name;
+            try (JarFile file = new JarFile(jar)) {
+                name = file.getManifest().getMainAttributes().getValue("Main-Class");
+            }
+            URLClassLoader loader = new URLClassLoader(
+                new URL[] {Path.of(jar).toUri().toURL()},
+                HipsgenDaemon.class.getClassLoader());
+            cls = Class.forName(name, true, loader);
+            MAIN_CLASSES.put(jar, cls);
+        }
+        return cls;
+    }
+
+    /**
+     * A Hipsgen job: the generator instance when the main class has an
+     * `execute` method (HipsGen.main may exit the JVM, execute does not),
+     * and the outcome of the run.
+     */
+    private static class Job implements Runnable {
+        final Class<?> cls;
+        final String[] args;
+        final PrintStream out;
+        final Object generator;
+        volatile boolean cancelled = false;
+        volatile int code = 0;
+
+        Job(Class<?> cls, String[] args, PrintStream out) throws Exception {
+            this.cls = cls;
+            this.args = args;
+            this.out = out;
+            Object instance = null;
+            try {
+                cls.getMethod("execute", String[].class);
+                instance = cls.getDeclaredConstructor().newInstance();
+            } catch (NoSuchMethodException e) {
+                // static main only
+            }
+            this.generator = instance;
+        }
+
+        @Override
+        public void run() {
+            try {
+                if (generator != null) {
+                    cls.getMethod("execute", String[].class).invoke(generator, (Object) args);
+                } else {
+                    cls.getMethod("main", String[].class).invoke(null, (Object) args);
+                }
+                if (Boolean.TRUE.equals(callHook(context(), "isTaskAborting"))) {
+                    code = 1;
+                }
+            } catch (InvocationTargetException e) {
+                e.getCause().printStackTrace(out);
+                code = 1;
+            } catch (Exception e) {
+                e.printStackTrace(out);
+                code = 1;
+            }
+        }
+
+        Object context() {
+            if (generator == null) {
+                return null;
+            }
+            for (Class<?> c = generator.getClass(); c != null; c = c.getSuperclass()) {
+                try {
+                    Field field = c.getDeclaredField("context");
+                    field.setAccessible(true);
+                    return field.get(generator);
+                } catch (ReflectiveOperationException | RuntimeException e) {
+                    // not in this class
+                }
+            }
+            return null;
+        }
+
+        /** Ask Hipsgen to stop, through the first abort hook found. */
+        void abort() {
+            cancelled = true;
+            for (Object target : new Object[] {context(), generator}) {
+                for (String name : new String[] {"taskAbort", "setStopped", "abort", "stop"}) {
+                    if (callHook(target, name) != null) {
+                        return;
+                    }
+                }
+            }
+        }
+    }
+
+    /**
+     * Call a method without arguments, or with `true`, on an object.
+     *
+     * @return the result of the method (Boolean.TRUE for void methods),
+     *         null when the object has no such method or it failed.
+     */
+    private static Object callHook(Object target, String name) {
+        if (target == null) {
+            return null;
+        }
+        for (Class<?> c = target.getClass(); c != null; c = c.getSuperclass()) {
+            for (Method method : c.getDeclaredMethods()) {
+                if (!method.getName().equals(name) || method.getParameterCount() > 1) {
+                    continue;
+                }
+                Class<?>[] types = method.getParameterTypes();
+                if (types.length == 1 && types[0] != boolean.class) {
+                    continue;
+                }
+                try {
+                    method.setAccessible(true);
+                    Object result = types.length == 0
+                        ? method.invoke(target)
+                        : method.invoke(target, true);
+                    return method.getReturnType() == void.class ? Boolean.TRUE : result;
+                } catch (ReflectiveOperationException | RuntimeException e) {
+                    return null;
+                }
+            }
+        }
+        return null;
+    }
+
+    /**
+     * Wait for the threads of a job to end, interrupting them when the
+     * job was cancelled.
+     *
+     * @return false if some threads were still running at the deadline.
+     */
+    private static boolean awaitThreads(ThreadGroup group, Job job, long deadline)
+            throws InterruptedException {
+        while (true) {
+            Thread[] threads = new Thread[group.activeCount() + 8];
+            int n = group.enumerate(threads, true);
+            if (n == 0) {
+                return true;
+            }
+            for (int i = 0; i < n; i++) {
+                if (job.cancelled) {
+                    threads[i].interrupt();
+                }
+                long left = deadline - System.currentTimeMillis();
+                if (left <= 0) {
+                    return false;
+                }
+                threads[i].join(Math.min(left, 1000));
+            }
+        }
+    }
+
+    /**
+     * Output of a job, sent to the client, that remembers whether Hipsgen
+     * logged an error: Hipsgen logs some failures without throwing.
+     */
+    private static class JobOutput extends OutputStream {
+        private final OutputStream target;
+        private final ByteArrayOutputStream line = new ByteArrayOutputStream();
+        volatile boolean error = false;
+
+        JobOutput(OutputStream target) {
+            this.target = target;
+        }
+
+        @Override
+        public synchronized void write(int b) throws IOException {
+            target.write(b);
+            if (b == '\n') {
+                String text = line.toString(StandardCharsets.UTF_8).trim().toUpperCase(Locale.ROOT);
+                if (text.startsWith("ERROR") || text.startsWith("*** ERROR")
+                        || text.contains("EXCEPTION")) {
+                    error = true;
+                }
+                line.reset();
+            } else if (line.size() < 256) {
+                line.write(b);
+            }
+        }
+
+        @Override
+        public synchronized void write(byte[] b, int off, int len) throws IOException {
+            for (int i = off; i < off + len; i++) {
+                write(b[i]);
+            }
+        }
+
+        @Override
+        public synchronized void flush() throws IOException {
+            target.flush();
+        }
+    }
+
+    private static String readLine(InputStream in) throws IOException {
+        ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+        int c;
+        while ((c = in.read()) != -1 && c != '\n') {
+            bytes.write(c);
+        }
+        if (c == -1 && bytes.size() == 0) {
+            return null;
+        }
+        return bytes.toString(StandardCharsets.UTF_8);
+    }
+
+    private static void handle(SocketChannel client) {
+        try (client) {
+            InputStream in = Channels.newInputStream(client);
+            PrintStream reply = new PrintStream(Channels.newOutputStream(client), true, StandardCharsets.UTF_8);
+
+            String jar = readLine(in);
+            List<String> args = new ArrayList<>();
+            for (String line; (line = readLine(in)) != null && !line.isEmpty(); ) {
+                args.add(line);
+            }
+            if (jar == null) {
+                return;
+            }
+
+            synchronized (HipsgenDaemon.class) {
+                if (busy) {
+                    reply.println("BUSY");
+                    return;
+                }
+                busy = true;
+            }
+
+            try {
+                reply.println("OK");
+                JobOutput output = new JobOutput(reply);
+                PrintStream out = new PrintStream(output, true, StandardCharsets.UTF_8);
+                Job job;
+                try {
+                    job = new Job(mainClass(jar), args.toArray(new String[0]), out);
+                } catch (Exception e) {
+                    e.printStackTrace(out);
+                    reply.println("@@EXIT 1");
+                    return;
+                }
+
+                ThreadGroup group = new ThreadGroup("hipsgen-job");
+                JOB_OUT.set(out);
+                Thread runner = new Thread(group, job, "hipsgen-job");
+                JOB_OUT.remove();
+
+                Thread watcher = new Thread(() -> {
+                    try {
+                        while (in.read() != -1) {
+                        }
+                    } catch (IOException e) {
+                        // connection closed
+                    }
+                    if (runner.isAlive() || group.activeCount() > 0) {
+                        job.abort();
+                        group.interrupt();
+                    }
+                });
+                watcher.setDaemon(true);
+
+                runner.start();
+                watcher.start();
+                runner.join();
+
+                long deadline = System.currentTimeMillis() + STOP_TIMEOUT_MS;
+                if (!awaitThreads(group, job, deadline)) {
+                    out.println("Hipsgen threads still running, restarting the daemon");
+                    out.flush();
+                    Runtime.getRuntime().halt(1);
+                }
+
+                int code = job.cancelled ? 130 : job.code;
+                if (code == 0 && output.error) {
+                    code = 1;
+                }
+                reply.println("@@EXIT " + code);
+            } catch (InterruptedException e) {
+                Runtime.getRuntime().halt(1);
+            } finally {
+                synchronized (HipsgenDaemon.class) {
+                    busy = false;
+                }
+            }
+        } catch (IOException e) {
+            // client gone
+        }
+    }
+}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Benchmark of the native catalog HiPS builder against Hipsgen-cat.
+
+Random catalogs (uniform on the sphere) are written for each size, then
+built with `catalog_hips.py` and, when java and the jar are available,
+with Hipsgen-cat using the options of the web application.
+
+Usage:
+    python bench_catalog_hips.py [-jar Hipsgen-cat.jar] [-dir bench]
+        [sizes...]
+
+Sizes default to 1000000 10000000 50000000 rows.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from catalog_hips import build_catalog_hips
+
+DEFAULT_SIZES = [1_000_000, 10_000_000, 50_000_000]
+WRITE_ROWS = 1_000_000
+
+
+def write_catalog(path, nrows, seed=0):
+    """Write a random catalog of `nrows` rows with id, ra, dec and mag."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        f.write('id,ra,dec,mag\n')
+        for first in range(0, nrows, WRITE_ROWS):
+            n = min(WRITE_ROWS, nrows - first)
+            table = np.column_stack((
+                np.arange(first, first + n),
+                rng.uniform(0, 360, n),
+                np.degrees(np.arcsin(rng.uniform(-1, 1, n))),
+                rng.uniform(5, 22, n),
+            ))
+            np.savetxt(f, table, fmt=('%d', '%.7f', '%.7f', '%.3f'),
+                       delimiter=',')
+
+
+def run_native(csv_path, output_dir):
+    """Build with the native builder, return the elapsed time (s)."""
+    start = time.time()
+    build_catalog_hips(csv_path, output_dir, 'ra', 'dec', 'mag')
+    return time.time() - start
+
+
+def run_jar(jar, csv_path, output_dir):
+    """Build with Hipsgen-cat, return the elapsed time (s)."""
+    start = time.time()
+    subprocess.run(
+        ['java', '-jar', jar, '-cat', 'bench', '-in', csv_path,
+         '-ra', 'ra', '-dec', 'dec', '-score', 'mag',
+         '-simple', '-lM', '11', '-out', output_dir],
+        check=True, stdout=subprocess.DEVNULL,
+    )
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    jar = 'Hipsgen-cat.jar'
+    bench_dir = 'bench'
+    if '-jar' in args:
+        i = args.index('-jar')
+        jar = args[i + 1]
+        del args[i:i + 2]
+    if '-dir' in args:
+        i = args.index('-dir')
+        bench_dir = args[i + 1]
+        del args[i:i + 2]
+    sizes = [int(arg) for arg in args] or DEFAULT_SIZES
+
+    use_jar = os.path.exists(jar) and shutil.which('java') is not None
+    if not use_jar:
+        print(f"java or {jar} not found, only the native builder is run")
+
+    os.makedirs(bench_dir, exist_ok=True)
+    print(f"{'rows':>12} {'native (s)':>12} {'hipsgen-cat (s)':>16}")
+    for nrows in sizes:
+        csv_path = os.path.join(bench_dir, f"cat_{nrows}.csv")
+        if not os.path.exists(csv_path):
+            write_catalog(csv_path, nrows)
+
+        out = os.path.join(bench_dir, 'native')
+        shutil.rmtree(out, ignore_errors=True)
+        native = run_native(csv_path, out)
+
+        jar_time = float('nan')
+        if use_jar:
+            out = os.path.join(bench_dir, 'hipsgen-cat')
+            shutil.rmtree(out, ignore_errors=True)
+            jar_time = run_jar(jar, csv_path, out)
+
+        print(f"{nrows:>12} {native:>12.1f} {jar_time:>16.1f}")
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+"""
+Catalog HiPS builder, an in-process alternative to Hipsgen-cat.
+
+The CSV file is memory-mapped and read in blocks: the RA, Dec and score
+columns are parsed with numpy and the HEALPix index of each row is
+computed with cdshealpix. Only the byte offsets of the rows are kept in
+memory, the rows themselves are copied from the CSV file to the tiles.
+
+Rows are ranked by ascending score. Each tile of order `MIN_ORDER` keeps
+its best `ALLSKY_TILE_SIZE` rows, the other rows go down to the tiles of
+the next orders (`TILE_SIZE` rows per tile), and all remaining rows are
+written at `max_order`. The output follows the layout written by
+Hipsgen-cat and read by Aladin Lite:
+
+    properties, Metadata.xml, Moc.fits
+    Norder1/Allsky.tsv, Norder2/Allsky.tsv
+    Norder<k>/Dir<d>/Npix<n>.tsv
+
+Each tile starts with a `# Completeness = <n> / <total>` line, <n> being
+the number of rows of the tile area written up to this order, followed
+by the header line.
+
+Usage:
+    python catalog_hips.py <input.csv> <output_dir> <ra_col> <dec_col>
+        <score_col> [name]
+"""
+
+import csv
+import io
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import Latitude, Longitude
+from cdshealpix.nested import lonlat_to_healpix
+from mocpy import MOC
+
+MIN_ORDER = 1
+MAX_ORDER = 11
+ALLSKY_ORDERS = (1, 2)
+ALLSKY_TILE_SIZE = 100
+TILE_SIZE = 500
+BLOCK_SIZE = 64 * 1024 * 1024  # bytes of CSV parsed at once
+PROGRESS_TILES = 1000  # tiles written between two progress reports
+
+
+def _tile_capacity(order, max_order):
+    """Return the number of rows kept in a tile of `order`."""
+    if order >= max_order:
+        return np.iinfo(np.int64).max
+    if order in ALLSKY_ORDERS:
+        return ALLSKY_TILE_SIZE
+    return TILE_SIZE
+
+
+def _parse_values(lines, indexes):
+    """
+    Parse the RA, Dec and score columns of CSV lines.
+
+    Values which are missing or not numbers are returned as NaN.
+
+    Args:
+        lines (list): Lines of the CSV file, as str.
+        indexes (tuple): Indexes of the RA, Dec and score columns.
+
+    Returns:
+        numpy.ndarray: Array of shape (len(lines), 3).
+    """
+    try:
+        values = np.loadtxt(
+            io.StringIO('\n'.join(lines)), delimiter=',', quotechar='"',
+            usecols=indexes, comments=None, dtype=np.float64, ndmin=2,
+        )
+        if len(values) == len(lines):
+            return values
+    except ValueError:
+        pass
+
+    values = np.full((len(lines), 3), np.nan)
+    for i, row in enumerate(csv.reader(lines)):
+        for j, k in enumerate(indexes):
+            try:
+                values[i, j] = float(row[k])
+            except (IndexError, ValueError):
+                pass
+    return values
+
+
+def read_catalog(mm, start, indexes, check_cancel=None, progress=None):
+    """
+    Read the rows of a memory-mapped CSV file.
+
+    Args:
+        mm (mmap.mmap): The CSV file.
+        start (int): Offset of the first row, after the header.
+        indexes (tuple): Indexes of the RA, Dec and score columns.
+        check_cancel (callable): Called after each block, raises to stop.
+        progress (callable): Called with the number of rows read
+            (`rows_read=`).
+
+    Returns:
+        tuple: (starts, ends, values) arrays. `starts` and `ends` are the
+        byte offsets of the rows, `values` holds the RA, Dec and score of
+        each row. Rows without valid coordinates are skipped.
+    """
+    size = len(mm)
+    starts, ends, values = [], [], []
+    nrows = 0
+    pos = start
+    while pos < size:
+        end = min(pos + BLOCK_SIZE, size)
+        if end < size:
+            nl = mm.rfind(b'\n', pos, end)
+            if nl == -1:
+                nl = mm.find(b'\n', end)
+            end = size if nl == -1 else nl + 1
+
+        block = mm[pos:end]
+        nls = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+        if not block.endswith(b'\n'):
+            nls = np.append(nls, len(block))
+        line_starts = np.concatenate(([0], nls[:-1] + 1))
+        line_ends = nls.copy()
+        cr = line_ends > line_starts
+        cr[cr] = np.frombuffer(block, dtype=np.uint8)[line_ends[cr] - 1] == 13
+        line_ends[cr] -= 1
+        keep = line_ends > line_starts
+        line_starts = line_starts[keep]
+        line_ends = line_ends[keep]
+
+        text = block.decode('utf-8', errors='replace')
+        lines = [line for line in text.splitlines() if line]
+        if len(lines) != len(line_starts):
+            # lines with unusual separators, split as the offsets do
+            lines = [
+                block[s:e].decode('utf-8', errors='replace')
+                for s, e in zip(line_starts, line_ends)
+            ]
+
+        block_values = _parse_values(lines, indexes)
+        valid = (
+            np.isfinite(block_values[:, 0])
+            & (np.abs(block_values[:, 1]) <= 90)
+        )
+        starts.append(line_starts[valid] + pos)
+        ends.append(line_ends[valid] + pos)
+        values.append(block_values[valid])
+
+        nrows += int(valid.sum())
+        if progress:
+            progress(rows_read=nrows)
+        if check_cancel:
+            check_cancel()
+        pos = end
+
+    if not starts:
+        return (np.empty(0, np.int64), np.empty(0, np.int64),
+                np.empty((0, 3)))
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(values)
+
+
+def assign_orders(ipix, score, max_order):
+    """
+    Distribute the rows over the HiPS orders.
+
+    Args:
+        ipix (numpy.ndarray): HEALPix index of each row at `max_order`.
+        score (numpy.ndarray): Score of each row, the lowest first.
+        max_order (int): Deepest order of the HiPS.
+
+    Yields:
+        tuple: (order, rows, pix, tile_starts, completeness) for each
+        order with tiles. `rows` holds the indexes of the rows of the
+        order, grouped by tile and ranked by score inside a tile, `pix`
+        the tile of each group starting at `tile_starts`, and
+        `completeness` the (written, total) counts of each tile.
+    """
+    sorted_ipix = np.sort(ipix)
+    remaining = np.argsort(score, kind='stable')
+
+    for order in range(MIN_ORDER, max_order + 1):
+        if not len(remaining):
+            return
+        shift = 2 * (max_order - order)
+        pix = ipix[remaining] >> shift
+        perm = np.argsort(pix, kind='stable')
+        remaining = remaining[perm]
+        pix = pix[perm]
+
+        n = len(pix)
+        group_starts = np.flatnonzero(np.r_[True, pix[1:] != pix[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, n])
+        rank = np.arange(n) - np.repeat(group_starts, group_sizes)
+        take = rank < _tile_capacity(order, max_order)
+
+        tile_pix = pix[group_starts]
+        taken = np.minimum(group_sizes, _tile_capacity(order, max_order))
+        total = (
+            np.searchsorted(sorted_ipix, (tile_pix + 1) << shift)
+            - np.searchsorted(sorted_ipix, tile_pix << shift)
+        )
+        written = total - group_sizes + taken
+        tile_starts = np.r_[0, np.cumsum(taken)[:-1]]
+
+        yield (order, remaining[take], tile_pix, tile_starts,
+               np.stack((written, total), axis=1))
+        remaining = remaining[~take]
+
+
+class _TileWriter:
+    """Write tiles from the rows of a memory-mapped CSV file."""
+
+    def __init__(self, mm, starts, ends, header):
+        self.mm = mm
+        self.starts = starts
+        self.ends = ends
+        self.header = header
+        self.quoted = mm.find(b'"') != -1
+
+    def rows(self, rows):
+        """Return the TSV lines of `rows`, as bytes."""
+        mm = self.mm
+        data = b'\n'.join(
+            mm[s:e] for s, e in zip(self.starts[rows], self.ends[rows])
+        )
+        if not self.quoted:
+            return data.replace(b',', b'\t') + b'\n'
+        out = io.StringIO()
+        csv.writer(out, delimiter='\t', lineterminator='\n').writerows(
+            csv.reader(data.decode('utf-8', errors='replace').splitlines())
+        )
+        return out.getvalue().encode('utf-8')
+
+    def write(self, path, rows, written, total):
+        """Write a tile with its completeness and header lines."""
+        with open(path, 'wb') as f:
+            f.write(b'# Completeness = %d / %d\n' % (written, total))
+            f.write(self.header)
+            f.write(self.rows(rows))
+
+
+def write_metadata(path, name, columns, types, ra_col, dec_col):
+    """Write the Metadata.xml VOTable describing the columns of the tiles."""
+    fields = []
+    for column, datatype in zip(columns, types):
+        attrs = f'name="{escape(column)}"'
+        if datatype == 'double':
+            attrs += ' datatype="double"'
+        else:
+            attrs += ' datatype="char" arraysize="*"'
+        if column == ra_col:
+            attrs += ' ucd="pos.eq.ra;meta.main"'
+        elif column == dec_col:
+            attrs += ' ucd="pos.eq.dec;meta.main"'
+        fields.append(f'<FIELD {attrs}/>')
+
+    with open(path, 'w') as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<VOTABLE version="1.2" '
+            'xmlns="http://www.ivoa.net/xml/VOTable/v1.2">\n'
+            '<RESOURCE>\n'
+            f'<TABLE name="{escape(name)}">\n'
+            + '\n'.join(fields) + '\n'
+            '<DATA><TABLEDATA>\n</TABLEDATA></DATA>\n'
+            '</TABLE>\n</RESOURCE>\n</VOTABLE>\n'
+        )
+
+
+def write_properties(path, name, nrows, max_order):
+    """Write the properties file of the catalog HiPS."""
+    with open(path, 'w') as f:
+        f.write(
+            f"creator_did = ivo://PRIVATE_USER/{name}\n"
+            f"obs_title = {name}\n"
+            "dataproduct_type = catalog\n"
+            "hips_version = 1.4\n"
+            "hips_builder = catalog_hips.py\n"
+            f"hips_release_date = "
+            f"{time.strftime('%Y-%m-%dT%H:%MZ', time.gmtime())}\n"
+            "hips_frame = equatorial\n"
+            f"hips_order = {max_order}\n"
+            f"hips_order_min = {MIN_ORDER}\n"
+            "hips_tile_format = tsv\n"
+            f"hips_cat_nrows = {nrows}\n"
+        )
+
+
+def _column_types(mm, start, ncols):
+    """Guess the VOTable datatype of each column from the first row."""
+    end = mm.find(b'\n', start)
+    line = mm[start:len(mm) if end == -1 else end].decode(
+        'utf-8', errors='replace').rstrip('\r')
+    row = next(csv.reader([line]), [])
+    types = []
+    for k in range(ncols):
+        try:
+            float(row[k])
+            types.append('double')
+        except (IndexError, ValueError):
+            types.append('char')
+    return types
+
+
+def build_catalog_hips(csv_path, output_dir, ra_col, dec_col, score_col,
+                       name=None, max_order=MAX_ORDER, workers=None,
+                       check_cancel=None, progress=None):
+    """
+    Build a catalog HiPS from a CSV file.
+
+    Args:
+        csv_path (str): Path to the CSV file, with a header line.
+        output_dir (str): Path to the output HiPS, created if needed.
+        ra_col (str): Name of the RA column, in degrees.
+        dec_col (str): Name of the Dec column, in degrees.
+        score_col (str): Name of the column ranking the rows, the lowest
+            values are shown first.
+        name (str): Name of the catalog, the CSV file name by default.
+        max_order (int): Deepest order of the HiPS.
+        workers (int): Number of threads writing the tiles.
+        check_cancel (callable): Called regularly, raises to stop the build.
+        progress (callable): Called with the `rows_read=` count while the
+            CSV file is read, then every `PROGRESS_TILES` tiles with the
+            `rows_read=`, `rows_written=` and `tiles=` counts.
+
+    Returns:
+        dict: Number of `rows` and `tiles` and deepest `order` written.
+
+    Raises:
+        ValueError: If a column is missing from the CSV header.
+    """
+    name = name or os.path.splitext(os.path.basename(csv_path))[0]
+
+    with open(csv_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offset = 3 if mm[:3] == b'\xef\xbb\xbf' else 0
+        header_end = mm.find(b'\n', offset)
+        if header_end == -1:
+            header_end = len(mm)
+        header_line = mm[offset:header_end].decode('utf-8').rstrip('\r')
+        columns = next(csv.reader([header_line]))
+        indexes = []
+        for column in (ra_col, dec_col, score_col):
+            if column not in columns:
+                raise ValueError(f"Column {column} not found in CSV file")
+            indexes.append(columns.index(column))
+
+        starts, ends, values = read_catalog(
+            mm, header_end + 1, tuple(indexes), check_cancel, progress)
+        nrows = len(starts)
+
+        ipix = lonlat_to_healpix(
+            Longitude(values[:, 0], u.deg),
+            Latitude(values[:, 1], u.deg),
+            max_order,
+        ).astype(np.int64)
+        score = np.where(np.isnan(values[:, 2]), np.inf, values[:, 2])
+        del values
+
+        os.makedirs(output_dir, exist_ok=True)
+        header = ('\t'.join(columns) + '\n').encode('utf-8')
+        writer = _TileWriter(mm, starts, ends, header)
+
+        ntiles = 0
+        nwritten = 0
+        deepest = MIN_ORDER
+        with ThreadPoolExecutor(workers) as pool:
+            for order, rows, pix, tile_starts, completeness in \
+                    assign_orders(ipix, score, max_order):
+                if check_cancel:
+                    check_cancel()
+                order_dir = os.path.join(output_dir, f"Norder{order}")
+                for d in np.unique(pix // 10000 * 10000):
+                    os.makedirs(os.path.join(order_dir, f"Dir{d}"),
+                                exist_ok=True)
+
+                tile_ends = np.r_[tile_starts[1:], len(rows)]
+                written = pool.map(
+                    lambda t: writer.write(
+                        os.path.join(
+                            order_dir,
+                            f"Dir{pix[t] // 10000 * 10000}",
+                            f"Npix{pix[t]}.tsv",
+                        ),
+                        rows[tile_starts[t]:tile_ends[t]],
+                        *completeness[t],
+                    ),
+                    range(len(pix)),
+                )
+                for t, _ in enumerate(written, 1):
+                    if t % PROGRESS_TILES and t < len(pix):
+                        continue
+                    if progress:
+                        progress(rows_read=nrows,
+                                 rows_written=nwritten + int(tile_ends[t - 1]),
+                                 tiles=ntiles + t)
+                    if check_cancel:
+                        check_cancel()
+                if order in ALLSKY_ORDERS:
+                    writer.write(os.path.join(order_dir, 'Allsky.tsv'),
+                                 rows, *completeness.sum(axis=0))
+
+                ntiles += len(pix)
+                nwritten += len(rows)
+                deepest = order
+
+        write_metadata(os.path.join(output_dir, 'Metadata.xml'), name,
+                       columns, _column_types(mm, header_end + 1,
+                                              len(columns)),
+                       ra_col, dec_col)
+
+    cells = np.unique(ipix)
+    if len(cells):
+        moc = MOC.from_healpix_cells(
+            cells, np.full(len(cells), max_order, dtype=np.uint8), max_order)
+        moc.save(os.path.join(output_dir, 'Moc.fits'), format='fits',
+                 overwrite=True)
+    write_properties(os.path.join(output_dir, 'properties'), name, nrows,
+                     deepest)
+
+    return {'rows': nrows, 'tiles': ntiles, 'order': deepest}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 6:
+        print(__doc__)
+        sys.exit(1)
+
+    start = time.time()
+    result = build_catalog_hips(*sys.argv[1:7])
+    print(f"{result['rows']} rows, {result['tiles']} tiles up to order "
+          f"{result['order']} in {time.time() - start:.1f} s")
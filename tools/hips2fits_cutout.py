@@ -22,6 +22,7 @@
  ##############################################################################
 
 
+import atexit
 import sys
 import os
 
@@ -34,14 +35,17 @@ from io import BytesIO
 
 import time
 
-import re
-
 import math
 
+import csv
+from collections import OrderedDict
 from functools import lru_cache
+from threading import Lock
 
 import numpy as np
-from multiprocessing import Pool
+from multiprocessing import get_context, shared_memory
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 import matplotlib.image as mimg
 
@@ -51,10 +55,16 @@ from astropy.visualization import simple_norm
 
 import numba
 numba.config.NUMBA_NUM_THREADS = max(1, os.cpu_count() // 3 - 1)
+# the cached kernels refer to this module by the name it was imported with: tools.hips2fits_cutout for the
+# web app, __main__ for the command line (__mp_main__ in its spawned workers). Each name gets its own cache
+# folder, a kernel cached under the other name would fail to load
+if not os.environ.get('NUMBA_CACHE_DIR'):
+    numba.config.CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'numba',
+                                          'script' if __name__ in ('__main__', '__mp_main__') else __name__)
 from numba.typed import Dict
 
 from astropy.wcs import WCS
-from astropy.coordinates import SkyCoord, Angle
+from astropy.coordinates import SkyCoord, Angle, CartesianRepresentation
 
 import numpy as np
 
@@ -66,12 +76,37 @@ import cdshealpix
 
 import astropy.units as u
 
+try:
+    from tools.hips_properties import read_properties
+except ImportError:
+    # run as a script from the tools directory
+    from hips_properties import read_properties
 
 
 DEFAULT_FORMAT = 'fits'
 DEFAULT_STRETCH = 'linear'
 DEFAULT_CMAP = 'Greys_r'
 
+TILE_CACHE_SIZE = 512 * 1024 * 1024 # bytes of decoded tiles kept in memory by each process
+# rows of a list are processed in the order of their HEALPix cell at this order, so that
+# neighbouring targets follow each other and find their tiles in the cache
+LIST_SORT_ORDER = 12
+# rows of a list given at once to a worker process
+LIST_CHUNK_SIZE = 16
+RESULT_COLUMNS = ('row', 'output', 'seconds', 'status', 'error')
+
+# cutouts of at least PIX2WORLD_MIN_PIXELS have their pixel to sky transform spread over a pool of
+# PIX2WORLD_WORKERS processes (see warm_up and the --pix2world-workers option)
+PIX2WORLD_WORKERS = 8
+PIX2WORLD_MIN_PIXELS = 4e6
+
+_pix2world_pool = None
+_pix2world_wcs = (None, None)
+
+_tile_cache = OrderedDict()
+_tile_cache_bytes = 0
+_tile_cache_lock = Lock()
+
 
 @lru_cache(maxsize=None)
 def _compute_xy2hpx(shift_order: int) -> np.ndarray:
@@ -150,6 +185,118 @@ def compute_pix2world(wcs, x, y, hips_frame='equatorial'):
         # planetary case!
         return skycoords.icrs.ra, skycoords.icrs.dec
 
+@lru_cache(maxsize=None)
+def _frame_rotation_matrix(from_frame, to_frame):
+    """
+    return the 3x3 matrix rotating cartesian directions of from_frame to to_frame ('icrs' or 'galactic'),
+    computed once by astropy from the images of the basis vectors
+    """
+    basis = SkyCoord(CartesianRepresentation(np.eye(3)), frame=from_frame)
+    return np.ascontiguousarray(basis.transform_to(to_frame).cartesian.xyz.value)
+
+def _wcs_frame(wcs):
+    """
+    return 'icrs' or 'galactic' for the celestial frame of wcs, None for other frames
+    """
+    lng_type = wcs.wcs.lngtyp
+    if lng_type == 'GLON':
+        return 'galactic'
+    if lng_type == 'RA' and (wcs.wcs.radesys == 'ICRS' or (wcs.wcs.radesys == '' and np.isnan(wcs.wcs.equinox))):
+        return 'icrs'
+    return None
+
+@numba.jit(nopython=True, nogil=True, fastmath=False, cache=True)
+def _rotate_lonlat(lon, lat, matrix):
+    """
+    rotate in place the directions lon, lat (2D arrays of degrees) by matrix, longitudes are wrapped to [0, 360[
+    """
+    for i in range(lon.shape[0]):
+        for j in range(lon.shape[1]):
+            a = np.radians(lon[i, j])
+            d = np.radians(lat[i, j])
+            x = np.cos(d) * np.cos(a)
+            y = np.cos(d) * np.sin(a)
+            z = np.sin(d)
+            rx = matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2] * z
+            ry = matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2] * z
+            rz = matrix[2, 0] * x + matrix[2, 1] * y + matrix[2, 2] * z
+            lon[i, j] = np.degrees(np.arctan2(ry, rx)) % 360.
+            lat[i, j] = np.degrees(np.arctan2(rz, np.sqrt(rx * rx + ry * ry)))
+
+def pix2world_deg(wcs, x, y, hips_frame='equatorial'):
+    """
+    same as compute_pix2world, for 2D arrays x, y, returning plain arrays of degrees.
+    When the celestial frame of wcs is ICRS or galactic, the sky coordinates come from all_pix2world,
+    rotated to the HiPS frame by a 3x3 matrix, without building SkyCoord objects
+    """
+    from_frame = _wcs_frame(wcs)
+    if from_frame is None:
+        lon, lat = compute_pix2world(wcs, x, y, hips_frame)
+        return lon.deg, lat.deg
+
+    to_frame = 'galactic' if hips_frame=='galactic' else 'icrs'
+    lon, lat = wcs.all_pix2world(x, y, 0)
+    if from_frame == to_frame:
+        np.mod(lon, 360., out=lon)
+    else:
+        _rotate_lonlat(lon, lat, _frame_rotation_matrix(from_frame, to_frame))
+    return lon, lat
+
+def _get_pix2world_pool():
+    """
+    return the pix2world pool, started on first use and kept for the next cutouts.
+    Its processes are spawned: the cdshealpix threads of this process would not survive a fork
+    """
+    global _pix2world_pool
+    if _pix2world_pool is None:
+        _pix2world_pool = get_context('spawn').Pool(processes=PIX2WORLD_WORKERS)
+        atexit.register(_pix2world_pool.terminate)
+    return _pix2world_pool
+
+def _pix2world_rows(shm_name, shape, wcs_header, hips_frame, row_start, row_end):
+    """
+    in a pix2world worker, compute the sky coordinates (degrees) of the rows row_start to row_end of a cutout
+    and write them to the (2, height, width) float64 shared memory buffer shm_name
+    """
+    global _pix2world_wcs
+    # the WCS is parsed once per cutout by each worker
+    if _pix2world_wcs[0] != wcs_header:
+        _pix2world_wcs = (wcs_header, WCS(fits.Header.fromstring(wcs_header)))
+
+    xv, yv = np.meshgrid(np.arange(0, shape[2]), np.arange(row_start, row_end))
+    lon, lat = pix2world_deg(_pix2world_wcs[1], xv, yv, hips_frame)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        lonlat = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        lonlat[0, row_start:row_end] = lon
+        lonlat[1, row_start:row_end] = lat
+        del lonlat
+    finally:
+        shm.close()
+
+def _parallel_pix2world(wcs, width, height, hips_frame):
+    """
+    compute_pix2world for all the pixels of a cutout, spread by sections of rows over the pix2world pool.
+    Workers receive the WCS header and their rows, and write the results of pix2world_deg to shared memory
+    """
+    shape = (2, height, width)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+    try:
+        nb_sections = min(height, max(1, width*height // 100000))
+        bounds = np.linspace(0, height, nb_sections + 1).astype(int)
+        wcs_header = wcs.to_header_string(relax=True)
+        _get_pix2world_pool().starmap(
+            _pix2world_rows,
+            [(shm.name, shape, wcs_header, hips_frame, int(start), int(end))
+             for start, end in zip(bounds[:-1], bounds[1:]) if end > start])
+        lonlat = np.array(np.ndarray(shape, dtype=np.float64, buffer=shm.buf))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return Longitude(lonlat[0], unit='deg', copy=False), Latitude(lonlat[1], unit='deg', copy=False)
+
 def _create_wcs_object(skycoord, width, height, fov, coordsys='icrs', projection='TAN', rotation_angle=0, inverse_longitude=False):
     """
     Create as Astropy WCS object from a few basic parameters
@@ -221,21 +368,6 @@ def _get_healpix_order_for_resolution(resolution):
 
     return 29
 
-def _parse_properties_as_dict(properties_path):
-    props = {}
-    with open(properties_path) as h:
-        while True:
-            l = h.readline()
-            if not l:
-                break
-
-            l = l.rstrip()
-            m = re.search('(.*?)=(.*)', l)
-            if m:
-                props[m.group(1).strip()] = m.group(2).strip()
-
-    return props
-
 def _get_tile_path(root_url, norder, npix, img_format):
         """
         return URL path for tile norder, npix for HiPS at root_url
@@ -252,42 +384,127 @@ def _get_allsky_tile_path(root_url, img_format):
 
         return f'{root_url}/Norder3/Allsky.{format}'
 
-def make_cutout(width, height, wcs, hips_root, coordsys='icrs', tile_format='fits'):
-    PARALLELISM_LEVEL = 8 # number of concurrent processes
+def _file_signature(path):
+    """
+    return (path, mtime, size) of a local tile or of its RICE compressed version, None if there is none
+    """
+    if path.startswith('http'):
+        return 'http'
+    for p in (path, path + '.fz'):
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            continue
+        return (p, st.st_mtime_ns, st.st_size)
+    return None
 
-    hips_properties = _parse_properties_as_dict(os.path.join(hips_root, 'properties'))
-    hips_frame = hips_properties.get('hips_frame', 'icrs')
+def _cached(key, path, load):
+    """
+    return load(), from the decoded tile cache when the file at path did not change since it was loaded.
+    The least recently used entries are evicted when the cache holds more than TILE_CACHE_SIZE bytes
+    """
+    global _tile_cache_bytes
+
+    signature = _file_signature(path)
+    with _tile_cache_lock:
+        entry = _tile_cache.get(key)
+        if entry is not None and entry[0] == signature:
+            _tile_cache.move_to_end(key)
+            return entry[1]
+
+    value = load()
+    nbytes = getattr(value, 'nbytes', 0)
+    with _tile_cache_lock:
+        old = _tile_cache.pop(key, None)
+        if old is not None:
+            _tile_cache_bytes -= old[2]
+        if nbytes <= TILE_CACHE_SIZE:
+            _tile_cache[key] = (signature, value, nbytes)
+            _tile_cache_bytes += nbytes
+        while _tile_cache_bytes > TILE_CACHE_SIZE:
+            _, (_, _, evicted) = _tile_cache.popitem(last=False)
+            _tile_cache_bytes -= evicted
+    return value
+
+def _get_allsky_types(hips_root, tile_format):
+    """
+    return numpy and numba types of the pixels of a HiPS, read from its Allsky file
+    """
+    allsky_path = _get_allsky_tile_path(hips_root, tile_format)
 
-    ### 1st step: compute sky location for each pixel
-    #             of the output image
-    # TODO: is there a 0.5 shift to be taken into account???
-    t1_start = time.time()
-    xv, yv = np.meshgrid(np.arange(0, width), np.arange(0, height))
+    def load():
+        if tile_format=='fits':
+            allsky_data = None
+            # is it a RICE compressed tile?
+            if not allsky_path.startswith('http'):
+                allskypath_fz = allsky_path + '.fz'
+                if os.path.exists(allskypath_fz):
+                    allsky_data = fits.open(allskypath_fz)[1].data
+
+            if allsky_data is None:
+                allsky_data = fits.open(allsky_path)[0].data
+        else:
+            if allsky_path.startswith('http'):
+                r = requests.get(allsky_path)
+                with Image.open(BytesIO(r.content)) as image:
+                    allsky_data = np.array(image)
+            else:
+                with Image.open(allsky_path) as image:
+                    allsky_data = np.array(image)
 
-    if width*height >= 4e6:
-        use_processes = True
-    else:
-        use_processes = False
+        return allsky_data.dtype, numba.typeof(allsky_data[0][0])
 
-    if use_processes:
-        nb_sections = max(1, width*height // 100000)
+    return _cached((hips_root, 'Allsky', tile_format), allsky_path, load)
 
-        xv_splitted = np.array_split(xv, nb_sections)
-        yv_splitted = np.array_split(yv, nb_sections)
+def _get_tile_data_type(numpy_data_type):
+    """
+    return the type the tiles are converted to for the interpolation kernels, None to keep them as they are
+    """
+    if numpy_data_type.str.endswith('f4'): # struggling with numpy and numba types ...
+        return np.dtype(np.float32)
+    elif numpy_data_type.str.endswith('f8'):
+        return np.dtype(np.float64)
+    elif numpy_data_type.str.endswith('i2'):
+        return np.dtype(np.int16)
+    elif numpy_data_type.str.endswith('i4'):
+        return np.dtype(np.int32)
+    elif numpy_data_type.str == '<u2':
+        return np.dtype(np.int16)
+    return None
+
+def _get_tile(hips_root, norder, npix, tile_format, tile_size, data_type):
+    """
+    return the decoded tile norder, npix converted to data_type, from the decoded tile cache.
+    Cached tiles are shared between cutouts and must not be modified
+    """
+    tile_path = _get_tile_path(hips_root, norder, npix, tile_format)
 
-        pool = Pool(processes=PARALLELISM_LEVEL)
-        input_list = []
-        for i in range(len(xv_splitted)):
-            input_list.append([wcs, xv_splitted[i], yv_splitted[i], hips_frame])
+    def load():
+        data = _get_image_data(tile_path, tile_size)
+        if data_type is not None:
+            return data.astype(data_type)
+        # do not keep a memory map of the tile file
+        return np.array(data)
 
-        lon, lat = np.concatenate(pool.starmap(compute_pix2world, input_list), axis=1)
-        lon = Longitude(lon, unit='deg')
-        lat = Latitude(lat, unit='deg')
+    return _cached((hips_root, norder, npix, tile_format), tile_path, load)
 
-        pool.close()
+def make_cutout(width, height, wcs, hips_root, coordsys='icrs', tile_format='fits'):
+    hips_properties = read_properties(os.path.join(hips_root, 'properties'))
+    hips_frame = hips_properties.get('hips_frame', 'icrs')
 
+    ### 1st step: compute sky location for each pixel
+    #             of the output image
+    # TODO: is there a 0.5 shift to be taken into account???
+    t1_start = time.time()
+    xv, yv = np.meshgrid(np.arange(0, width), np.arange(0, height))
+
+    # workers of generate_for_list run with PIX2WORLD_WORKERS = 1 (see _list_worker)
+    if width*height >= PIX2WORLD_MIN_PIXELS and PIX2WORLD_WORKERS > 1:
+        lon, lat = _parallel_pix2world(wcs, width, height, hips_frame)
     else:
-        lon, lat = compute_pix2world(wcs, xv, yv, hips_frame)
+        lon, lat = pix2world_deg(wcs, xv, yv, hips_frame)
+        lon = Longitude(lon, unit='deg', copy=False)
+        lat = Latitude(lat, unit='deg', copy=False)
 
     t1_end = time.time()
     #print(f'T1: {t1_end-t1_start}')
@@ -326,7 +543,8 @@ def make_cutout(width, height, wcs, hips_root, coordsys='icrs', tile_format='fit
 
     coeffs = compute_interpolation_coeff(lon, lat, pixel_order)
 
-    coeffs_0 = coeffs[0].filled(fill_value = -1)
+    # -1 as an unsigned ipix (implicit cast of numpy < 2): no tile has it
+    coeffs_0 = coeffs[0].filled(fill_value = np.iinfo(coeffs[0].dtype).max)
     coeffs_1 = coeffs[1].filled(fill_value = -1)
 
     t2_end = time.time()
@@ -347,61 +565,19 @@ def make_cutout(width, height, wcs, hips_root, coordsys='icrs', tile_format='fit
     else:
         ipixes, orders, fully_covered = cdshealpix.polygon_search(borders_lon, borders_lat, tile_order, flat=True)
 
-    tiles = {}
-    numpy_data_type = None
-    numba_data_type = None
-
     # find types from Allsky tiles
-    allsky_path = _get_allsky_tile_path(hips_root, tile_format)
-
-
-
-    if tile_format=='fits':
-        allsky_data = None
-        # is it a RICE compressed tile?
-        if not allsky_path.startswith('http'):
-            allskypath_fz = allsky_path + '.fz'
-            if os.path.exists(allskypath_fz):
-                allsky_data = fits.open(allskypath_fz)[1].data
-
-        if allsky_data is None:
-            allsky_data = fits.open(allsky_path)[0].data
-    else:
-        if allsky_path.startswith('http'):
-            r = requests.get(allsky_path)
-            with Image.open(BytesIO(r.content)) as image:
-                allsky_data = np.array(image)
-        else:
-            with Image.open(allsky_path) as image:
-                allsky_data = np.array(image)
-
-    numpy_data_type = allsky_data.dtype
-    numba_data_type = numba.typeof(allsky_data[0][0])
+    numpy_data_type, numba_data_type = _get_allsky_types(hips_root, tile_format)
+    target_data_type = _get_tile_data_type(numpy_data_type)
 
+    tiles = {}
     for ipix in ipixes:
         ipix = ipix.item()
-        hdu = None
-        tile_path = _get_tile_path(hips_root, tile_order, ipix, tile_format)
-        data = _get_image_data(tile_path, tile_size)
+        tiles[ipix] = _get_tile(hips_root, tile_order, ipix, tile_format, tile_size, target_data_type)
 
-        if numpy_data_type.str.endswith('f4'): # struggling with numpy and numba types ...
-            tiles[ipix] = data.astype(np.float32)
-            numpy_data_type = tiles[ipix].dtype
-        elif numpy_data_type.str.endswith('f8'):
-            tiles[ipix] = data.astype(np.float64)
-            numpy_data_type = tiles[ipix].dtype
-        elif numpy_data_type.str.endswith('i2'):
-            tiles[ipix] = data.astype(np.int16)
-            numpy_data_type = tiles[ipix].dtype
-        elif numpy_data_type.str.endswith('i4'):
-            tiles[ipix] = data.astype(np.int32)
-            numpy_data_type = tiles[ipix].dtype
-        elif numpy_data_type.str == '<u2':
-            tiles[ipix] = data.astype(np.int16)
-            numpy_data_type = tiles[ipix].dtype
-            numba_data_type = numba.typeof(tiles[ipix][0][0])
-        else:
-            tiles[ipix] = data
+    if target_data_type is not None:
+        if numpy_data_type.str == '<u2':
+            numba_data_type = numba.typeof(target_data_type.type(0))
+        numpy_data_type = target_data_type
 
 
     if tile_format=='fits':
@@ -505,7 +681,11 @@ def _apply_stretch(input_image, stretch='linear', min_cut=None, max_cut=None, as
     if not asinh_a:
         asinh_a = 0.1
 
-    image_normalizer = simple_norm(input_image, stretch=stretch, min_cut=min_cut, max_cut=max_cut, asinh_a=asinh_a, clip=True)
+    try:
+        image_normalizer = simple_norm(input_image, stretch=stretch, vmin=min_cut, vmax=max_cut, asinh_a=asinh_a, clip=True)
+    except TypeError:
+        # astropy < 6.1
+        image_normalizer = simple_norm(input_image, stretch=stretch, min_cut=min_cut, max_cut=max_cut, asinh_a=asinh_a, clip=True)
     image_scaled = image_normalizer(input_image)
     image_scaled = np.flipud(image_scaled)
 
@@ -612,7 +792,7 @@ def generate(ra, dec, fov, width, height, hips_path, output_path, format='fits',
     sc = SkyCoord(ra, dec, frame='icrs', unit='deg')
     wcs = _create_wcs_object(sc, width, height, fov, coordsys='icrs', projection='SIN', rotation_angle=0)
 
-    hips_properties = _parse_properties_as_dict(os.path.join(hips_path, 'properties'))
+    hips_properties = read_properties(os.path.join(hips_path, 'properties'))
     is_color_hips = hips_properties.get('dataproduct_subtype', '')=='color'
 
     # TODO: read from properties
@@ -660,35 +840,228 @@ def generate(ra, dec, fov, width, height, hips_path, output_path, format='fits',
 
     # return stat (generation time, success/error, errorCause)
 
-def generate_for_list(params_table, min_cut=None, max_cut=None, stretch='linear', cmap='Greys'):
+def generate_bytes(ra, dec, fov, width, height, hips_path, format='fits', min_cut=None, max_cut=None,
+                   stretch='linear', cmap=DEFAULT_CMAP):
+    """
+    Same as generate, but return the content of the cutout file instead of writing it to disk
+    """
+    output = BytesIO()
+    generate(ra, dec, fov, width, height, hips_path, output, format=format, min_cut=min_cut, max_cut=max_cut,
+             stretch=stretch, cmap=cmap)
+    return output.getvalue()
+
+def warm_up(pix2world_workers=None):
+    """
+    Compile (or load from the numba cache) the interpolation kernels for the usual tile types,
+    and compute the hpx2xy table of 512 pixels tiles, so that the first cutout of a long-lived
+    worker process does not pay for it. pix2world_workers replaces PIX2WORLD_WORKERS
+    """
+    global PIX2WORLD_WORKERS
+    if pix2world_workers is not None:
+        PIX2WORLD_WORKERS = pix2world_workers
+
+    hpx2xy = _compute_hpx2xy(9)
+    xv, yv = np.meshgrid(np.arange(0, 2), np.arange(0, 2))
+    _rotate_lonlat(np.zeros((2, 2)), np.zeros((2, 2)), _frame_rotation_matrix('icrs', 'galactic'))
+    coeffs = compute_interpolation_coeff(Longitude([[0, 1], [0, 1]], unit='deg'),
+                                         Latitude([[0, 0], [1, 1]], unit='deg'), 9)
+    coeffs_0 = coeffs[0].filled(fill_value = np.iinfo(coeffs[0].dtype).max)
+    coeffs_1 = coeffs[1].filled(fill_value = -1)
+
+    for numpy_data_type in (np.dtype(np.float32), np.dtype(np.int16)):
+        tile = np.zeros((512, 512), dtype=numpy_data_type)
+        dict_tiles = Dict.empty(key_type=numba.types.int64, value_type=numba.typeof(tile[0][0])[:,:])
+        dict_tiles[0] = tile
+        dispatch_weights_to_pixels_fits(xv, yv, dict_tiles, coeffs_0, coeffs_1, hpx2xy, numpy_data_type)
+
+    for tile_format, n_dim in (('png', 4), ('jpg', 3)):
+        tile = np.zeros((512, 512, n_dim), dtype=np.uint8)
+        dict_tiles = Dict.empty(key_type=numba.types.int64, value_type=numba.types.uint8[:,:,:])
+        dict_tiles[0] = tile
+        dispatch_weights_to_pixels_jpg(xv, yv, dict_tiles, coeffs_0, coeffs_1, hpx2xy, tile.dtype, tile_format)
+
+def _sort_values(column):
+    """
+    values of a coordinate column for sorting the rows, 0 for the invalid ones: they are reported by the
+    row that uses them, not by the whole list
+    """
+    values = np.zeros(len(column))
+    for i, value in enumerate(column):
+        try:
+            values[i] = float(value)
+        except (TypeError, ValueError):
+            pass
+    values[~np.isfinite(values)] = 0
+    return values
+
+def _list_order(params_table):
+    """
+    return the indexes of the rows of a list sorted by HiPS, then by the HEALPix cell of their target.
+    Cells of the nested scheme are numbered along a Z-order curve: consecutive rows are close on the sky
+    """
+    ipix = cdshealpix.nested.lonlat_to_healpix(Longitude(_sort_values(params_table['ra']), unit='deg'),
+                                               Latitude(np.clip(_sort_values(params_table['dec']), -90, 90),
+                                                        unit='deg'),
+                                               LIST_SORT_ORDER)
+    hips = np.unique(np.asarray(params_table['hips']), return_inverse=True)[1]
+    return np.lexsort((ipix, hips))
+
+def _write_output(output_path, data):
+    """
+    write a cutout file through a temporary file, so that an interrupted list never leaves a truncated output
+    """
+    tmp_path = output_path + '.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+
+def _generate_rows(rows, skip_existing):
+    """
+    generate the cutouts of a chunk of rows, return the result of each row.
+    A failing row, invalid values included, is reported with its error and does not stop the others
+    """
+    results = []
+    for row_id, output_path, values in rows:
+        start = time.time()
+        if skip_existing and os.path.exists(output_path):
+            results.append((row_id, output_path, 0., 'skipped', ''))
+            continue
+        try:
+            args = (float(values['ra']), float(values['dec']), float(values['fov']), int(values['width']),
+                    int(values['height']), str(values['hips']))
+            kwargs = {name: values[name] for name in ('format', 'min_cut', 'max_cut', 'stretch', 'cmap')}
+            _write_output(output_path, generate_bytes(*args, **kwargs))
+            results.append((row_id, output_path, time.time() - start, 'ok', ''))
+        except Exception as e:
+            results.append((row_id, output_path, time.time() - start, 'error', f'{type(e).__name__}: {e}'))
+    return results
+
+def _list_worker():
+    """
+    initializer of the worker processes of a list: the list is already spread over all of them, so they do
+    not start a pix2world pool each
+    """
+    global PIX2WORLD_WORKERS
+    PIX2WORLD_WORKERS = 1
+
+def _lost_rows(rows, skip_existing):
+    """
+    generate a chunk of rows again in its own process, after the process running it died. The rows are
+    reported as errors if this process dies too
+    """
+    with ProcessPoolExecutor(max_workers=1, initializer=_list_worker) as pool:
+        try:
+            return pool.submit(_generate_rows, rows, skip_existing).result()
+        except BrokenProcessPool:
+            return [(row_id, output_path, 0., 'error', 'BrokenProcessPool: the worker process died')
+                    for row_id, output_path, _ in rows]
+
+def _pool_results(chunks, workers, skip_existing):
+    """
+    generate the chunks of rows in a pool of worker processes, yield the results of each chunk as it ends.
+    Only one chunk per worker is submitted at a time, so that the chunks lost when a worker dies (crash, out of
+    memory kill) are known: they are generated again one by one (_lost_rows), then a new pool goes on
+    """
+    next_chunk = 0
+    while next_chunk < len(chunks):
+        lost = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_list_worker) as pool:
+            running = {}
+            while True:
+                while not lost and len(running) < workers and next_chunk < len(chunks):
+                    try:
+                        future = pool.submit(_generate_rows, chunks[next_chunk], skip_existing)
+                    except BrokenProcessPool:
+                        lost.append(None)
+                        break
+                    running[future] = chunks[next_chunk]
+                    next_chunk += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        lost.append(chunk)
+                        continue
+                    yield result
+        for chunk in lost:
+            if chunk is not None:
+                yield _lost_rows(chunk, skip_existing)
+
+def _row_value(params_table, row, colname, default):
+    if colname not in params_table.colnames or np.ma.is_masked(row[colname]):
+        return default
+    value = row[colname]
+    return value.item() if isinstance(value, np.generic) else value
+
+def generate_for_list(params_table, min_cut=None, max_cut=None, stretch=DEFAULT_STRETCH, cmap=DEFAULT_CMAP,
+                      workers=None, results_path=None, skip_existing=False):
+    """
+    Generate the cutouts of a list, one row per cutout (columns ra, dec, fov, width, height, hips, output,
+    and optionally format, min_cut, max_cut, stretch, cmap which default to the arguments)
+
+    Rows are processed in chunks of LIST_CHUNK_SIZE neighbouring rows, spread over a pool of worker processes.
+    The result of each row (row, output, seconds, status, error) is appended to the CSV file results_path as
+    soon as its chunk is done. status is 'ok', 'error' or 'skipped' (output already there with skip_existing),
+    so that an interrupted list can be run again with skip_existing and only generates the missing outputs: the
+    results of the previous runs are kept in results_path. A row with invalid values, or whose worker process
+    died twice, is reported as an error.
+
+    Returns the results as an astropy Table, in the order of the rows of params_table
+    """
     start = time.time()
 
     # TODO: check column names. If no column names, use default order
-    # TODO: additional params : cmap, min/max_cut, stretch, format
-
-    for row in params_table:
-        format = DEFAULT_FORMAT
-        min_cut = max_cut = None
-        stretch = DEFAULT_STRETCH
-        cmap = DEFAULT_CMAP
-        if 'format' in params_table.colnames:  format = row['format']
-        if 'min_cut' in params_table.colnames: min_cut = row['min_cut']
-        if 'max_cut' in params_table.colnames: max_cut = row['max_cut']
-        if 'stretch' in params_table.colnames: stretch = row['stretch']
-        if 'cmap' in params_table.colnames:    cmap = row['cmap']
-
-        generate(row['ra'], row['dec'], row['fov'], row['width'], row['height'], row['hips'], row['output'],
-                     format=format, min_cut=min_cut, max_cut=max_cut, stretch=stretch, cmap=cmap)
 
-    # return stat (generation time, success/error, errorCause)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # the values are checked by the workers, row by row
+    defaults = dict(ra=None, dec=None, fov=None, width=None, height=None, hips=None, format=DEFAULT_FORMAT,
+                    min_cut=min_cut, max_cut=max_cut, stretch=stretch, cmap=cmap)
+    rows = []
+    for row_id in _list_order(params_table):
+        row = params_table[row_id]
+        values = {name: _row_value(params_table, row, name, default) for name, default in defaults.items()}
+        rows.append((int(row_id), str(_row_value(params_table, row, 'output', '')), values))
+    chunks = [rows[i:i + LIST_CHUNK_SIZE] for i in range(0, len(rows), LIST_CHUNK_SIZE)]
+
+    results = []
+    results_file = None
+    if results_path:
+        new_file = not os.path.exists(results_path) or os.path.getsize(results_path) == 0
+        results_file = open(results_path, 'a', newline='')
+        writer = csv.writer(results_file)
+        if new_file:
+            writer.writerow(RESULT_COLUMNS)
+
+    try:
+        if workers > 1 and len(chunks) > 1:
+            chunk_results = _pool_results(chunks, min(workers, len(chunks)), skip_existing)
+        else:
+            chunk_results = (_generate_rows(chunk, skip_existing) for chunk in chunks)
 
-    # TODO: check params column names
+        for chunk_result in chunk_results:
+            results.extend(chunk_result)
+            if results_file:
+                writer.writerows(chunk_result)
+                results_file.flush()
+    finally:
+        if results_file:
+            results_file.close()
 
-    end = time.time()
+    results.sort()
+    results_table = Table(rows=results, names=RESULT_COLUMNS) if results else Table(names=RESULT_COLUMNS)
 
-    print(f'\n\n{len(params_table)} cutouts generated in {end-start:.2f} seconds')
+    end = time.time()
+    counts = {status: int(np.sum(results_table['status'] == status)) for status in ('ok', 'skipped', 'error')}
+    print(f'\n\n{len(params_table)} cutouts processed in {end-start:.2f} seconds: '
+          f'{counts["ok"]} generated, {counts["skipped"]} skipped, {counts["error"]} errors')
 
-    # return array of stat (generation time, success/error, errorCause)
+    return results_table
 
 def create_html_page(params_table, html_path, link_template):
     with open(html_path, 'w') as h:
@@ -727,6 +1100,9 @@ def create_html_page(params_table, html_path, link_template):
 if __name__ == '__main__':
     start = time.time()
 
+    if '--pix2world-workers' in sys.argv:
+        PIX2WORLD_WORKERS = int(sys.argv[sys.argv.index('--pix2world-workers') + 1])
+
     if '-l' in sys.argv or '--list-params' in sys.argv:
         if '-l' in sys.argv:
             list_params_path_idx = sys.argv.index('-l')
@@ -746,7 +1122,19 @@ if __name__ == '__main__':
             create_html_page(params, html_path, link_template)
 
         else:
-            generate_for_list(params)
+            workers = None
+            if '-w' in sys.argv or '--workers' in sys.argv:
+                workers_idx = sys.argv.index('-w' if '-w' in sys.argv else '--workers')
+                workers = int(sys.argv[workers_idx + 1])
+
+            results_path = None
+            if '--results' in sys.argv:
+                results_path = sys.argv[sys.argv.index('--results') + 1]
+
+            results = generate_for_list(params, workers=workers, results_path=results_path,
+                                        skip_existing='--skip-existing' in sys.argv)
+            if np.any(results['status'] == 'error'):
+                sys.exit(1)
 
         sys.exit()
 
@@ -0,0 +1,108 @@
+"""
+Parsing of HiPS `properties` files, with an in-memory cache shared by the
+web application and the cutout engine.
+
+A cached entry is kept until the file modification time or size changes.
+The file is checked at most once every `CHECK_INTERVAL` seconds, so hot
+polls of the same HiPS are served from memory.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+CACHE_SIZE = 1024
+CHECK_INTERVAL = 1.0  # s
+
+_cache = OrderedDict()
+_cache_lock = Lock()
+
+
+def parse_properties(properties_path):
+    """
+    Parse a HiPS properties file.
+
+    Args:
+        properties_path (str): Path to the properties file.
+
+    Returns:
+        dict: Value of each key, as strings. Comments and lines without
+        '=' are skipped.
+    """
+    props = {}
+    with open(properties_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            props[key.strip()] = value.strip()
+    return props
+
+
+def read_properties(properties_path):
+    """
+    Return the parsed properties file, from the cache when it did not
+    change since it was last parsed.
+
+    Args:
+        properties_path (str): Path to the properties file.
+
+    Returns:
+        dict: Value of each key, as strings. The dict is shared, callers
+        must not modify it.
+
+    Raises:
+        FileNotFoundError: If the properties file does not exist.
+    """
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(properties_path)
+        if entry is not None:
+            _cache.move_to_end(properties_path)
+            if now - entry[0] < CHECK_INTERVAL:
+                return entry[2]
+
+    try:
+        st = os.stat(properties_path)
+    except FileNotFoundError:
+        with _cache_lock:
+            _cache.pop(properties_path, None)
+        raise
+    signature = (st.st_mtime_ns, st.st_size)
+
+    if entry is not None and entry[1] == signature:
+        props = entry[2]
+    else:
+        props = parse_properties(properties_path)
+
+    with _cache_lock:
+        _cache[properties_path] = (now, signature, props)
+        _cache.move_to_end(properties_path)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return props
+
+
+def get_initial_view(properties_path):
+    """
+    Read the initial view of a HiPS.
+
+    Args:
+        properties_path (str): Path to the properties file.
+
+    Returns:
+        tuple: (hips_initial_ra, hips_initial_dec, hips_initial_fov) as
+        floats, None for the values missing or if there is no properties
+        file.
+    """
+    try:
+        props = read_properties(properties_path)
+    except FileNotFoundError:
+        return None, None, None
+
+    return tuple(
+        float(props[key]) if key in props else None
+        for key in ('hips_initial_ra', 'hips_initial_dec', 'hips_initial_fov')
+    )